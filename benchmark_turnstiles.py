@@ -0,0 +1,97 @@
+from src.turnstile import cleaning, synthetic, turnstile
+from datetime import datetime, timedelta
+from pathlib import Path
+import argparse
+import json
+import logging
+import resource
+import tempfile
+import time
+import tracemalloc
+
+# group by keys of process_turnstiles.py, the station columns are needed to
+# aggregate by station
+GROUP_BY = ['STATION', 'LINENAME', 'UNIT', 'SCP']
+
+
+def run_stage(results, scale, memory, stage, rows, function, *args, **kwargs):
+    """
+    Run one stage of the pipeline, record its time and peak memory. The rows
+    are the rows in, or the rows out if None. tracemalloc slows down Python
+    code, most of all the pandas engine, so the stage is timed without it and
+    run a second time under it for the peak memory, unless memory is False.
+    """
+    started = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    rows = len(output) if rows is None else rows
+    results.append({
+        'units': scale,
+        'stage': stage,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds) if seconds else None,
+        'peak_mb': None if peak is None else round(peak / 2**20, 1),
+        # high water mark of the whole process so far
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1),
+    })
+    logging.info("%d units, %s: %d rows in %.2fs", scale, stage, rows, seconds)
+    return output
+
+
+def benchmark_scale(results, units, args):
+    first_week = args.start + timedelta(days=7)
+    weeks = [first_week + timedelta(days=7 * w) for w in range(args.weeks)]
+    start_date, end_date = weeks[0] - timedelta(days=6), weeks[-1] - timedelta(days=1)
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic.build_turnstile_site(directory, first_week, weeks=args.weeks,
+                                       units=units, scps=args.scps, seed=args.seed)
+        server, base_url = synthetic.serve_turnstile_site(directory)
+        try:
+            raw = run_stage(results, units, args.memory, 'download', None, turnstile.download_turnstile_data, start_date, end_date, workers=args.download_workers, base_url=base_url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    raw = turnstile._select_dates(raw, start_date, end_date)
+    processed = run_stage(results, units, args.memory, 'process_raw_data', len(raw), turnstile._process_raw_data, raw, GROUP_BY)
+    processed, _ = run_stage(results, units, args.memory, 'clean_counters', len(processed), cleaning.clean_counters, processed, GROUP_BY)
+    for engine in args.engines:
+        interpolated = run_stage(results, units, args.memory, 'interpolate_' + engine, len(processed), turnstile.ENGINES[engine], processed, GROUP_BY, args.interval)
+    with tempfile.TemporaryDirectory() as directory:
+        run_stage(results, units, args.memory, 'aggregate_by_station', len(interpolated), turnstile.aggregate_turnstile_data_by_station, interpolated, directory, workers=args.write_workers)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level= logging.INFO)
+    parser = argparse.ArgumentParser(description='Times the turnstile pipeline on synthetic weekly files served from a local HTTP server, see src/turnstile/synthetic.py')
+    parser.add_argument('units', type=int, nargs='*', help='The scales to run, in number of remote units', default=[50, 200, 800])
+    parser.add_argument('-s','--start', type=lambda s: datetime.fromisoformat(s), help='Date of the first synthetic snapshot', default=datetime(2019, 12, 28))
+    parser.add_argument('--weeks', type=int, help='Number of weekly files', default=2)
+    parser.add_argument('--scps', type=int, help='Number of turnstiles per unit', default=4)
+    parser.add_argument('--seed', type=int, help='Seed of the generator', default=0)
+    parser.add_argument('-i','--interval', type=str, help='The interpolation interval', default='1H')
+    parser.add_argument('--engines', choices=sorted(turnstile.ENGINES), nargs='+', help='The interpolation engines to time', default=sorted(turnstile.ENGINES))
+    parser.add_argument('-d','--download-workers', type=int, help='Number of weekly files to download concurrently', default=1)
+    parser.add_argument('--write-workers', type=int, help='Number of threads writing the station files', default=4)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='Only time the stages, without the second run of each stage that measures its peak memory')
+    parser.add_argument('-o','--output', type=str, help='JSON file to write the results to', default=None)
+
+    args = parser.parse_args()
+
+    results = []
+    for units in args.units:
+        benchmark_scale(results, units, args)
+
+    print(f"{'units':>6} {'stage':<22} {'rows':>10} {'seconds':>9} {'rows/s':>10} {'peak MB':>8} {'rss MB':>8}")
+    for r in results:
+        print(f"{r['units']:>6} {r['stage']:<22} {r['rows']:>10} {r['seconds']:>9.3f} {r['rows_per_second'] or 0:>10} {r['peak_mb'] or '-':>8} {r['max_rss_mb']:>8}")
+    if args.output:
+        Path(args.output).write_text(json.dumps({'parameters': {k: str(v) for k, v in vars(args).items()}, 'results': results}, indent=2))
@@ -1,6 +1,7 @@
 
-from src.turnstile import turnstile
-from datetime import datetime
+from src import profiling
+from src.turnstile import cube, hierarchy, incremental, rollup, service, sharding, sketches, store, streaming, turnstile, writer
+from datetime import datetime, timedelta
 from pathlib import Path
 import argparse
 import logging
@@ -9,42 +10,167 @@ if __name__ == "__main__":
 
     logging.basicConfig(level= logging.INFO)
     parser = argparse.ArgumentParser(description='Downloads turnstile data for a given time period, interpolates and aggregates to station level')
+    parser.add_argument('command', nargs='?', choices=['process', 'serve', 'coordinate', 'work'], help='process: download and process the data (the default). serve: load the station data in the output directory and answer HTTP/JSON queries about it, see src/turnstile/service.py. coordinate: split the processing into shards queued in the --job directory, wait for the workers to process them and merge their outputs into the station files. work: process the shards queued in the --job directory until there are none left, see src/turnstile/sharding.py', default='process')
     parser.add_argument('-s','--start', type=lambda s: datetime.fromisoformat(s), help='Date to start pulling data from', default=datetime(2020, 1, 1))
     parser.add_argument('-e','--end', type=lambda s: datetime.fromisoformat(s), help='Date to stop pulling data from', default = datetime.today())
-    parser.add_argument('-i','--interval', type=str, help='The interpolation interval, 1H, 15M etc', default = '1H')
+    parser.add_argument('-i','--interval', type=str, nargs='+', help='The interpolation interval, 1H, 15M etc. With several intervals the data is interpolated once and written to a subdirectory of the output per interval', default = ['1H'])
+    parser.add_argument('-w','--workers', type=int, help='Number of processes to interpolate with', default=1)
+    parser.add_argument('-d','--download-workers', type=int, help='Number of weekly files to download concurrently', default=1)
+    parser.add_argument('-c','--cache', type=str, help='Directory to cache the downloaded weekly files in, empty to disable', default='data/raw/turnstile')
+    parser.add_argument('-a','--archive', type=str, help='Read the weekly files from a local mirror instead of downloading them: a directory or zip file of turnstile_YYMMDD.txt files, plain or gzip compressed. The files are parsed by --download-workers processes', default=None)
+    parser.add_argument('--stream', action='store_true', help='Process one week at a time and append to the station files, memory use does not grow with the date range')
+    parser.add_argument('--incremental', action='store_true', help='Only process the weeks published since the last run into the output directory, and append them to the station files. Processes up to the latest week, --end is ignored')
 
+    parser.add_argument('-f','--format', choices=['csv', 'parquet'], help='csv: one file per station. parquet: a dataset partitioned by station and month, see src/turnstile/store.py', default='csv')
+    parser.add_argument('--write-workers', type=int, help='Number of threads writing the station files', default=4)
+    parser.add_argument('--compression', choices=['gzip', 'bz2', 'xz', 'zstd'], help='Compress the station csv files as they are written', default=None)
+    parser.add_argument('--cube', action='store_true', help='Also save a memory mapped station x interval cube under <output>/cube, see src/turnstile/cube.py')
+    parser.add_argument('--rollup', action='store_true', help='Also save daily, weekly, monthly and yearly rollups and hour of week profiles under <output>/rollup, updated with --incremental, see src/turnstile/rollup.py')
+    parser.add_argument('--sketches', action='store_true', help='Also save quantile sketches and moments of the station ridership per month and hour of week under <output>/sketches, see src/turnstile/sketches.py')
+    parser.add_argument('--levels', choices=hierarchy.LEVELS, nargs='+', help='Also sum the turnstile data at these levels of the station hierarchy in one pass and save them as <output>/levels.parquet, see src/turnstile/hierarchy.py', default=None)
     parser.add_argument('-o','--output', type=str, help='Directory to output to. ',default='turnstile_per_station')
     parser.add_argument('-m','--manifest', type=bool, help='Create a manifest markdown file?',default=True)
     parser.add_argument('-p','--prefix', type=str, help="Prefix to add on the the url's in the manifest", default='')
+    parser.add_argument('--job', type=str, help='Job directory shared by the coordinator and the workers, <output>/job by default', default=None)
+    parser.add_argument('--unit-shards', type=int, help='Number of shares of the turnstiles a coordinated job is split in', default=4)
+    parser.add_argument('--window', type=int, help='Number of days of the time windows a coordinated job is split in', default=28)
+    parser.add_argument('--local-workers', type=int, help='Number of worker processes the coordinator starts on this machine, the coordinator processes the queued shards itself while none is running', default=0)
+    parser.add_argument('--lease', type=int, help='Seconds after which the shard of a worker that stopped reporting is queued again', default=3600)
+    parser.add_argument('--host', type=str, help='Address to serve on', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port to serve on', default=8080)
+    profiling.add_arguments(parser)
 
     args = parser.parse_args()
     start = args.start
     end  = args.end
     output = args.output
     make_markdown_manifest= args.manifest
-    interpolation_period = args.interval
+    interpolation_periods = args.interval
     url_prefix = args.prefix
+    workers = args.workers
+    download_workers = args.download_workers
+    cache_directory = args.cache or None
+    archive = args.archive
+    stream = args.stream
+    incremental_update = args.incremental
+    output_format = args.format
+    write_workers = args.write_workers
+    compression = args.compression
+    make_cube = args.cube
+    make_rollup = args.rollup
+    make_sketches = args.sketches
+    levels = args.levels
+    profiler = profiling.Profiler.from_args(args)
+    # the station columns are needed to aggregate by station
+    group_by = ['STATION', 'LINENAME', 'UNIT', 'SCP']
 
-    logging.info(f"Downloading data between ${start} and ${end}")
-    turnstile_data = turnstile.create_interpolated_turnstile_data(start_date=start, end_date=end,frequency=interpolation_period)
+    outputDir = Path(output)
+    jobDir = Path(args.job) if args.job else outputDir / 'job'
 
-    logging.info("Aggregating data")
+    if args.command == 'serve':
+        index = service.RidershipIndex(service.load_station_data(outputDir, output_format))
+        service.RidershipService(index).serve_forever(args.host, args.port)
+        parser.exit()
 
-    turnstile_by_station = turnstile.aggregate_turnstile_data_by_station(turnstile_data, 'data/crosswalk/ee_turnstile.csv')
+    if args.command == 'work':
+        sharding.run_worker(jobDir, workers=workers, download_workers=download_workers)
+        parser.exit()
 
-    logging.info("Writing out data")
-    outputDir = Path(output)
     outputDir.mkdir(exist_ok=True)
 
-    for station in turnstile_by_station.keys():
-        outfile = (outputDir / station).with_suffix('.csv')
-        turnstile_by_station[station].to_csv(outfile,index=False)
+    if incremental_update and output_format != 'csv':
+        parser.error('--incremental only supports the csv format')
+    if (incremental_update or stream) and len(interpolation_periods) > 1:
+        parser.error('--stream and --incremental only support one interval')
+    if (incremental_update or stream or output_format != 'csv') and compression:
+        parser.error('--compression is only supported by the batch csv output')
+    if (incremental_update or stream) and make_cube:
+        parser.error('--cube is only supported in batch mode')
+    if (incremental_update or stream) and levels:
+        parser.error('--levels is only supported in batch mode')
+    if incremental_update and make_sketches:
+        parser.error('--sketches is not supported with --incremental')
+    if args.command == 'coordinate' and (stream or incremental_update or len(interpolation_periods) > 1):
+        parser.error('coordinate only supports one interval, without --stream or --incremental')
+    if args.command == 'coordinate' and (make_cube or make_rollup or make_sketches or levels):
+        parser.error('--cube, --rollup, --sketches and --levels are not supported by coordinate')
+    interpolation_period = interpolation_periods[0]
+    # the output directory of each interval
+    outputDirs = {interpolation_period: outputDir} if len(interpolation_periods) == 1 else {period: outputDir / period for period in interpolation_periods}
+
+    # the station files written to each output directory, for the manifest
+    written = {}
+    with profiler:
+        if incremental_update:
+            logging.info(f"Updating data since ${start} in {outputDir}")
+            with profiling.span('incremental') as span:
+                written[outputDir] = span.output(incremental.update_station_files(outputDir, start_date=start, group_by=group_by, frequency=interpolation_period, cache_directory=cache_directory, rollup_directory=outputDir / 'rollup' if make_rollup else None, archive=archive))
+        elif args.command == 'coordinate':
+            logging.info(f"Coordinating the processing of data between ${start} and ${end} in {jobDir}")
+            sharding.create_job(jobDir, start, end, unit_shards=args.unit_shards, window=timedelta(days=args.window), group_by=group_by, frequency=interpolation_period, cache_directory=cache_directory, archive=archive)
+            with profiling.span('wait_for_job'):
+                processes = sharding.start_local_workers(jobDir, args.local_workers, workers, download_workers)
+                sharding.wait_for_job(jobDir, lease=timedelta(seconds=args.lease), processes=processes, workers=workers, download_workers=download_workers)
+            with profiling.span('merge_job') as span:
+                station_data = span.output(sharding.merge_job(jobDir))
+            with profiling.span('write_' + output_format, rows_in=len(station_data)) as span:
+                if output_format == 'parquet':
+                    store.write_station_store(station_data, outputDir)
+                else:
+                    written[outputDir] = span.output(writer.write_station_files(station_data, outputDir, workers=write_workers, compression=compression))
+        elif stream:
+            logging.info(f"Streaming data between ${start} and ${end}")
+            stationWriter = store.StoreWriter(outputDir) if output_format == 'parquet' else streaming.StationWriter(outputDir)
+            rollupWriter = rollup.RollupWriter(outputDir / 'rollup', rebuild=True) if make_rollup else None
+            sketchWriter = sketches.SketchWriter(outputDir / 'sketches') if make_sketches else None
+            for chunk in streaming.stream_interpolated_turnstile_data(start_date=start, end_date=end, group_by=group_by, frequency=interpolation_period, cache_directory=cache_directory, archive=archive):
+                with profiling.span('write_chunk', rows_in=len(chunk)):
+                    stationWriter.write(chunk)
+                    if rollupWriter:
+                        rollupWriter.write(chunk)
+                    if sketchWriter:
+                        sketchWriter.write(chunk)
+            if rollupWriter:
+                with profiling.span('build_rollup'):
+                    rollupWriter.close()
+            if sketchWriter:
+                with profiling.span('save_sketches'):
+                    sketchWriter.close()
+            if output_format == 'csv':
+                written[outputDir] = stationWriter.files
+        else:
+            logging.info(f"Downloading data between ${start} and ${end}")
+            with profiling.span('create_interpolated_turnstile_data') as span:
+                turnstile_data = span.output(turnstile.create_interpolated_turnstile_data(start_date=start, end_date=end, group_by=group_by, frequency=interpolation_periods, workers=workers, download_workers=download_workers, cache_directory=cache_directory, archive=archive))
+
+            if levels:
+                crosswalk = hierarchy.Crosswalk.from_files('data/crosswalk/Master_crosswalk.csv', 'data/crosswalk/ee_turnstile.csv', 'data/raw/google_transit/transfers.txt')
+            for period, periodDir in outputDirs.items():
+                logging.info(f"Aggregating data for {period}")
+                station_data = turnstile.sum_turnstile_data_by_station(turnstile_data[period])
+
+                logging.info("Writing out data")
+                with profiling.span('write_' + output_format, rows_in=len(station_data), interval=period) as span:
+                    if output_format == 'parquet':
+                        store.write_station_store(station_data, periodDir)
+                    else:
+                        written[periodDir] = span.output(writer.write_station_files(station_data, periodDir, workers=write_workers, compression=compression))
+                if make_cube:
+                    with profiling.span('build_cube', rows_in=len(station_data), interval=period):
+                        cube.build_cube(station_data, periodDir / 'cube', frequency=period)
+                if levels:
+                    with profiling.span('aggregate_levels', rows_in=len(turnstile_data[period]), interval=period) as span:
+                        span.output(hierarchy.aggregate_levels(turnstile_data[period], crosswalk, levels)).to_parquet(periodDir / 'levels.parquet', index=False)
+                if make_rollup:
+                    with profiling.span('build_rollup', rows_in=len(station_data), interval=period):
+                        rollup.RollupPyramid.build(station_data).save(periodDir / 'rollup')
+                if make_sketches:
+                    with profiling.span('build_sketches', rows_in=len(station_data), interval=period):
+                        ridership_sketches = sketches.RidershipSketches()
+                        ridership_sketches.add(station_data)
+                        ridership_sketches.save(periodDir / 'sketches')
 
     if (make_markdown_manifest):
         logging.info("Making manifest")
-
-        filelist = outputDir.glob('*.csv')
-        linkList = '\n'.join([ f"- [{file.name}]({url_prefix}{file.name})" for file in filelist])
-        header = f"## Turnstile data per station per hour for 2020\n {linkList}"
-        with open(outputDir /'turnstile_station_data.md', 'w') as f:
-            f.write(header)
\ No newline at end of file
+        for periodDir, files in written.items():
+            writer.write_manifest(files, periodDir, url_prefix)
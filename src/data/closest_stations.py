@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point, LineString
@@ -7,7 +8,9 @@ import numpy as np
 from pathlib import Path
 import matplotlib.pyplot as plt
 
-DATA_PATH = Path('../../data')
+from src import profiling
+
+DATA_PATH = Path(__file__).resolve().parents[2] / 'data'
 PROCESSED_DATA_PATH = DATA_PATH / 'processed/nearest'
 def load_graph():
     ox.config(use_cache=True, log_console=True)
@@ -86,17 +89,29 @@ def plot_all_routes(graph,nodes,routes):
 
 def process():
     PROCESSED_DATA_PATH.mkdir(exist_ok=True)
-    graph = load_graph()
-    plot_graph(graph)
-    stations = load_stations_with_elevators()
-    nodes = get_nearest_nodes(stations,graph)
-    euclidian_distances = calculate_euclid_distances(nodes,graph) 
-    walking_distances = calculate_walking_distances(nodes,graph, euclidian_distances)
-    nearest = get_closest(walking_distances)
+    with profiling.span('load_graph') as span:
+        graph = span.output(load_graph())
+    with profiling.span('plot_graph', rows_in=len(graph)):
+        plot_graph(graph)
+    with profiling.span('load_stations_with_elevators') as span:
+        stations = span.output(load_stations_with_elevators())
+    with profiling.span('get_nearest_nodes', rows_in=len(stations)) as span:
+        nodes = span.output(get_nearest_nodes(stations,graph))
+    with profiling.span('calculate_euclid_distances', rows_in=len(nodes)) as span:
+        euclidian_distances = span.output(calculate_euclid_distances(nodes,graph))
+    with profiling.span('calculate_walking_distances', rows_in=len(nodes)) as span:
+        walking_distances = span.output(calculate_walking_distances(nodes,graph, euclidian_distances))
+    with profiling.span('get_closest', rows_in=len(walking_distances)) as span:
+        nearest = span.output(get_closest(walking_distances))
     nearest.to_csv(PROCESSED_DATA_PATH / 'nearest_stations.csv',index=False)
     walking_distances.to_csv(PROCESSED_DATA_PATH / "all_walking_distances.csv",index=False)
-    plot_all_routes(graph,nodes,nearest) 
+    with profiling.span('plot_all_routes', rows_in=len(nearest)):
+        plot_all_routes(graph,nodes,nearest) 
 
 
 if __name__ =='__main__':
-    process() 
\ No newline at end of file
+    parser = argparse.ArgumentParser("Closest stations")
+    profiling.add_arguments(parser)
+    opts = parser.parse_args()
+    with profiling.Profiler.from_args(opts):
+        process()
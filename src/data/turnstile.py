@@ -7,10 +7,11 @@ import pandas as pd
 import re
 import requests
 
-from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from html.parser import HTMLParser
-from typing import Dict
+from typing import Dict, List, Union
 
 # This module provides methods that handles MTA turnstile data
 
@@ -70,11 +71,30 @@ def _process_grouped_data(grouped: pd.DataFrame):
     return interpolated_group
 
 
-def _interpolate(intervalized_data: pd.DataFrame) -> pd.DataFrame:
-    logging.getLogger().info("Start creating hourly turnstile data")
-
+def _interpolate_chunk(intervalized_data: pd.DataFrame) -> pd.DataFrame:
     interpolated = []
     intervalized_data.groupby(['UNIT', 'SCP']).apply(lambda g: interpolated.append(_process_grouped_data(g)))
+    return pd.concat(interpolated)
+
+
+def _split_into_chunks(intervalized_data: pd.DataFrame, chunks: int) -> List[pd.DataFrame]:
+    # contiguous runs of (UNIT, SCP) groups with roughly the same number of rows
+    codes = intervalized_data.groupby(['UNIT', 'SCP'], sort=True).ngroup()
+    intervalized_data, codes = intervalized_data[codes.notnull()], codes[codes.notnull()].astype(int)
+    sizes = np.bincount(codes)
+    chunk_of_group = (np.cumsum(sizes) - sizes) * chunks // max(sizes.sum(), 1)
+    return [chunk for _, chunk in intervalized_data.groupby(chunk_of_group[codes.values])]
+
+
+def _interpolate(intervalized_data: pd.DataFrame, workers: int=1) -> pd.DataFrame:
+    logging.getLogger().info("Start creating hourly turnstile data")
+
+    if workers > 1:
+        # executor.map keeps the order of the chunks, the result doesn't depend on the number of workers
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            interpolated = list(executor.map(_interpolate_chunk, _split_into_chunks(intervalized_data, workers * 4)))
+    else:
+        interpolated = [_interpolate_chunk(intervalized_data)]
     logging.getLogger().info("Finish interpolating")
     result = pd.concat(interpolated)
     logging.getLogger().info("Finish concatenating the result")
@@ -150,7 +170,7 @@ def download_turnstile_data(start_date: datetime, end_date: datetime=None) -> pd
     return pd.concat(dfs)
 
 
-def get_hourly_turnstile_data(start_date: datetime, end_date=None) -> pd.DataFrame:
+def get_hourly_turnstile_data(start_date: datetime, end_date=None, workers: int=1) -> pd.DataFrame:
     """
     Get hourly turnstile data
 
@@ -162,6 +182,7 @@ def get_hourly_turnstile_data(start_date: datetime, end_date=None) -> pd.DataFra
     Parameters
     start_date : datetime
     end_date : datetime, optional
+    workers : int, optional - number of processes to interpolate with
 
     Returns
     dataframe
@@ -177,13 +198,172 @@ def get_hourly_turnstile_data(start_date: datetime, end_date=None) -> pd.DataFra
 
     """
     raw = download_turnstile_data(start_date, end_date)
-    interpolated = _interpolate(_process_raw_data(raw))
+    interpolated = _interpolate(_process_raw_data(raw), workers)
     end_date = end_date or interpolated.index.max()
     return interpolated[interpolated.index.to_series().between(start_date, end_date)] \
         .drop(columns=["entry_diffs", "exit_diffs", "entry_diffs_abs", "exit_diffs_abs"])
 
 
-def split_turnstile_data_by_station(turnstile_data: pd.DataFrame, station_turnstile_file_path: str) \
+class StationMapping:
+    """
+    UNIT to station mapping of the station to turnstile file
+    (data/crosswalk/ee_turnstile.csv), compiled to integer codes
+
+    A remote unit can serve several stations and a station several units. The
+    units of the file are indexed once, and each unit code points to its
+    equipment rows and to its stations in two sorted lookup tables, so that
+    turnstile data is mapped to stations by array indexing instead of
+    merging strings.
+    """
+
+    def __init__(self, equipment: pd.DataFrame, remotes: pd.Series):
+        # equipment: the rows of the file without the remote column
+        # remotes: the remote units of each equipment row, as lists
+        self.equipment = equipment.reset_index(drop=True)
+        counts = remotes.str.len().to_numpy()
+        equipment_rows = np.repeat(np.arange(len(counts)), counts)
+        unit_codes, units = pd.factorize(
+            np.concatenate(remotes.to_numpy()) if counts.sum() else np.array([], dtype=object),
+            sort=True)
+        self.units = pd.Index(units)
+        # the equipment rows of each unit, in the order of the file
+        order = np.argsort(unit_codes, kind='stable')
+        self.equipment_rows = equipment_rows[order]
+        self.equipment_offsets = np.append(
+            0, np.cumsum(np.bincount(unit_codes, minlength=len(self.units))))
+
+        # the station of each equipment row
+        self.station_codes, self.stations = pd.factorize(
+            self.equipment['station_name'], sort=True)
+        # the distinct stations of each unit, in a lookup table like the
+        # equipment rows
+        pairs = np.unique(unit_codes * len(self.stations) +
+                          self.station_codes[equipment_rows])
+        self.unit_stations = pairs % len(self.stations)
+        self.station_offsets = np.append(0, np.cumsum(np.bincount(
+            pairs // len(self.stations), minlength=len(self.units))))
+
+    @classmethod
+    def from_file(cls, station_turnstile_file_path: str) -> 'StationMapping':
+        equipment = pd.read_csv(station_turnstile_file_path)
+        # the remote column holds python lists, e.g. ['R132', 'R133']
+        remotes = equipment.remote.astype(str).str.findall(r"'([^']*)'")
+        return cls(equipment.drop(columns=['Unnamed: 0', 'remote'], errors='ignore'),
+                   remotes)
+
+    def unit_codes(self, units: pd.Series) -> np.ndarray:
+        """
+        The code of each unit, -1 for units the file doesn't map
+        """
+        return self.units.get_indexer(units)
+
+    @staticmethod
+    def _expand(codes: np.ndarray, offsets: np.ndarray) -> (np.ndarray, np.ndarray):
+        # for each row the positions of its code's entries in a lookup table:
+        # the row repeated once per entry, and the position of the entry
+        known = codes >= 0
+        starts = np.where(known, offsets[np.maximum(codes, 0)], 0)
+        counts = np.where(known, offsets[np.maximum(codes, 0) + 1] - starts, 0)
+        rows = np.repeat(np.arange(len(codes)), counts)
+        firsts = np.cumsum(counts) - counts
+        return rows, starts[rows] + np.arange(len(rows)) - firsts[rows]
+
+    def aggregate(self, turnstile_data: pd.DataFrame, columns: List[str] = None,
+                  by: str = 'station') -> pd.DataFrame:
+        """
+        Sum turnstile data by datetime and station, or by datetime, STATION
+        and UNIT, in one pass
+
+        The datetimes, stations and units are integer codes, the sums of
+        each combination of codes are bincounts. By station, each row counts
+        towards every station its unit serves. By unit, the rows of units the
+        file doesn't map are left out.
+
+        Parameters
+        turnstile_data: pandas.DataFrame - with a UNIT column and a datetime
+            column or index, e.g. the output of get_hourly_turnstile_data
+        columns: List[str], optional - the columns to sum, all numeric
+            columns if not specified
+        by: str, optional - station or unit
+
+        Return
+        pandas.DataFrame - datetime, station_name and the sums by station,
+        datetime, STATION, UNIT and the sums by unit, sorted by the keys
+
+        """
+        if by not in ('station', 'unit'):
+            raise Exception("Unsupported aggregation: " + str(by))
+        if 'datetime' not in turnstile_data.columns:
+            turnstile_data = turnstile_data.reset_index()
+        if columns is None:
+            columns = [c for c in turnstile_data.select_dtypes('number').columns]
+        unit_codes = self.unit_codes(turnstile_data['UNIT'])
+        time_codes, times = pd.factorize(turnstile_data['datetime'], sort=True)
+        if by == 'station':
+            rows, entries = self._expand(unit_codes, self.station_offsets)
+            codes = [time_codes[rows], self.unit_stations[entries]]
+            labels = [('datetime', times), ('station_name', self.stations)]
+        else:
+            station_codes, stations = pd.factorize(turnstile_data['STATION'], sort=True)
+            rows = np.flatnonzero((time_codes >= 0) & (station_codes >= 0) & (unit_codes >= 0))
+            codes = [time_codes[rows], station_codes[rows], unit_codes[rows]]
+            labels = [('datetime', times), ('STATION', stations), ('UNIT', self.units)]
+        # one key per combination of codes, in the order of the labels
+        key = np.zeros(len(rows), dtype=np.int64)
+        for code, (_, label) in zip(codes, labels):
+            key = key * len(label) + code
+        keys, inverse = np.unique(key, return_inverse=True)
+        result = {}
+        for name, label in reversed(labels):
+            result[name] = label[keys % len(label)]
+            keys = keys // len(label)
+        result = {name: result[name] for name, _ in labels}
+        for column in columns:
+            values = turnstile_data[column].to_numpy(dtype=np.float64)[rows]
+            sums = np.bincount(inverse, np.where(np.isnan(values), 0, values),
+                               minlength=len(result[labels[0][0]]))
+            # integer columns can't hold NaN, their sums are exact
+            dtype = turnstile_data[column].dtype
+            result[column] = sums.astype(dtype) if np.issubdtype(dtype, np.integer) else sums
+        return pd.DataFrame(result)
+
+    def join_equipment(self, unit_data: pd.DataFrame) -> (pd.DataFrame, np.ndarray):
+        """
+        Join the rows of units to the equipment rows of their unit, on
+        integer codes
+
+        Parameters
+        unit_data: pandas.DataFrame - with a UNIT column, e.g. the output of
+            aggregate with by='unit'
+
+        Return
+        (pandas.DataFrame, numpy.ndarray) - a row per row and equipment row
+        of its unit, with the equipment columns and the unit in remote, and
+        the station code of each row, see stations. Units the file doesn't
+        map have no rows.
+
+        """
+        rows, entries = self._expand(self.unit_codes(unit_data['UNIT']),
+                                     self.equipment_offsets)
+        equipment_rows = self.equipment_rows[entries]
+        joined = pd.concat([
+            unit_data.iloc[rows].reset_index(drop=True),
+            self.equipment.iloc[equipment_rows].reset_index(drop=True)], axis=1)
+        joined['remote'] = joined['UNIT']
+        return joined, self.station_codes[equipment_rows]
+
+
+@lru_cache(maxsize=None)
+def load_station_mapping(station_turnstile_file_path: str) -> StationMapping:
+    """
+    The StationMapping of a station to turnstile file, compiled on the first
+    call and reused afterwards
+    """
+    return StationMapping.from_file(station_turnstile_file_path)
+
+
+def split_turnstile_data_by_station(turnstile_data: pd.DataFrame,
+                                    station_turnstile_file_path: Union[str, StationMapping]) \
     -> Dict[str, pd.DataFrame]:
 
     """
@@ -191,22 +371,25 @@ def split_turnstile_data_by_station(turnstile_data: pd.DataFrame, station_turnst
 
     Parameters
     turnstile_data: pandas.DataFram
-    station_turnstile_file_path: str
+    station_turnstile_file_path: str or StationMapping - the file is compiled
+        into a StationMapping once, see load_station_mapping
 
     Return
-    dict[station_name:str, station_turnstile_data: pd.DataFrame]
+    dict[station_name:str, station_turnstile_data: pd.DataFrame] - the sums of
+    each datetime, STATION and UNIT, joined to the equipment rows of the unit
 
     """
 
-    equipment = pd.read_csv(station_turnstile_file_path)
-    equipment.remote = equipment.remote.apply(lambda x: literal_eval(str(x)))
-    lst_col = 'remote'
-    mapping = pd.DataFrame({col:np.repeat(equipment[col].values, equipment[lst_col].str.len())
-                    for col in equipment.columns.difference([lst_col])}).assign(
-                        **{lst_col:np.concatenate(equipment[lst_col].values)})[equipment.columns.tolist()]
-    mapping.drop(columns = ['Unnamed: 0'], inplace=True)
-    aggregated = turnstile_data.groupby(['datetime', 'STATION', 'UNIT']).sum().reset_index()
-    merged = aggregated.merge(mapping, how='left', left_on=['UNIT'], right_on=[lst_col])
-    return {re.sub(r"\s+", '_', re.sub(r"[/|-]", " ", station)) + ".csv": df \
-         for (station, df) in merged.groupby(['station_name'])}
-
+    mapping = station_turnstile_file_path
+    if not isinstance(mapping, StationMapping):
+        mapping = load_station_mapping(station_turnstile_file_path)
+    merged, station_codes = mapping.join_equipment(
+        mapping.aggregate(turnstile_data, by='unit'))
+
+    # one stable sort by station, each station is a contiguous slice
+    order = np.argsort(station_codes, kind='stable')
+    merged, station_codes = merged.iloc[order], station_codes[order]
+    bounds = np.append(np.flatnonzero(np.diff(station_codes, prepend=-1)), len(order))
+    return {re.sub(r"\s+", '_', re.sub(r"[/|-]", " ", mapping.stations[station_codes[start]])) + ".csv":
+            merged.iloc[start:stop]
+            for start, stop in zip(bounds[:-1], bounds[1:]) if station_codes[start] >= 0}
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+# This module records named spans around the stages of the scripts: wall
+# time, CPU time of the process, rows in and out, and the peak RSS of the
+# process when the span ends. Each span is written as a line of JSON when it
+# ends, and all of them can be saved as a trace in the Chrome trace event
+# format, which chrome://tracing and https://ui.perfetto.dev open.
+#
+#   with profiling.Profiler.from_args(opts):
+#       with profiling.span('load', rows_in=len(df)) as s:
+#           ...
+#           s.rows_out = len(result)
+#
+# It only uses the standard library, and is imported as src.profiling: the
+# scripts run from the project directory, the ones in src as modules, e.g.
+# python -m src.stationgraph.buildgraphs. The turnstile package records its
+# stages with spans too.
+#
+# Spans opened while no profiler is active cost a function call, so library
+# code can open them without checking if profiling is on.
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+def count_rows(value) -> int:
+    """
+    Number of rows of a stage's input or output: the rows of a DataFrame or
+    array, the sum over a dict of them, the first item of a tuple, the nodes
+    of a graph, or the length of a list. None if unknown.
+    """
+    if value is None:
+        return None
+    if hasattr(value, 'shape'):
+        return value.shape[0]
+    if isinstance(value, dict):
+        counts = [count_rows(v) for v in value.values()]
+        return None if None in counts else sum(counts)
+    if isinstance(value, tuple):
+        return count_rows(value[0]) if value else None
+    if hasattr(value, 'vcount'):
+        return value.vcount()
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+class Span:
+    """
+    A running stage, rows_out and attributes can be set until it ends
+    """
+
+    def __init__(self, name: str, parent: str = None, rows_in: int = None,
+                 **attributes):
+        self.name = name
+        self.parent = parent
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.attributes = attributes
+
+    def output(self, value):
+        """
+        Set rows_out from a value and return it
+        """
+        self.rows_out = count_rows(value)
+        return value
+
+
+class Profiler:
+    """
+    Collects the spans of a run, see the module comment
+
+    Parameters
+    output: str, optional - file to append the JSON lines of the spans to,
+        '-' for stderr, None to not write them
+    trace: str, optional - file to save the Chrome trace to when the
+        profiler is closed
+    """
+
+    enabled = True
+
+    def __init__(self, output: str = '-', trace: str = None):
+        self.output = output
+        self.trace = trace
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stream = None
+        self._start = time.perf_counter()
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> 'Profiler':
+        """
+        The profiler of the --profile and --profile-trace arguments, see
+        add_arguments. An inactive profiler if neither is set.
+        """
+        if args.profile is None and args.profile_trace is None:
+            return _NullProfiler()
+        return cls(args.profile, args.profile_trace)
+
+    def __enter__(self) -> 'Profiler':
+        global _active
+        self._previous = _active
+        _active = self
+        if self.output == '-':
+            self._stream = sys.stderr
+        elif self.output is not None:
+            self._stream = open(self.output, 'a')
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        if self._stream is not None and self._stream is not sys.stderr:
+            self._stream.close()
+        if self.trace is not None:
+            with open(self.trace, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f)
+
+    @contextmanager
+    def span(self, name: str, rows_in: int = None, **attributes) -> Iterator[Span]:
+        stack = self._local.__dict__.setdefault('stack', [])
+        s = Span(name, stack[-1].name if stack else None, rows_in, **attributes)
+        stack.append(s)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        try:
+            yield s
+        finally:
+            stack.pop()
+            ended = time.perf_counter()
+            self._record(s, started, ended, time.process_time() - cpu_started)
+
+    def _record(self, s: Span, started: float, ended: float, cpu: float):
+        record = {
+            'span': s.name,
+            'parent': s.parent,
+            'wall_seconds': round(ended - started, 6),
+            'cpu_seconds': round(cpu, 6),
+            'rows_in': s.rows_in,
+            'rows_out': s.rows_out,
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+        record.update(s.attributes)
+        event = {
+            'name': s.name,
+            'ph': 'X',
+            'ts': round((started - self._start) * 10**6, 1),
+            'dur': round((ended - started) * 10**6, 1),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {k: v for k, v in record.items()
+                     if k not in ('span', 'wall_seconds')},
+        }
+        with self._lock:
+            self.events.append(event)
+            if self._stream is not None:
+                self._stream.write(json.dumps(record, default=str) + '\n')
+                self._stream.flush()
+
+
+class _NullProfiler(Profiler):
+    # records nothing, for runs without --profile
+
+    enabled = False
+
+    def __init__(self):
+        super().__init__(output=None)
+
+    def __enter__(self) -> 'Profiler':
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    @contextmanager
+    def span(self, name: str, rows_in: int = None, **attributes) -> Iterator[Span]:
+        yield Span(name, None, rows_in, **attributes)
+
+
+_null = _NullProfiler()
+# the profiler spans are recorded to, set while a Profiler is entered
+_active = _null
+
+
+def span(name: str, rows_in: int = None, **attributes):
+    """
+    A span of the active profiler, does nothing if there's none
+
+    Parameters
+    name: str
+    rows_in: int, optional
+    attributes - added to the JSON record of the span
+
+    Return
+    context manager returning the Span, to set rows_out on
+    """
+    return _active.span(name, rows_in, **attributes)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """
+    Add the --profile and --profile-trace arguments shared by the scripts
+    """
+    parser.add_argument('--profile', nargs='?', const='-', default=None, metavar='FILE',
+                        help='Record the wall time, CPU time, rows in and out and peak RSS of each stage as lines of JSON, appended to FILE or written to stderr')
+    parser.add_argument('--profile-trace', default=None, metavar='FILE',
+                        help='Save the stages as a Chrome trace file, to open in chrome://tracing or ui.perfetto.dev. Implies --profile, without FILE the JSON lines are not written')
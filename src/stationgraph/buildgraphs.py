@@ -10,7 +10,8 @@ import pandas as pd
 import re
 import sys
 
-from utils import split_elevator_description
+from src import profiling
+from src.stationgraph.utils import split_elevator_description
 
 
 def load_equipment(master_file, with_inactive=False, with_inaccessible=False, with_escalators=False, with_elevators=True):
@@ -168,37 +169,46 @@ def main():
     parser.add_argument("--no-elevators", dest="elevators", action="store_false", required=False,
             help="don't include elevators as a connection between floors")
     parser.add_argument("--verbose", dest="verbose", action="store_true", required=False, default=False)
+    profiling.add_arguments(parser)
 
     opts = parser.parse_args()
 
     log = (lambda hdr,df: print("==={}===\n{}".format(hdr, df.head()), file=sys.stderr)
           ) if opts.verbose else (lambda hdr,df: None)
 
-    equipment = load_equipment(opts.master_list,
-                               with_inactive=opts.inactive, with_inaccessible=opts.inaccessible,
-                               with_escalators=opts.escalators, with_elevators=opts.elevators)
-    log("Equipment", equipment)
-
-    platforms = load_platforms(opts.platform_list)
-    log("Platforms", platforms)
-
-    overrides = load_overrides(opts.override_list)
-    log("Overrides", overrides)
-
-    equipment = merge_platforms(equipment, platforms)
-    log("Merged 1", equipment)
-
-    from_to = identify_edges(equipment)
-    equipment = pd.concat([equipment, from_to], axis=1, sort=False)
-    log("Merged 2", equipment)
-
-    column_names = ['station_name','equipment_id','from','to','platform_id']
-    equipment = equipment[column_names]
-    equipment = merge_overrides(equipment, overrides)
-    log("Merged 3", equipment)
-
-    equipment.to_csv(sys.stdout if opts.output is None else opts.output,
-                     index=False, columns=column_names)
+    with profiling.Profiler.from_args(opts):
+        with profiling.span("load_equipment") as span:
+            equipment = span.output(load_equipment(opts.master_list,
+                                    with_inactive=opts.inactive, with_inaccessible=opts.inaccessible,
+                                    with_escalators=opts.escalators, with_elevators=opts.elevators))
+        log("Equipment", equipment)
+
+        with profiling.span("load_platforms") as span:
+            platforms = span.output(load_platforms(opts.platform_list))
+        log("Platforms", platforms)
+
+        with profiling.span("load_overrides") as span:
+            overrides = span.output(load_overrides(opts.override_list))
+        log("Overrides", overrides)
+
+        with profiling.span("merge_platforms", rows_in=len(equipment)) as span:
+            equipment = span.output(merge_platforms(equipment, platforms))
+        log("Merged 1", equipment)
+
+        with profiling.span("identify_edges", rows_in=len(equipment)) as span:
+            from_to = identify_edges(equipment)
+            equipment = span.output(pd.concat([equipment, from_to], axis=1, sort=False))
+        log("Merged 2", equipment)
+
+        column_names = ['station_name','equipment_id','from','to','platform_id']
+        equipment = equipment[column_names]
+        with profiling.span("merge_overrides", rows_in=len(equipment)) as span:
+            equipment = span.output(merge_overrides(equipment, overrides))
+        log("Merged 3", equipment)
+
+        with profiling.span("write", rows_in=len(equipment)):
+            equipment.to_csv(sys.stdout if opts.output is None else opts.output,
+                             index=False, columns=column_names)
 
     #canonical_cols = canonical_names(equipment)
     #equipment = pd.concat([equipment, canonical_cols], axis=1, sort=False)
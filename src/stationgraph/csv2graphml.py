@@ -8,6 +8,8 @@ import networkx as nx
 import pandas as pd 
 import sys
 
+from src import profiling
+
 def add_to_graph(g, df):
     for _, row in df.iterrows():
         station = row['station_name']
@@ -54,25 +56,31 @@ def main():
     parser.add_argument("--verbose", action="store_true", required=False, default=False)
     parser.add_argument("--pretty", action="store_true", required=False, default=False)
     parser.add_argument('stations', nargs="*")
+    profiling.add_arguments(parser)
 
     opts = parser.parse_args()
 
     log = (lambda txt: print(txt, file=sys.stderr)) if opts.verbose else (lambda txt: None)
 
-    graph_in = pd.read_csv(sys.stdin)
-    log("Read {} lines.".format(len(graph_in)))
-    if opts.stations:
-        log("Filtering by station: {}.".format(str(opts.stations)))
-        graph_in = graph_in[graph_in.station_name.isin(opts.stations)]
-        log("Filtered to {} lines.".format(len(graph_in)))
-
-    graph_in = add_canonical_names(graph_in)
-    graph_in = add_labels(graph_in)
-    log("Added canonical names and labels.")
-    graph_out = add_to_graph(nx.Graph(), graph_in)
-    log("Constructed graph.")
-    nx.write_graphml(graph_out, sys.stdout.buffer, prettyprint=opts.pretty)
-    log("Done.")
+    with profiling.Profiler.from_args(opts):
+        with profiling.span("read") as span:
+            graph_in = span.output(pd.read_csv(sys.stdin))
+        log("Read {} lines.".format(len(graph_in)))
+        if opts.stations:
+            log("Filtering by station: {}.".format(str(opts.stations)))
+            graph_in = graph_in[graph_in.station_name.isin(opts.stations)]
+            log("Filtered to {} lines.".format(len(graph_in)))
+
+        with profiling.span("add_names_and_labels", rows_in=len(graph_in)) as span:
+            graph_in = add_canonical_names(graph_in)
+            graph_in = span.output(add_labels(graph_in))
+        log("Added canonical names and labels.")
+        with profiling.span("add_to_graph", rows_in=len(graph_in)) as span:
+            graph_out = span.output(add_to_graph(nx.Graph(), graph_in))
+        log("Constructed graph.")
+        with profiling.span("write_graphml", rows_in=len(graph_out)):
+            nx.write_graphml(graph_out, sys.stdout.buffer, prettyprint=opts.pretty)
+        log("Done.")
 
 
 if __name__ == "__main__":
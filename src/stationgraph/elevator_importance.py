@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import sys
 
+from src import profiling
+
 def calc_betweeness(graph):
     elevators = graph.vs.select(lambda vertex: vertex["node_type"] == "Elevator")
     betweenness = graph.betweenness(vertices=elevators)
@@ -71,18 +73,25 @@ def main():
     parser.add_argument("--individual-station-graph", required=True)
     parser.add_argument("--complete-station-graph", required=True)
     parser.add_argument("--output", required=False)
+    profiling.add_arguments(parser)
 
     opts = parser.parse_args()
 
-    independent_stations_graph = igraph.Graph.Read_GraphML(opts.individual_station_graph)
-    importance = elevator_redundancy_analysis(independent_stations_graph)
-    output = pd.DataFrame(importance, columns = ['Station', 'Elevator', 'Importance', 'Perc. Importance'])  
-    
-    full_graph = igraph.Graph.Read_GraphML(opts.complete_station_graph)
-    betweenness = calc_betweeness(full_graph)
-    output['Betweenness'] = output["Elevator"].map({e[1]: e[2] for e in betweenness}) 
+    with profiling.Profiler.from_args(opts):
+        with profiling.span("read_individual_station_graph") as span:
+            independent_stations_graph = span.output(igraph.Graph.Read_GraphML(opts.individual_station_graph))
+        with profiling.span("elevator_redundancy_analysis", rows_in=independent_stations_graph.vcount()) as span:
+            importance = span.output(elevator_redundancy_analysis(independent_stations_graph))
+        output = pd.DataFrame(importance, columns = ['Station', 'Elevator', 'Importance', 'Perc. Importance'])  
+        
+        with profiling.span("read_complete_station_graph") as span:
+            full_graph = span.output(igraph.Graph.Read_GraphML(opts.complete_station_graph))
+        with profiling.span("calc_betweeness", rows_in=full_graph.vcount()) as span:
+            betweenness = span.output(calc_betweeness(full_graph))
+        output['Betweenness'] = output["Elevator"].map({e[1]: e[2] for e in betweenness}) 
 
-    output.to_csv(sys.stdout if opts.output is None else opts.output, index=False)
+        with profiling.span("write", rows_in=len(output)):
+            output.to_csv(sys.stdout if opts.output is None else opts.output, index=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,6 +4,8 @@ import textdistance
 import numpy as np
 import argparse
 
+from src import profiling
+
 north_bound = ['north','norwood 205 st', 'woodlawn','jamaica', 'flushing main st','jamaica center','flushing', 'wakefield 241 st','jamaica, forest hills']
 south_bound = ['south','bay ridge', 'coney island','flatbush av brooklyn college','brighton beach, coney island, bay ridge','brighton beach','coney island, brighton beach','far rockaway']
 
@@ -61,34 +63,45 @@ def main():
     parser.add_argument("--edgelist", required=True)
     parser.add_argument("--gtfs", required=True)
     parser.add_argument("--output", required=False)
+    profiling.add_arguments(parser)
     
     opts = parser.parse_args()
     
-    ee = pd.read_csv(opts.edgelist)
+    with profiling.Profiler.from_args(opts):
+        map_platforms(opts)
+
+
+def map_platforms(opts):
+    with profiling.span("read_edgelist") as span:
+        ee = span.output(pd.read_csv(opts.edgelist))
 #     ee.loc[ee.to == '5 service via manhattan','to'] = '5-manhattan'
     ee = ee[ee.to_type == 'Train']
     ee['line'] = [x.split('-')[0] for x in ee.to]
     ee['direction'] = [x.split('-')[1] for x in ee.to]
     
-    routes = pd.read_csv(opts.gtfs+'routes.txt')
-    trips = pd.read_csv(opts.gtfs+'trips.txt')
-    stops = pd.read_csv(opts.gtfs+'stops.txt')
-    stop_times = pd.read_csv(opts.gtfs+'stop_times.txt')
-    
-    platforms = stops[stops.location_type == 0]
-    stop_times['line'] = [x[x.find('..')-1:x.find('..')] for x in stop_times.trip_id]
-    weekday = stop_times[stop_times.trip_id.str.contains('Weekday')]
-    routes_subset = routes[(routes.route_id.str.len() == 1) & (routes.route_id != 'H')]
-    weekday = weekday.merge(trips[trips.route_id.isin(routes_subset.route_id)][['trip_id','route_id']],on="trip_id")
+    with profiling.span("read_gtfs") as span:
+        routes = pd.read_csv(opts.gtfs+'routes.txt')
+        trips = pd.read_csv(opts.gtfs+'trips.txt')
+        stops = pd.read_csv(opts.gtfs+'stops.txt')
+        stop_times = span.output(pd.read_csv(opts.gtfs+'stop_times.txt'))
     
-    unique_stop_ids = pd.DataFrame(weekday.stop_id.unique(),columns=['stop_id'])
-    unique_stop_ids['routes_wkd'] = [''.join(weekday[weekday.stop_id == x]['route_id'].unique()) for x in unique_stop_ids.stop_id]
-    platforms = platforms.merge(unique_stop_ids,on='stop_id')
+    with profiling.span("weekday_routes", rows_in=len(stop_times)) as span:
+        platforms = stops[stops.location_type == 0]
+        stop_times['line'] = [x[x.find('..')-1:x.find('..')] for x in stop_times.trip_id]
+        weekday = stop_times[stop_times.trip_id.str.contains('Weekday')]
+        routes_subset = routes[(routes.route_id.str.len() == 1) & (routes.route_id != 'H')]
+        weekday = weekday.merge(trips[trips.route_id.isin(routes_subset.route_id)][['trip_id','route_id']],on="trip_id")
+        
+        unique_stop_ids = pd.DataFrame(weekday.stop_id.unique(),columns=['stop_id'])
+        unique_stop_ids['routes_wkd'] = [''.join(weekday[weekday.stop_id == x]['route_id'].unique()) for x in unique_stop_ids.stop_id]
+        platforms = span.output(platforms.merge(unique_stop_ids,on='stop_id'))
     
     ee['possible_stops'] = ''
     
-    ee = match_jaccard(ee,platforms)
-    ee = match_jaro_winkler(ee,platforms)
+    with profiling.span("match_jaccard", rows_in=len(ee)):
+        ee = match_jaccard(ee,platforms)
+    with profiling.span("match_jaro_winkler", rows_in=len(ee)):
+        ee = match_jaro_winkler(ee,platforms)
 
     ## Manual overrides
     ee.loc[ee[(ee.possible_stops == '') & (ee.station_name == 'Broadway-Lafayette/Bleecker St')].index,'possible_stops'] = '637N, 637S'
@@ -109,7 +122,9 @@ def main():
     plt_stop_id['platform_id'] = plt_stop_id['from']
     plt_stop_id = plt_stop_id[['station_name','platform_id','line','direction','stop_id']]
 
-    plt_stop_id.to_csv(opts.output,index=False)
-    
+    with profiling.span("write", rows_in=len(plt_stop_id)):
+        plt_stop_id.to_csv(opts.output,index=False)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
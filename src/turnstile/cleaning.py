@@ -0,0 +1,197 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, NamedTuple, Tuple
+
+# This module cleans the ENTRIES and EXITS counters of MTA turnstile data. The
+# counters are cumulative, the difference between two snapshots of a
+# turnstile is the traffic in between. Differences that can't be traffic are
+# fixed or dropped by the rules below, in one pass over every turnstile laid
+# out in an array sorted by turnstile and time, and the cleaned differences
+# are summed back into cumulative counts.
+
+# differences outside of [0, MAX_DIFF] are treated as bad counter readings
+MAX_DIFF = 10000
+
+# range of the counters, they wrap around to 0 at its end
+COUNTER_RANGE = 2 ** 32
+
+# the rules in the order they are applied, the names of the hit counts
+RULES = ['reversed', 'wraparound', 'reset', 'negative', 'ceiling']
+
+
+class CleaningRules(NamedTuple):
+    """
+    Rules to clean the differences of the counters
+
+    negative: bool - drop the negative differences
+    max_diff: float - drop the differences above, None for no ceiling
+    adaptive: float - If set, the ceiling of each turnstile is this multiple
+        of the median of its positive differences, instead of max_diff
+    adaptive_floor: float - the lowest adaptive ceiling, so that quiet
+        turnstiles don't lose their busy hours
+    resets: bool - a negative difference to a counter within the ceiling is a
+        counter reset to 0, the difference is the new counter
+    wraparound: bool - a negative difference that is within the ceiling once
+        COUNTER_RANGE is added is a counter wrapping around
+    reversed: bool - negate the differences of the turnstiles with more
+        negative than positive differences, their counters count down
+    """
+    negative: bool = True
+    max_diff: float = MAX_DIFF
+    adaptive: float = None
+    adaptive_floor: float = MAX_DIFF / 10
+    resets: bool = False
+    wraparound: bool = False
+    reversed: bool = False
+
+
+# drops negative differences and differences above MAX_DIFF
+DEFAULT_RULES = CleaningRules()
+
+
+def _segment_starts(codes: np.ndarray) -> np.ndarray:
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = codes[1:] != codes[:-1]
+    return starts
+
+
+def _segmented_diff(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    diffs = np.empty(len(values))
+    diffs[1:] = values[1:] - values[:-1]
+    diffs[starts] = np.nan
+    return diffs
+
+
+def _segmented_cumsum(diffs: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # cumulative sum that skips (and keeps) missing values, like pandas
+    filled = np.where(np.isnan(diffs), 0.0, diffs)
+    total = np.cumsum(filled)
+    offset = (total - filled)[starts]
+    cumulative = total - np.repeat(offset, np.diff(
+        np.append(np.flatnonzero(starts), len(diffs))))
+    cumulative[np.isnan(diffs)] = np.nan
+    return cumulative
+
+
+def _segmented_median(values: np.ndarray,
+                      segment_ids: np.ndarray,
+                      segments: int) -> np.ndarray:
+    # lower median of the values of each segment, nan for an empty one
+    order = np.lexsort((values, segment_ids))
+    counts = np.bincount(segment_ids, minlength=segments)
+    first = np.cumsum(counts) - counts
+    median = np.full(segments, np.nan)
+    present = counts > 0
+    median[present] = values[order][first[present] +
+                                    (counts[present] - 1) // 2]
+    return median
+
+
+def _clean(counters: np.ndarray,
+           starts: np.ndarray,
+           rules: CleaningRules) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    # the cleaned differences, and the differences each rule applied to
+    segment_ids = np.cumsum(starts) - 1
+    segments = segment_ids[-1] + 1 if len(segment_ids) else 0
+    diffs = _segmented_diff(counters, starts)
+    hits = {}
+    with np.errstate(invalid='ignore'):
+        backwards = np.zeros(len(diffs), dtype=bool)
+        if rules.reversed:
+            negatives = np.bincount(segment_ids, diffs < 0, segments)
+            positives = np.bincount(segment_ids, diffs > 0, segments)
+            backwards = (negatives > positives)[segment_ids]
+            diffs = np.where(backwards, -diffs, diffs)
+        hits['reversed'] = backwards & ~np.isnan(diffs)
+
+        if rules.adaptive is not None:
+            positive = diffs > 0
+            median = _segmented_median(diffs[positive],
+                                       segment_ids[positive], segments)
+            # fmax takes the floor for turnstiles without positive diffs
+            ceiling = np.fmax(rules.adaptive * median,
+                              rules.adaptive_floor)[segment_ids]
+        elif rules.max_diff is not None:
+            ceiling = rules.max_diff
+        else:
+            ceiling = np.inf
+
+        # wraparound and resets only apply to counters counting up
+        negative = diffs < 0
+        wrapped = np.zeros(len(diffs), dtype=bool)
+        if rules.wraparound:
+            wrapped = negative & ~backwards & \
+                (diffs + COUNTER_RANGE <= ceiling)
+            diffs = np.where(wrapped, diffs + COUNTER_RANGE, diffs)
+            negative &= ~wrapped
+        hits['wraparound'] = wrapped
+
+        reset = np.zeros(len(diffs), dtype=bool)
+        if rules.resets:
+            reset = negative & ~backwards & (counters >= 0) & \
+                (counters <= ceiling)
+            diffs = np.where(reset, counters, diffs)
+            negative &= ~reset
+        hits['reset'] = reset
+
+        if not rules.negative:
+            negative[:] = False
+        diffs = np.where(negative, np.nan, diffs)
+        hits['negative'] = negative
+
+        above = diffs > ceiling
+        hits['ceiling'] = above
+    return np.where(above, np.nan, diffs), hits
+
+
+def clean_counters(processed: pd.DataFrame,
+                   group_by: List[str],
+                   rules: CleaningRules = DEFAULT_RULES) -> Tuple[pd.DataFrame,
+                                                                  pd.DataFrame]:
+    """
+    Clean the counters of every turnstile at once
+
+    Parameters
+    processed: pandas.DataFrame - output of turnstile._process_raw_data
+    group_by: List[str]
+    rules: CleaningRules, optional
+
+    Return
+    (pandas.DataFrame, pandas.DataFrame) - the processed data sorted by
+    turnstile and time, with the cleaned differences in entry_diffs and
+    exit_diffs and their cumulative sums in cleaned_entries and
+    cleaned_exits. The number of differences of each turnstile that each rule
+    applied to, e.g. entries_negative and exits_ceiling, with the group by
+    keys as index.
+
+    """
+    logging.getLogger().info("Cleaning turnstile counters")
+    processed = processed[processed[group_by].notnull().all(axis=1)]
+    codes = processed.groupby(group_by, sort=True,
+                              observed=True).ngroup().to_numpy()
+    order = np.lexsort((processed.index.asi8, codes))
+    processed = processed.iloc[order]
+    starts = _segment_starts(codes[order])
+    segment_ids = np.cumsum(starts) - 1
+    segments = segment_ids[-1] + 1 if len(segment_ids) else 0
+
+    columns = {}
+    counts = {}
+    for column, diffs_name, cleaned_name, counter in [
+            ('ENTRIES', 'entry_diffs', 'cleaned_entries', 'entries'),
+            ('EXITS', 'exit_diffs', 'cleaned_exits', 'exits')]:
+        diffs, hits = _clean(processed[column].to_numpy(dtype=np.float64),
+                             starts, rules)
+        columns[diffs_name] = diffs
+        columns[cleaned_name] = _segmented_cumsum(diffs, starts)
+        for rule in RULES:
+            counts[counter + '_' + rule] = np.bincount(
+                segment_ids, hits[rule], segments).astype(np.int64)
+
+    report = pd.DataFrame(
+        counts,
+        index=pd.MultiIndex.from_frame(processed[group_by].iloc[
+            np.flatnonzero(starts)]))
+    return processed.assign(**columns), report
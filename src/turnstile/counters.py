@@ -0,0 +1,358 @@
+import bz2
+import logging
+import lzma
+import numpy as np
+import pandas as pd
+import zlib
+
+from datetime import datetime, timedelta
+from pandas.api.types import union_categoricals
+from typing import Dict, List, NamedTuple, Union
+
+from . import turnstile
+from .cleaning import CleaningRules, DEFAULT_RULES
+
+# This module keeps the raw snapshots of the turnstiles in memory, delta
+# encoded, so that years of them can be interpolated again without
+# downloading or parsing the weekly files:
+#
+#   store = build_counter_store(datetime(2010, 5, 1), archive='data/raw/turnstile')
+#   store.interpolate(datetime(2014, 1, 1), datetime(2014, 2, 1))
+#
+# The snapshots are processed like the compact raw data (sorted by turnstile
+# and time, the first of duplicate snapshots kept), and each appended frame
+# adds a segment per turnstile. A segment keeps its keys and its first
+# time, ENTRIES and EXITS, its rows only keep the differences to the
+# previous snapshot: a few hours and a few hundred entries.
+#
+# The rows are split into blocks, and each column of a block is stored as
+# the zigzag encoded (small negative numbers become small positive numbers)
+# differences in the narrowest unsigned integer type that fits all but a
+# few of them. The others, counter resets or gaps in the data, are patched
+# in from a separate list. A block can also be compressed. Decoding a
+# block is a handful of numpy passes, and only the blocks of the segments
+# overlapping the selected dates are decoded.
+
+BLOCK_ROWS = 2**16
+WIDTHS = [np.uint8, np.uint16, np.uint32, np.uint64]
+# the size of a value patched in: its position and its value
+EXCEPTION_BYTES = 12
+CODECS = {
+    'zlib': zlib,
+    'bz2': bz2,
+    'lzma': lzma,
+}
+NANOS_PER_SECOND = 10**9
+# the columns of a segment besides its keys
+SEGMENT_COLUMNS = ['first_time', 'last_time', 'first_entries', 'first_exits',
+                   'row_start', 'row_end']
+STREAMS = ['datetime', 'ENTRIES', 'EXITS']
+
+
+class _Stream(NamedTuple):
+    dtype: str
+    data: bytes
+    positions: np.ndarray
+    values: np.ndarray
+
+
+def _encode(deltas: np.ndarray, compression: str = None) -> _Stream:
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64)
+    # the narrowest type, counting the values that don't fit it
+    best = None
+    for dtype in WIDTHS:
+        over = zigzag > np.iinfo(dtype).max
+        size = len(zigzag) * np.dtype(dtype).itemsize + int(over.sum()) * EXCEPTION_BYTES
+        if best is None or size < best[0]:
+            best = (size, dtype, over)
+    _, dtype, over = best
+    data = np.where(over, 0, zigzag).astype(dtype).tobytes()
+    if compression is not None:
+        data = CODECS[compression].compress(data)
+    return _Stream(np.dtype(dtype).str, data,
+                   np.flatnonzero(over).astype(np.uint32), zigzag[over])
+
+
+def _decode(stream: _Stream, compression: str = None) -> np.ndarray:
+    data = stream.data
+    if compression is not None:
+        data = CODECS[compression].decompress(data)
+    zigzag = np.frombuffer(data, dtype=stream.dtype).astype(np.uint64)
+    zigzag[stream.positions] = stream.values
+    return (zigzag >> np.uint64(1)).view(np.int64) ^ -(zigzag & np.uint64(1)).view(np.int64)
+
+
+def _segmented_deltas(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # differences to the previous row, 0 at the start of each segment
+    deltas = np.zeros(len(values), dtype=np.int64)
+    deltas[1:] = values[1:] - values[:-1]
+    deltas[starts] = 0
+    return deltas
+
+
+def _concat_segments(frames: List[pd.DataFrame],
+                     group_by: List[str]) -> pd.DataFrame:
+    # like turnstile._concat_compact, the keys share the union of the
+    # categories so that their codes sort in the order of the keys
+    columns = {}
+    for c in group_by:
+        columns[c] = union_categoricals([f[c] for f in frames],
+                                        sort_categories=True)
+    for c in SEGMENT_COLUMNS:
+        columns[c] = np.concatenate([f[c].to_numpy() for f in frames])
+    return pd.DataFrame(columns)
+
+
+class CounterStore:
+    """
+    Delta encoded raw snapshots of the turnstiles, see the module comment
+
+    Parameters
+    group_by: List[str], optional - the keys of a turnstile, UNIT and SCP by
+        default. Include STATION and LINENAME to aggregate the interpolated
+        data by station.
+    compression: str, optional - compress each block with zlib, bz2 or lzma
+    block_rows: int, optional - rows per block
+    """
+
+    def __init__(self,
+                 group_by: List[str] = ['UNIT', 'SCP'],
+                 compression: str = None,
+                 block_rows: int = BLOCK_ROWS):
+        if not set(group_by).issubset(turnstile.COMPACT_KEYS):
+            raise Exception("Unsupported group by keys: " + str(group_by))
+        if compression is not None and compression not in CODECS:
+            raise Exception("Unsupported compression: " + str(compression))
+        self.group_by = list(group_by)
+        self.compression = compression
+        self.block_rows = block_rows
+        self.rows = 0
+        # the first row of each block and its streams
+        self._block_starts = []
+        self._blocks = []
+        # the segments of each appended frame, concatenated when needed
+        self._segments = []
+
+    def __len__(self) -> int:
+        return self.rows
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the blocks and the segments
+        """
+        blocks = sum(len(s.data) + s.positions.nbytes + s.values.nbytes
+                     for block in self._blocks for s in block.values())
+        segments = sum(int(f.memory_usage(deep=True).sum()) for f in self._segments)
+        return blocks + segments
+
+    def append(self, raw_data: pd.DataFrame):
+        """
+        Add raw turnstile data, e.g. a weekly file
+
+        Parameters
+        raw_data: pandas.DataFrame - the output of download_turnstile_data,
+            compact or not
+        """
+        if not isinstance(raw_data['UNIT'].dtype, pd.CategoricalDtype):
+            raw_data = turnstile._compact_raw_data(raw_data)
+        processed = turnstile._process_compact_data(raw_data, self.group_by)
+        times = processed.index.asi8
+        processed = processed[times != np.iinfo(np.int64).min]
+        if not len(processed):
+            return
+        seconds = processed.index.asi8 // NANOS_PER_SECOND
+        entries = processed['ENTRIES'].to_numpy(dtype=np.int64)
+        exits = processed['EXITS'].to_numpy(dtype=np.int64)
+
+        starts = np.zeros(len(processed), dtype=bool)
+        starts[0] = True
+        for key in self.group_by:
+            codes = processed[key].cat.codes.to_numpy()
+            starts[1:] |= codes[1:] != codes[:-1]
+        first = np.flatnonzero(starts)
+        last = np.append(first[1:], len(processed)) - 1
+        segments = processed[self.group_by].iloc[first].reset_index(drop=True)
+        segments = segments.assign(first_time=seconds[first],
+                                   last_time=seconds[last],
+                                   first_entries=entries[first],
+                                   first_exits=exits[first],
+                                   row_start=self.rows + first,
+                                   row_end=self.rows + last + 1)
+        self._segments.append(segments)
+
+        deltas = {'datetime': _segmented_deltas(seconds, starts),
+                  'ENTRIES': _segmented_deltas(entries, starts),
+                  'EXITS': _segmented_deltas(exits, starts)}
+        for start in range(0, len(processed), self.block_rows):
+            self._block_starts.append(self.rows + start)
+            self._blocks.append({
+                c: _encode(d[start:start + self.block_rows], self.compression)
+                for c, d in deltas.items()})
+        self.rows += len(processed)
+
+    def segments(self) -> pd.DataFrame:
+        """
+        The keys, first and last time (in seconds), first counters and rows
+        of each segment
+        """
+        if len(self._segments) > 1:
+            self._segments = [_concat_segments(self._segments, self.group_by)]
+        if not self._segments:
+            return pd.DataFrame({**{c: pd.Categorical([]) for c in self.group_by},
+                                 **{c: np.zeros(0, dtype=np.int64) for c in SEGMENT_COLUMNS}})
+        return self._segments[0]
+
+    def _decode_rows(self, rows: np.ndarray) -> Dict[str, np.ndarray]:
+        # the deltas of the rows, decoding the blocks they are in once
+        block_starts = np.array(self._block_starts, dtype=np.int64)
+        block_of_row = np.searchsorted(block_starts, rows, side='right') - 1
+        needed = np.unique(block_of_row)
+        decoded = {c: [] for c in STREAMS}
+        offsets = np.zeros(len(block_starts), dtype=np.int64)
+        offset = 0
+        for b in needed:
+            offsets[b] = offset - block_starts[b]
+            for c in STREAMS:
+                decoded[c].append(_decode(self._blocks[b][c], self.compression))
+            offset += len(decoded[STREAMS[0]][-1])
+        positions = rows + offsets[block_of_row]
+        return {c: np.concatenate(d)[positions] if d else np.zeros(0, dtype=np.int64)
+                for c, d in decoded.items()}
+
+    def decode(self,
+               start_date: datetime = None,
+               end_date: datetime = None) -> pd.DataFrame:
+        """
+        The snapshots between start_date and end_date, like
+        turnstile._process_compact_data
+
+        Parameters
+        start_date: datetime, optional - the first time included
+        end_date: datetime, optional - the first time excluded
+
+        Return
+        pandas.DataFrame - the group by keys as categoricals, ENTRIES and
+        EXITS, sorted by turnstile and time with a datetime index
+        """
+        segments = self.segments()
+        start = None if start_date is None else pd.Timestamp(start_date).value // NANOS_PER_SECOND
+        end = None if end_date is None else pd.Timestamp(end_date).value // NANOS_PER_SECOND
+        selected = np.ones(len(segments), dtype=bool)
+        if start is not None:
+            selected &= segments['last_time'].to_numpy() >= start
+        if end is not None:
+            selected &= segments['first_time'].to_numpy() < end
+        segments = segments[selected]
+
+        # the segments of a turnstile in the order they were appended, and
+        # their rows
+        codes = [segments[key].cat.codes.to_numpy() for key in self.group_by]
+        order = np.lexsort([segments['first_time'].to_numpy()] + codes[::-1])
+        segments = segments.iloc[order]
+        lengths = (segments['row_end'] - segments['row_start']).to_numpy()
+        segment_of_row = np.repeat(np.arange(len(segments)), lengths)
+        first_row = np.cumsum(lengths) - lengths
+        rows = segments['row_start'].to_numpy()[segment_of_row] + \
+            np.arange(len(segment_of_row)) - first_row[segment_of_row]
+        deltas = self._decode_rows(rows)
+
+        # the deltas are 0 at the start of each segment
+        values = {}
+        for c, first in [('datetime', 'first_time'), ('ENTRIES', 'first_entries'),
+                         ('EXITS', 'first_exits')]:
+            cumulative = np.cumsum(deltas[c])
+            values[c] = segments[first].to_numpy()[segment_of_row] + \
+                cumulative - cumulative[first_row][segment_of_row]
+        kept = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            kept &= values['datetime'] >= start
+        if end is not None:
+            kept &= values['datetime'] < end
+        segment_of_row = segment_of_row[kept]
+        values = {c: v[kept] for c, v in values.items()}
+
+        # segments of a turnstile appended out of order, or overlapping
+        row_codes = [c[order][segment_of_row] for c in codes]
+        same = np.ones(max(len(segment_of_row) - 1, 0), dtype=bool)
+        for c in row_codes:
+            same &= c[1:] == c[:-1]
+        times = values['datetime']
+        if (same & (times[1:] < times[:-1])).any():
+            resorted = np.lexsort([times] + row_codes[::-1])
+            segment_of_row = segment_of_row[resorted]
+            values = {c: v[resorted] for c, v in values.items()}
+            row_codes = [c[resorted] for c in row_codes]
+            times = values['datetime']
+            same = np.ones(max(len(segment_of_row) - 1, 0), dtype=bool)
+            for c in row_codes:
+                same &= c[1:] == c[:-1]
+        duplicated = np.zeros(len(times), dtype=bool)
+        duplicated[1:] = same & (times[1:] == times[:-1])
+
+        segment_of_row = segment_of_row[~duplicated]
+        processed = pd.DataFrame({
+            key: segments[key].array.take(segment_of_row) for key in self.group_by})
+        processed['ENTRIES'] = values['ENTRIES'][~duplicated]
+        processed['EXITS'] = values['EXITS'][~duplicated]
+        processed.index = pd.DatetimeIndex(
+            (times[~duplicated] * NANOS_PER_SECOND).view('datetime64[ns]'),
+            name='datetime')
+        return processed
+
+    def interpolate(self,
+                    start_date: datetime,
+                    end_date: datetime = None,
+                    frequency: Union[str, List[str]] = '1H',
+                    engine: str = 'pandas',
+                    workers: int = 1,
+                    cleaning_rules: CleaningRules = DEFAULT_RULES) -> Union[
+                        pd.DataFrame, Dict[str, pd.DataFrame]]:
+        """
+        create_interpolated_turnstile_data from the stored snapshots, with
+        compact=True and the group by keys of the store. Takes the same
+        parameters.
+        """
+        if engine not in turnstile.ENGINES:
+            raise Exception("Unsupported engine: " + str(engine))
+        # the days around the range, like turnstile._select_dates
+        first_day = pd.Timestamp(start_date).normalize() - timedelta(1)
+        last_day = None if end_date is None else pd.Timestamp(end_date).normalize() + timedelta(2)
+        processed = self.decode(first_day, last_day)
+        frequencies = [frequency] if isinstance(frequency, str) else frequency
+        result = turnstile._interpolate_processed_data(
+            processed, start_date, end_date, self.group_by, frequencies,
+            engine, workers, cleaning_rules)
+        return result[frequency] if isinstance(frequency, str) else result
+
+
+def build_counter_store(start_date: datetime,
+                        end_date: datetime = None,
+                        group_by: List[str] = ['UNIT', 'SCP'],
+                        compression: str = None,
+                        base_url: str = turnstile.MTA_TURNSTILE_URL,
+                        cache_directory: str = None,
+                        archive: str = None) -> CounterStore:
+    """
+    Read the weekly files between start_date and end_date into a
+    CounterStore, one at a time
+
+    Parameters
+    start_date: datetime
+    end_date: datetime, optional
+    group_by: List[str], optional - see CounterStore
+    compression: str, optional - see CounterStore
+    base_url: str, optional - see download_turnstile_data
+    cache_directory: str, optional - see download_turnstile_data
+    archive: str, optional - see download_turnstile_data
+
+    Return
+    CounterStore
+    """
+    store = CounterStore(group_by, compression)
+    for link, data in turnstile._iterate_turnstile_files(
+            start_date, end_date, base_url, cache_directory, archive=archive):
+        store.append(data)
+        logging.getLogger().info("Stored %s, %d snapshots in %d bytes",
+                                 link, len(store), store.nbytes)
+    return store
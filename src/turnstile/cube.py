@@ -0,0 +1,226 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+# This module stores per-station turnstile data as a dense cube of
+# stations x intervals, one float32 numpy file per column (estimated entries
+# and exits), next to the index of the stations and the start and frequency
+# of the intervals. The intervals cover whole days, so the daily totals are a
+# reshape of the cube. The files are memory mapped when opened: loading a
+# cube doesn't read it, queries only touch the rows and intervals they use.
+
+COLUMNS = ['estimated_entries', 'estimated_exits']
+STATIONS_FILE = 'stations.csv'
+META_FILE = 'cube.json'
+NANOS_PER_DAY = 24 * 60 * 60 * 10**9
+
+# the buckets of the profiles: the bucket of each interval and their number
+PROFILES = {
+    'hour': (lambda times: times.hour, 24),
+    'dayofweek': (lambda times: times.dayofweek, 7),
+    'hour_of_week': (lambda times: times.dayofweek * 24 + times.hour, 7 * 24),
+}
+
+
+def _intervals_per_day(frequency: str) -> int:
+    nanos = pd.tseries.frequencies.to_offset(frequency).nanos
+    if NANOS_PER_DAY % nanos:
+        raise Exception("The frequency of a cube needs to divide a day: " +
+                        str(frequency))
+    return NANOS_PER_DAY // nanos
+
+
+def build_cube(station_data: pd.DataFrame,
+               path: str,
+               frequency: str = '1H') -> 'RidershipCube':
+    """
+    Build a cube from per-station turnstile data and save it under path
+
+    Parameters
+    station_data: pandas.DataFrame - datetime, STATION, LINENAME,
+        estimated_entries and estimated_exits, e.g. the output of
+        turnstile.sum_turnstile_data_by_station
+    path: str - directory of the cube
+    frequency: str, optional - the frequency of the data, it needs to
+        divide a day
+
+    Return
+    RidershipCube
+
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    per_day = _intervals_per_day(frequency)
+    step = NANOS_PER_DAY // per_day
+
+    station_data = station_data[
+        station_data[['STATION', 'LINENAME']].notnull().all(axis=1)]
+    codes, stations = pd.MultiIndex.from_frame(
+        station_data[['STATION', 'LINENAME']].astype(str)).factorize(sort=True)
+    times = station_data['datetime'].to_numpy().astype('datetime64[ns]').view(np.int64)
+    start = times.min() - times.min() % NANOS_PER_DAY
+    days = (times.max() - start) // NANOS_PER_DAY + 1
+    intervals = (times - start) // step
+
+    logging.getLogger().info("Building a cube of %d stations and %d days in %s",
+                             len(stations), days, path)
+    for column in COLUMNS:
+        cube = np.lib.format.open_memmap(
+            path / (column + '.npy'), mode='w+', dtype=np.float32,
+            shape=(len(stations), days * per_day))
+        cube[:] = np.nan
+        cube[codes, intervals] = station_data[column].to_numpy(dtype=np.float32)
+        cube.flush()
+        del cube
+
+    stations.to_frame(index=False).to_csv(path / STATIONS_FILE, index=False)
+    with open(path / META_FILE, 'w') as f:
+        json.dump({'start': str(pd.Timestamp(start)),
+                   'frequency': frequency,
+                   'intervals_per_day': int(per_day),
+                   'days': int(days)}, f)
+    return RidershipCube(path)
+
+
+class RidershipCube:
+    """
+    Memory mapped cube of per-station turnstile data, see build_cube
+
+    The queries take the column (estimated_entries or estimated_exits), the
+    stations as (STATION, LINENAME) pairs, all of them by default, and a time
+    range, start inclusive and end exclusive. Missing intervals are NaN and
+    are left out of the sums and means.
+    """
+
+    def __init__(self, path: str):
+        path = Path(path)
+        with open(path / META_FILE) as f:
+            meta = json.load(f)
+        self.frequency = meta['frequency']
+        self.intervals_per_day = meta['intervals_per_day']
+        self.days = meta['days']
+        self.times = pd.date_range(meta['start'],
+                                   periods=self.days * self.intervals_per_day,
+                                   freq=self.frequency)
+        self.stations = pd.MultiIndex.from_frame(
+            pd.read_csv(path / STATIONS_FILE, dtype=str, keep_default_na=False))
+        self._data = {column: np.load(path / (column + '.npy'), mmap_mode='r')
+                      for column in COLUMNS}
+
+    def _rows(self, stations: List[Tuple[str, str]] = None):
+        if stations is None:
+            return slice(None)
+        rows = self.stations.get_indexer(pd.MultiIndex.from_tuples(stations))
+        if (rows < 0).any():
+            raise Exception("Unknown stations: " + str(
+                [s for s, r in zip(stations, rows) if r < 0]))
+        return rows
+
+    def _columns(self, start: datetime = None, end: datetime = None,
+                 whole_days: bool = False) -> slice:
+        first = 0 if start is None else self.times.searchsorted(start)
+        last = len(self.times) if end is None else self.times.searchsorted(end)
+        if whole_days:
+            first = -(-first // self.intervals_per_day) * self.intervals_per_day
+            last = max(first, last // self.intervals_per_day *
+                       self.intervals_per_day)
+        return slice(first, last)
+
+    def values(self,
+               column: str = 'estimated_entries',
+               stations: List[Tuple[str, str]] = None,
+               start: datetime = None,
+               end: datetime = None) -> np.ndarray:
+        """
+        The stations x intervals array of a column, a view of the memory
+        mapped file when all stations are selected
+        """
+        return self._data[column][self._rows(stations), self._columns(start, end)]
+
+    def slice(self,
+              column: str = 'estimated_entries',
+              stations: List[Tuple[str, str]] = None,
+              start: datetime = None,
+              end: datetime = None) -> pd.DataFrame:
+        """
+        The intervals of a time range, one column per station
+        """
+        columns = self._columns(start, end)
+        return pd.DataFrame(
+            self._data[column][self._rows(stations), columns].T,
+            index=self.times[columns],
+            columns=self.stations[self._rows(stations)])
+
+    def daily_totals(self,
+                     column: str = 'estimated_entries',
+                     stations: List[Tuple[str, str]] = None,
+                     start: datetime = None,
+                     end: datetime = None) -> pd.DataFrame:
+        """
+        The total of each day, one column per station. Only the whole days
+        of the time range are included, a day without data is NaN.
+        """
+        columns = self._columns(start, end, whole_days=True)
+        values = self._data[column][self._rows(stations), columns]
+        values = values.reshape(values.shape[0], -1, self.intervals_per_day)
+        present = ~np.isnan(values)
+        totals = np.where(present, values, 0).sum(axis=2, dtype=np.float64)
+        totals[~present.any(axis=2)] = np.nan
+        return pd.DataFrame(
+            totals.T,
+            index=self.times[columns][::self.intervals_per_day],
+            columns=self.stations[self._rows(stations)])
+
+    def station_means(self,
+                      column: str = 'estimated_entries',
+                      stations: List[Tuple[str, str]] = None,
+                      start: datetime = None,
+                      end: datetime = None,
+                      period: str = 'day') -> pd.Series:
+        """
+        The mean per station of the daily totals (period='day') or of the
+        intervals (period='interval')
+        """
+        if period == 'day':
+            return self.daily_totals(column, stations, start, end).mean()
+        if period != 'interval':
+            raise Exception("Unsupported period: " + str(period))
+        values = self.values(column, stations, start, end)
+        present = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            means = np.where(present, values, 0).sum(
+                axis=1, dtype=np.float64) / present.sum(axis=1)
+        return pd.Series(means, index=self.stations[self._rows(stations)])
+
+    def profile(self,
+                column: str = 'estimated_entries',
+                stations: List[Tuple[str, str]] = None,
+                start: datetime = None,
+                end: datetime = None,
+                by: str = 'hour_of_week') -> pd.DataFrame:
+        """
+        The mean of the intervals of each hour, day of week or hour of the
+        week (0 is Monday 0:00), one column per station
+        """
+        if by not in PROFILES:
+            raise Exception("Unsupported profile: " + str(by))
+        bucket_of, buckets = PROFILES[by]
+        columns = self._columns(start, end)
+        values = self._data[column][self._rows(stations), columns]
+        # one-hot matrix of the bucket of each interval, the sums and counts
+        # of all buckets are two matrix products
+        membership = np.zeros((values.shape[1], buckets), dtype=np.float32)
+        membership[np.arange(values.shape[1]),
+                   np.asarray(bucket_of(self.times[columns]))] = 1
+        present = ~np.isnan(values)
+        sums = np.where(present, values, 0).astype(np.float64) @ membership
+        counts = present.astype(np.float32) @ membership
+        with np.errstate(invalid='ignore'):
+            means = sums / counts
+        return pd.DataFrame(means.T, index=pd.RangeIndex(buckets, name=by),
+                            columns=self.stations[self._rows(stations)])
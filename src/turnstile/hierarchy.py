@@ -0,0 +1,275 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Tuple
+
+# This module sums interpolated turnstile data at several levels of the
+# station hierarchy in one pass, as a grouping sets result:
+#
+#   SCP      a turnstile, UNIT and SCP
+#   UNIT     a remote unit
+#   STATION  STATION and LINENAME as in the turnstile files
+#   COMPLEX  the stations of the crosswalk connected by shared remote units,
+#            GTFS stops or GTFS transfers
+#   BOROUGH  the borough of the complex
+#
+# The group by keys of the data are factorized once into leaves, and each
+# leaf gets the integer code of its node at every level. When the nodes of a
+# finer level each belong to one node of a level, the level is summed from
+# the sums of the finer one through a parent pointer array, so the rows of
+# the data are only read for the finest level.
+
+LEVELS = ['SCP', 'UNIT', 'STATION', 'COMPLEX', 'BOROUGH']
+# the key columns of the nodes of each level in the result
+LEVEL_KEYS = {
+    'SCP': ['UNIT', 'SCP'],
+    'UNIT': ['UNIT'],
+    'STATION': ['STATION', 'LINENAME'],
+    'COMPLEX': ['COMPLEX'],
+    'BOROUGH': ['BOROUGH'],
+}
+COLUMNS = ['estimated_entries', 'estimated_exits']
+
+
+def _components(nodes: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # the smallest node of the connected component of each node, from the
+    # edges a[i] - b[i]
+    labels = np.arange(nodes)
+    while True:
+        updated = labels.copy()
+        np.minimum.at(updated, a, labels[b])
+        np.minimum.at(updated, b, labels[a])
+        updated = updated[updated]
+        if (updated == labels).all():
+            return labels
+        labels = updated
+
+
+def _same_value_edges(rows: np.ndarray, values: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    # edges from each row to the first row with the same value
+    values = pd.Series(values.to_numpy())
+    present = values.notnull().to_numpy()
+    rows, values = rows[present], values[present]
+    first = pd.Series(rows).groupby(values.to_numpy()).transform('first').to_numpy()
+    return rows, first
+
+
+class Crosswalk:
+    """
+    The complex and borough of each remote unit, compiled to integer codes
+    from the crosswalk (data/crosswalk/Master_crosswalk.csv)
+
+    units: pandas.Index - the remote units of the crosswalk
+    unit_complexes: numpy.ndarray - the complex code of each unit
+    complexes: pandas.Index - the name of each complex, its station names and
+        lines
+    complex_boroughs: numpy.ndarray - the borough code of each complex, -1
+        if it is unknown
+    boroughs: pandas.Index
+    """
+
+    def __init__(self, units: pd.Index, unit_complexes: np.ndarray,
+                 complexes: pd.Index, complex_boroughs: np.ndarray,
+                 boroughs: pd.Index):
+        self.units = units
+        self.unit_complexes = unit_complexes
+        self.complexes = complexes
+        self.complex_boroughs = complex_boroughs
+        self.boroughs = boroughs
+
+    @classmethod
+    def from_files(cls, crosswalk_file: str,
+                   station_turnstile_file: str,
+                   transfers_file: str = None) -> 'Crosswalk':
+        """
+        Compile the crosswalk
+
+        The stations of the crosswalk sharing a remote unit or a GTFS stop, or
+        connected by a GTFS transfer, are one complex. The borough of a
+        complex is the one of its units in the station to turnstile file
+        (data/crosswalk/ee_turnstile.csv). It only lists the stations with
+        elevators or escalators, and none on Staten Island, the borough of
+        the other complexes is missing.
+
+        Parameters
+        crosswalk_file: str - data/crosswalk/Master_crosswalk.csv
+        station_turnstile_file: str - data/crosswalk/ee_turnstile.csv
+        transfers_file: str, optional - the transfers.txt of the GTFS feed,
+            data/raw/google_transit/transfers.txt
+
+        Return
+        Crosswalk
+
+        """
+        crosswalk = pd.read_csv(crosswalk_file, index_col=0,
+                                dtype={'gtfs_stop_id': str}).reset_index(drop=True)
+        rows = np.arange(len(crosswalk))
+        units = crosswalk['turnstile_units'].str.split(',')
+        unit_rows = np.repeat(rows, units.str.len().fillna(0).astype(int))
+        unit_names = pd.Series(np.concatenate(units.dropna().to_numpy())).str.strip()
+
+        edges = [_same_value_edges(unit_rows, unit_names),
+                 _same_value_edges(rows, crosswalk['gtfs_stop_id'])]
+        if transfers_file is not None:
+            transfers = pd.read_csv(transfers_file, dtype={'from_stop_id': str, 'to_stop_id': str})
+            stop_rows = pd.Series(rows, index=crosswalk['gtfs_stop_id']).groupby(level=0).first()
+            a = stop_rows.reindex(transfers['from_stop_id']).to_numpy()
+            b = stop_rows.reindex(transfers['to_stop_id']).to_numpy()
+            known = ~(np.isnan(a) | np.isnan(b))
+            edges.append((a[known].astype(int), b[known].astype(int)))
+        labels = _components(len(crosswalk), np.concatenate([a for a, _ in edges]),
+                             np.concatenate([b for _, b in edges]))
+        row_complexes, _ = pd.factorize(labels, sort=True)
+
+        # a complex is named after its stations and their lines
+        names = crosswalk.assign(complex=row_complexes).groupby('complex').agg(
+            stations=('station_name', lambda s: '/'.join(sorted(set(s)))),
+            lines=('clean_lines', lambda s: ''.join(sorted(set(''.join(s.astype(str)))))))
+        complexes = pd.Index(names['stations'] + ' ' + names['lines'])
+
+        unit_complexes = pd.Series(row_complexes[unit_rows]).groupby(unit_names.to_numpy()).first()
+
+        equipment = pd.read_csv(station_turnstile_file)
+        remotes = equipment['remote'].astype(str).str.findall(r"'([^']*)'")
+        unit_boroughs = pd.Series(np.repeat(equipment['borough'].to_numpy(), remotes.str.len()),
+                                  index=np.concatenate(remotes.to_numpy()))
+        complex_of_equipment = unit_complexes.reindex(unit_boroughs.index).to_numpy()
+        known = ~np.isnan(complex_of_equipment)
+        borough_names = pd.Series(unit_boroughs.to_numpy()[known]).groupby(
+            complex_of_equipment[known].astype(int)).agg(lambda b: b.mode().iloc[0])
+        borough_codes, boroughs = pd.factorize(borough_names, sort=True)
+        complex_boroughs = np.full(len(complexes), -1)
+        complex_boroughs[borough_names.index.to_numpy()] = borough_codes
+
+        logging.getLogger().info("Crosswalk of %d units, %d complexes and %d boroughs, %d complexes without a borough",
+                                 len(unit_complexes), len(complexes), len(boroughs),
+                                 (complex_boroughs < 0).sum())
+        return cls(pd.Index(unit_complexes.index), unit_complexes.to_numpy(),
+                   complexes, complex_boroughs, pd.Index(boroughs))
+
+    def complex_codes(self, units: pd.Series) -> np.ndarray:
+        """
+        The complex code of each unit, -1 for units not in the crosswalk
+        """
+        codes = self.units.get_indexer(units)
+        return np.where(codes >= 0, self.unit_complexes[codes], -1)
+
+
+def _leaf_nodes(leaves: pd.DataFrame, crosswalk: Crosswalk, level: str) -> Tuple[np.ndarray, pd.DataFrame]:
+    # the node of each leaf at a level and the keys of the nodes. Leaves
+    # without a complex share a node with missing keys.
+    if level in ('COMPLEX', 'BOROUGH'):
+        codes = crosswalk.complex_codes(leaves['UNIT'])
+        if level == 'BOROUGH':
+            codes = np.where(codes >= 0, crosswalk.complex_boroughs[codes], -1)
+        names = crosswalk.complexes if level == 'COMPLEX' else crosswalk.boroughs
+        used, codes = np.unique(codes, return_inverse=True)
+        keys = pd.DataFrame({level: names[np.maximum(used, 0)].to_numpy()})
+        keys.loc[used < 0, level] = None
+        return codes, keys
+    codes, nodes = pd.MultiIndex.from_frame(leaves[LEVEL_KEYS[level]]).factorize(sort=True)
+    return codes, pd.DataFrame(list(nodes), columns=LEVEL_KEYS[level])
+
+
+def _parents(children: np.ndarray, parents: np.ndarray, nodes: int) -> np.ndarray:
+    # the parent pointer of each child node, None if a child has several
+    pointers = np.full(nodes, -1)
+    pointers[children] = parents
+    return pointers if (pointers[children] == parents).all() else None
+
+
+def _sum(time_codes: np.ndarray, node_codes: np.ndarray, nodes: int,
+         values: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    # the sums of each (time, node), as the time and node codes of the groups
+    keys = time_codes.astype(np.int64) * nodes + node_codes
+    if len(keys) and keys.max() < 4 * len(keys):
+        # dense enough to count every combination
+        counts = np.bincount(keys)
+        groups = np.flatnonzero(counts)
+        inverse = np.searchsorted(groups, keys)
+    else:
+        groups, inverse = np.unique(keys, return_inverse=True)
+    sums = {c: np.bincount(inverse, v, len(groups)) for c, v in values.items()}
+    return groups // nodes, groups % nodes, sums
+
+
+def aggregate_levels(turnstile_data: pd.DataFrame,
+                     crosswalk: Crosswalk,
+                     levels: List[str] = LEVELS,
+                     columns: List[str] = COLUMNS) -> pd.DataFrame:
+    """
+    Sum turnstile data by datetime at several levels of the station
+    hierarchy in one pass, see the module comment
+
+    Parameters
+    turnstile_data: pandas.DataFrame - with a datetime column or index and
+        the UNIT column, and the SCP, STATION and LINENAME columns for those
+        levels, e.g. the output of create_interpolated_turnstile_data with
+        group_by=['STATION', 'LINENAME', 'UNIT', 'SCP']
+    crosswalk: Crosswalk - for the COMPLEX and BOROUGH levels
+    levels: List[str], optional - from LEVELS
+    columns: List[str], optional - the columns to sum
+
+    Return
+    pandas.DataFrame - level, datetime, the keys of all the levels and the
+    sums. The keys of the other levels are missing, like the rows of
+    GROUPING SETS in SQL. Sorted by level (in the order of LEVELS) and
+    datetime.
+
+    """
+    if set(levels) - set(LEVELS):
+        raise Exception("Unsupported levels: " + str(sorted(set(levels) - set(LEVELS))))
+    levels = [level for level in LEVELS if level in levels]
+    if 'datetime' not in turnstile_data.columns:
+        turnstile_data = turnstile_data.reset_index()
+    keys = [k for k in ['UNIT', 'SCP', 'STATION', 'LINENAME']
+            if any(k in LEVEL_KEYS[level] for level in levels) or k == 'UNIT']
+    missing = set(keys) - set(turnstile_data.columns)
+    if missing:
+        raise Exception("The turnstile data needs the columns: " + str(sorted(missing)))
+
+    # the only pass over the string keys of the rows
+    grouped = turnstile_data.groupby(keys, observed=True, sort=True)
+    leaf_codes = grouped.ngroup().to_numpy()
+    leaves = grouped.size().index.to_frame(index=False)
+    time_codes, times = pd.factorize(turnstile_data['datetime'], sort=True)
+    values = {c: np.nan_to_num(turnstile_data[c].to_numpy(dtype=np.float64)) for c in columns}
+    if (leaf_codes < 0).any():
+        # rows with missing keys are not in any group
+        kept = leaf_codes >= 0
+        leaf_codes, time_codes = leaf_codes[kept], time_codes[kept]
+        values = {c: v[kept] for c, v in values.items()}
+
+    results = []
+    # the levels summed so far, the coarsest last
+    summed = []
+    for level in levels:
+        node_of_leaf, nodes = _leaf_nodes(leaves, crosswalk, level)
+        # the coarsest level summed so far whose nodes have one parent
+        source, pointers = None, None
+        for candidate in reversed(summed):
+            pointers = _parents(candidate['node_of_leaf'], node_of_leaf, candidate['nodes'])
+            if pointers is not None:
+                source = candidate
+                break
+        if source is not None:
+            level_times, level_nodes, sums = _sum(
+                source['times'], pointers[source['groups']], len(nodes), source['sums'])
+        else:
+            level_times, level_nodes, sums = _sum(
+                time_codes, node_of_leaf[leaf_codes], len(nodes), values)
+        logging.getLogger().info("%s level: %d rows from %d rows of %s", level, len(level_times),
+                                 len(time_codes) if source is None else len(source['times']),
+                                 'the data' if source is None else source['level'])
+        summed.append({'level': level, 'node_of_leaf': node_of_leaf, 'nodes': len(nodes),
+                       'times': level_times, 'groups': level_nodes, 'sums': sums})
+        results.append(pd.concat([
+            pd.DataFrame({'level': level, 'datetime': times[level_times]}),
+            nodes.iloc[level_nodes].reset_index(drop=True),
+            pd.DataFrame(sums)], axis=1))
+
+    result = pd.concat(results, ignore_index=True)
+    key_columns = [k for level in levels for k in LEVEL_KEYS[level]]
+    key_columns = list(dict.fromkeys(key_columns))
+    return result[['level', 'datetime'] + key_columns + columns]
@@ -0,0 +1,153 @@
+import logging
+import os
+import pickle
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from .cleaning import CleaningRules, DEFAULT_RULES
+from .rollup import RollupWriter
+from .streaming import OVERLAP, StationWriter, TurnstileStream
+from .turnstile import MTA_TURNSTILE_URL
+
+# This module keeps a directory of per-station files up to date. The state of
+# the last run is saved next to the files: the stream state (the boundary
+# snapshots of every turnstile and the weekly files processed) and the size of
+# each station file once its final intervals were written. The intervals
+# written after those are provisional, the next run cuts them off and
+# recomputes them with the new weeks.
+
+STATE_FILE = '.turnstile_state.pkl'
+
+
+def _load_state(output_directory: Path) -> dict:
+    path = output_directory / STATE_FILE
+    if not path.exists():
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_state(output_directory: Path, state: dict):
+    # replace the state in one step, an interrupted run leaves the previous
+    # state and the next run starts over from it
+    path = output_directory / STATE_FILE
+    with open(str(path) + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(str(path) + '.tmp', path)
+
+
+def _remove_provisional(output_directory: Path, state: dict):
+    for name in state['files']:
+        path = output_directory / name
+        if name in state['sizes']:
+            os.truncate(path, state['sizes'][name])
+        elif path.exists():
+            path.unlink()
+
+
+def update_station_files(output_directory: str,
+                         start_date: datetime,
+                         group_by: List[str] = ['STATION', 'LINENAME', 'UNIT', 'SCP'],
+                         frequency: str = '1H',
+                         engine: str = 'pandas',
+                         overlap: timedelta = OVERLAP,
+                         base_url: str = MTA_TURNSTILE_URL,
+                         cache_directory: str = None,
+                         cleaning_rules: CleaningRules = DEFAULT_RULES,
+                         rollup_directory: str = None,
+                         archive: str = None) -> List[Path]:
+    """
+    Create or update per-station turnstile data in output directory
+
+    The first run processes all weekly files from start_date on, like
+    process_turnstiles.py --stream. Later runs only download and interpolate
+    the weekly files published since, and append to the station files. The
+    files are the same as those of a full rebuild. The start date, group by
+    keys, frequency, engine, overlap and cleaning rules of later runs need
+    to be those of the first one.
+
+    Parameters
+    output_directory: str
+    start_date: datetime
+    group_by: List(str), optional - needs to include STATION and LINENAME
+    frequency: str, optional
+    engine: str, optional
+    overlap: timedelta, optional
+    base_url: str, optional
+    cache_directory: str, optional
+    cleaning_rules: CleaningRules, optional
+    rollup_directory: str, optional - also update the rollups saved there,
+        see rollup.py. The provisional intervals are replaced like those of
+        the station files.
+    archive: str, optional - read the weekly files from this local mirror
+        instead of downloading them, see turnstile.read_turnstile_archive
+
+    Return
+    List[Path] - the station files
+
+    """
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    parameters = {
+        'start_date': start_date,
+        'group_by': group_by,
+        'frequency': frequency,
+        'engine': engine,
+        'overlap': overlap,
+        'cleaning_rules': cleaning_rules,
+    }
+
+    state = _load_state(output_directory)
+    if state is None:
+        state = {
+            'parameters': parameters,
+            'carried': None,
+            'emitted': None,
+            'links': [],
+            'sizes': {},
+            'files': [],
+        }
+    elif state['parameters'] != parameters:
+        raise Exception(
+            "The station files in " + str(output_directory) +
+            " were created with " + str(state['parameters']) +
+            ", remove them to rebuild with " + str(parameters))
+    else:
+        logging.getLogger().info(
+            "Updating station files complete until %s", state['emitted'])
+    _remove_provisional(output_directory, state)
+
+    stream = TurnstileStream(start_date, None, group_by, frequency, engine,
+                             overlap, base_url, cache_directory,
+                             carried=state['carried'],
+                             emitted=state['emitted'],
+                             links=state['links'],
+                             cleaning_rules=cleaning_rules,
+                             archive=archive)
+    writer = StationWriter(output_directory,
+                           [output_directory / name for name in state['sizes']])
+    sinks = [writer] if rollup_directory is None else [writer, RollupWriter(rollup_directory)]
+    for chunk in stream.final_chunks():
+        for sink in sinks:
+            sink.write(chunk)
+    sizes = {path.name: path.stat().st_size for path in writer.files}
+    remaining = stream.remaining()
+    if remaining is not None:
+        for sink in sinks:
+            sink.write(remaining)
+    if rollup_directory is not None:
+        # saved before the state, a run interrupted in between replaces the
+        # same intervals again
+        sinks[1].close()
+
+    _save_state(output_directory, {
+        'parameters': parameters,
+        'carried': stream.carried,
+        'emitted': stream.emitted,
+        'links': stream.links,
+        'sizes': sizes,
+        'files': [path.name for path in writer.files],
+    })
+    return writer.files
@@ -0,0 +1,273 @@
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+from . import cleaning, turnstile, vectorized
+from .cleaning import CleaningRules, DEFAULT_RULES
+from .streaming import OVERLAP
+
+# This module caches interpolated turnstile data on disk, in week long
+# segments starting on Monday:
+#
+#   cache = ResultCache('data/cache/interpolated')
+#   cache.get(start, end)     # same parameters as create_interpolated_turnstile_data
+#
+# A call reads the segments of its weeks that earlier calls cached and only
+# computes the missing ones, downloading each run of consecutive missing
+# weeks once. Each segment is interpolated from the snapshots of its week and
+# the margin on both sides of it, and from nothing else, so that its content
+# doesn't depend on the date range it was first computed for: every call
+# returns the same estimates for a week, cached or not. A segment is only
+# cached once there are snapshots past its margin, the weeks still being
+# published are computed again.
+#
+# This is not create_interpolated_turnstile_data, which interpolates its date
+# range as a whole with a day of context on each side: the splines of a
+# turnstile are fitted to all the snapshots read, so near the edges of the
+# range or of a week the two can round an estimate differently.
+#
+# The segments of a set of parameters (group by keys, frequency, engine,
+# compact, cleaning rules and the code of the modules computing them) are in
+# a directory named after their hash. The least recently used segments are
+# removed when the cache grows over max_bytes, and the most recent ones are
+# also kept in memory so that repeated queries don't read them again.
+
+SEGMENT = timedelta(days=7)
+KEY_FILE = 'key.json'
+# the modules computing the results, changing them invalidates the cache
+CODE_MODULES = [cleaning, turnstile, vectorized]
+
+
+def _code_version() -> str:
+    digest = hashlib.sha1()
+    for module in CODE_MODULES:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _week_start(time: datetime) -> pd.Timestamp:
+    # the Monday 0:00 of the week of a time
+    day = pd.Timestamp(time).normalize()
+    return day - pd.Timedelta(days=day.dayofweek)
+
+
+def _runs(weeks: List[pd.Timestamp]) -> List[List[pd.Timestamp]]:
+    # the runs of consecutive weeks
+    runs = []
+    for week in weeks:
+        if runs and week - runs[-1][-1] == SEGMENT:
+            runs[-1].append(week)
+        else:
+            runs.append([week])
+    return runs
+
+
+class ResultCache:
+    """
+    Disk cache of create_interpolated_turnstile_data, see the module comment
+
+    Parameters
+    directory: str
+    max_bytes: int, optional - size of the segment files kept on disk
+    memory_bytes: int, optional - size of the segments kept in memory
+    margin: timedelta, optional - snapshots read on both sides of a week
+    """
+
+    def __init__(self,
+                 directory: str,
+                 max_bytes: int = 10 * 2**30,
+                 memory_bytes: int = 2**30,
+                 margin: timedelta = OVERLAP):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.margin = margin
+        self.version = _code_version()
+        # (key, week) -> (segment, bytes), the most recently used last
+        self._memory = OrderedDict()
+        self._memory_size = 0
+
+    def _key(self, group_by: List[str], frequency: str, engine: str,
+             compact: bool, cleaning_rules: CleaningRules) -> str:
+        parameters = {
+            'group_by': list(group_by),
+            'frequency': frequency,
+            'engine': engine,
+            'compact': compact,
+            'cleaning_rules': cleaning_rules._asdict(),
+            'margin': self.margin.total_seconds(),
+            'version': self.version,
+        }
+        text = json.dumps(parameters, sort_keys=True)
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+        key_file = self.directory / key / KEY_FILE
+        if not key_file.exists():
+            key_file.parent.mkdir(exist_ok=True)
+            key_file.write_text(text)
+        return key
+
+    def _path(self, key: str, week: pd.Timestamp) -> Path:
+        return self.directory / key / (week.strftime('%Y-%m-%d') + '.parquet')
+
+    def _remember(self, key: str, week: pd.Timestamp, segment: pd.DataFrame):
+        size = int(segment.memory_usage(deep=True).sum())
+        if size > self.memory_bytes:
+            return
+        previous = self._memory.pop((key, week), None)
+        if previous is not None:
+            self._memory_size -= previous[1]
+        self._memory[(key, week)] = (segment, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_size -= evicted
+
+    def _read(self, key: str, week: pd.Timestamp) -> pd.DataFrame:
+        # the cached segment, None if it isn't. Reading it marks it as used.
+        path = self._path(key, week)
+        if (key, week) in self._memory:
+            self._memory.move_to_end((key, week))
+            segment = self._memory[(key, week)][0]
+        elif path.exists():
+            segment = pd.read_parquet(path)
+            self._remember(key, week, segment)
+        else:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted from the disk by another process
+            pass
+        return segment
+
+    def _write(self, key: str, week: pd.Timestamp, segment: pd.DataFrame):
+        # write to a temporary file first, so that concurrent readers never
+        # see a partially written segment
+        path = self._path(key, week)
+        segment.to_parquet(str(path) + '.tmp', compression='snappy')
+        os.replace(str(path) + '.tmp', path)
+        self._remember(key, week, segment)
+
+    def evict(self):
+        """
+        Remove the least recently used segments until the cache is within
+        max_bytes
+        """
+        files = [(f.stat().st_mtime, f.stat().st_size, f)
+                 for f in self.directory.glob('*/*.parquet')]
+        size = sum(s for _, s, _ in files)
+        for _, file_size, f in sorted(files, key=lambda f: f[0]):
+            if size <= self.max_bytes:
+                break
+            f.unlink()
+            size -= file_size
+            logging.getLogger().info("Evicted %s from the result cache", f)
+
+    def get(self,
+            start_date: datetime,
+            end_date: datetime = None,
+            group_by: List[str] = ['UNIT', 'SCP'],
+            frequency: Union[str, List[str]] = '1H',
+            engine: str = 'pandas',
+            workers: int = 1,
+            download_workers: int = 1,
+            cache_directory: str = None,
+            compact: bool = False,
+            cleaning_rules: CleaningRules = DEFAULT_RULES,
+            archive: str = None) -> Union[
+                pd.DataFrame, Dict[str, pd.DataFrame]]:
+        """
+        Interpolated turnstile data from the cached segments, the missing ones
+        are computed and cached. Takes the parameters of
+        create_interpolated_turnstile_data.
+
+        Returns
+        the columns of create_interpolated_turnstile_data, sorted the same way
+        by group by keys and time
+
+        """
+        if not set(group_by).issubset(['STATION', 'LINENAME', 'UNIT', 'SCP']):
+            raise Exception("Unsupported group by keys: " + str(group_by))
+        if engine not in turnstile.ENGINES:
+            raise Exception("Unsupported engine: " + str(engine))
+        frequencies = [frequency] if isinstance(frequency, str) else frequency
+        keys = {f: self._key(group_by, f, engine, compact, cleaning_rules)
+                for f in frequencies}
+        weeks = list(pd.date_range(_week_start(start_date),
+                                   _week_start(end_date or datetime.today()),
+                                   freq=SEGMENT))
+
+        segments = {f: {} for f in frequencies}
+        for week in weeks:
+            for f in frequencies:
+                segment = self._read(keys[f], week)
+                if segment is not None:
+                    segments[f][week] = segment
+        missing = [w for w in weeks if any(w not in segments[f] for f in frequencies)]
+        logging.getLogger().info("%d of %d weeks cached", len(weeks) - len(missing), len(weeks))
+
+        for run in _runs(missing):
+            computed = self._compute(run, group_by, frequencies, engine, workers,
+                                     download_workers, cache_directory, compact,
+                                     cleaning_rules, archive)
+            for week, (final, by_frequency) in computed.items():
+                for f, segment in by_frequency.items():
+                    segments[f][week] = segment
+                    if final:
+                        self._write(keys[f], week, segment)
+        if missing:
+            self.evict()
+
+        result = {}
+        for f in frequencies:
+            frames = [segments[f][w] for w in weeks if w in segments[f]]
+            if not frames:
+                raise Exception("No turnstile data between " + str(start_date) +
+                                " and " + str(end_date))
+            data = pd.concat(frames)
+            selected = data.index >= start_date
+            if end_date is not None:
+                selected &= data.index <= end_date
+            result[f] = data[selected].sort_values(group_by + ['datetime'],
+                                                   kind='stable')
+        return result[frequency] if isinstance(frequency, str) else result
+
+    def _compute(self, run: List[pd.Timestamp], group_by: List[str],
+                 frequencies: List[str], engine: str, workers: int,
+                 download_workers: int, cache_directory: str, compact: bool,
+                 cleaning_rules: CleaningRules, archive: str) -> Dict[pd.Timestamp, Tuple[bool, Dict[str, pd.DataFrame]]]:
+        # the segments of a run of weeks, and whether each is final, from one
+        # download of the weekly files of the run. Weeks without snapshots
+        # are left out.
+        raw = turnstile.download_turnstile_data(
+            run[0] - self.margin, run[-1] + SEGMENT + self.margin,
+            workers=download_workers, cache_directory=cache_directory,
+            compact=compact, archive=archive)
+        timestamps = turnstile._build_timestamps(raw)
+        last = timestamps.max() if len(raw) else None
+        computed = {}
+        for week in run:
+            end = week + SEGMENT
+            # only the snapshots of the week and its margin, whatever else the
+            # weekly files of the run hold
+            window = (timestamps >= week - self.margin) & (timestamps < end + self.margin)
+            if not window.any():
+                # not published yet
+                continue
+            interpolated = turnstile._interpolate_raw_data(
+                raw[window], week - self.margin, end + self.margin, group_by,
+                frequencies, engine, workers, compact, cleaning_rules)
+            final = last is not None and last >= end + self.margin
+            computed[week] = (final, {
+                f: data[(data.index >= week) & (data.index < end)]
+                for f, data in interpolated.items()})
+        return computed
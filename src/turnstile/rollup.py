@@ -0,0 +1,328 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .turnstile import FREQUENCIES, sum_turnstile_data_by_station
+
+# This module maintains daily, weekly, monthly and yearly sums of per-station
+# ridership, and its hour of week profile per month, as a pyramid of
+# materialized rollups:
+#
+#   pyramid = RollupPyramid.build(station_data)
+#   pyramid.update(next_week)
+#   pyramid.rollup('M', start=datetime(2019, 1, 1))
+#   pyramid.year_over_year('M')
+#
+# Every level holds sums and the number of intervals summed, so the levels are
+# additive: an update adds the new intervals to the buckets they fall in. The
+# intervals of the last TAIL are also kept, so that data replacing them (the
+# provisional intervals of incremental.update_station_files) is first
+# subtracted. Only the buckets from the first changed interval on are
+# touched, each level is sorted by bucket so that they are a suffix of it.
+
+COLUMNS = ['estimated_entries', 'estimated_exits']
+KEYS = ['STATION', 'LINENAME']
+
+# the levels and their time buckets, from the finest
+LEVELS = ['D', 'W', 'M', 'Y']
+# the levels whose buckets make up the buckets of a frequency, coarsest first
+NESTED = {
+    'D': ['D'],
+    'W': ['W', 'D'],
+    'M': ['M', 'D'],
+    'Y': ['Y', 'M', 'D'],
+}
+# the same bucket a year before, for year_over_year
+YEAR_BEFORE = {
+    'D': pd.DateOffset(days=364),
+    'W': pd.DateOffset(weeks=52),
+    'M': pd.DateOffset(months=12),
+    'Y': pd.DateOffset(years=1),
+}
+PROFILE = 'hour_of_week'
+TAIL = timedelta(days=28)
+META_FILE = 'rollup.json'
+
+
+def _bucket(times: pd.Series, level: str) -> np.ndarray:
+    return FREQUENCIES[level](times.to_numpy().astype('datetime64[ns]')).astype('datetime64[ns]')
+
+
+def _hour_of_week(times: pd.Series) -> np.ndarray:
+    # 0 is Monday 0:00
+    return (times.dt.dayofweek * 24 + times.dt.hour).to_numpy()
+
+
+def _contributions(station_data: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    # the sums and interval counts of the data in the buckets of each level
+    station_data = station_data[station_data[KEYS].notnull().all(axis=1)]
+    values = station_data[KEYS + COLUMNS].assign(intervals=1)
+    levels = {}
+    for level in LEVELS:
+        levels[level] = values.assign(bucket=_bucket(station_data['datetime'], level)).groupby(
+            ['bucket'] + KEYS, observed=True).sum()
+    levels[PROFILE] = values.assign(
+        bucket=_bucket(station_data['datetime'], 'M'),
+        hour_of_week=_hour_of_week(station_data['datetime'])).groupby(
+            ['bucket'] + KEYS + [PROFILE], observed=True).sum()
+    return levels
+
+
+class RollupPyramid:
+    """
+    Materialized rollups of per-station ridership, see the module comment
+
+    levels: Dict[str, pandas.DataFrame] - D, W, M, Y and hour_of_week, the
+        sums and intervals of each bucket (and hour of week), indexed by
+        bucket, STATION and LINENAME (and hour_of_week) in that order
+    tail: pandas.DataFrame - the intervals of the last TAIL
+    """
+
+    def __init__(self, levels: Dict[str, pd.DataFrame], tail: pd.DataFrame,
+                 tail_length: timedelta = TAIL):
+        self.levels = levels
+        self.tail = tail
+        self.tail_length = tail_length
+
+    @classmethod
+    def build(cls, station_data: pd.DataFrame, tail_length: timedelta = TAIL) -> 'RollupPyramid':
+        """
+        Build the rollups of per-station data
+
+        Parameters
+        station_data: pandas.DataFrame - datetime, STATION, LINENAME,
+            estimated_entries and estimated_exits, e.g. the output of
+            turnstile.sum_turnstile_data_by_station
+        tail_length: timedelta, optional - how far back updates can replace
+            intervals
+
+        Return
+        RollupPyramid
+        """
+        logging.getLogger().info("Building rollups of %d rows", len(station_data))
+        levels = {level: data.sort_index() for level, data in
+                  _contributions(station_data).items()}
+        pyramid = cls(levels, station_data.iloc[:0][['datetime'] + KEYS + COLUMNS], tail_length)
+        pyramid._keep_tail(station_data)
+        return pyramid
+
+    @property
+    def end(self) -> datetime:
+        """
+        The last interval, None if the pyramid is empty
+        """
+        return None if self.tail.empty else self.tail['datetime'].max()
+
+    def _keep_tail(self, station_data: pd.DataFrame):
+        station_data = station_data[['datetime'] + KEYS + COLUMNS]
+        if station_data.empty:
+            return
+        since = station_data['datetime'].max() - self.tail_length
+        self.tail = station_data[station_data['datetime'] > since].reset_index(drop=True)
+
+    def update(self, station_data: pd.DataFrame):
+        """
+        Add new intervals. The intervals of the pyramid from the first new
+        one on are replaced, they need to be within the tail.
+
+        Parameters
+        station_data: pandas.DataFrame - see build
+        """
+        if station_data.empty:
+            return
+        first = station_data['datetime'].min()
+        end = self.end
+        if end is not None and first <= end and (
+                self.tail.empty or first < self.tail['datetime'].min()):
+            raise Exception("Can't replace the intervals before " +
+                            str(self.tail['datetime'].min()) + " with data from " + str(first))
+        replaced = self.tail[self.tail['datetime'] >= first]
+        added = _contributions(station_data)
+        removed = _contributions(replaced)
+        for level, data in self.levels.items():
+            # the buckets from the first changed one on
+            since = np.datetime64(_bucket(pd.Series([first]), 'M' if level == PROFILE else level)[0])
+            split = data.index.get_level_values('bucket').searchsorted(since)
+            changed = data.iloc[split:].add(added[level], fill_value=0).sub(
+                removed[level], fill_value=0)
+            changed = changed[changed['intervals'] > 0]
+            self.levels[level] = pd.concat([data.iloc[:split], changed.sort_index()]).astype(
+                data.dtypes.to_dict())
+        self._keep_tail(pd.concat([self.tail[self.tail['datetime'] < first],
+                                   station_data[['datetime'] + KEYS + COLUMNS]], ignore_index=True))
+
+    def _level_for(self, freq: str, start: datetime = None, end: datetime = None) -> str:
+        # the coarsest level whose buckets make up the buckets of freq and
+        # start and end the time range on a bucket boundary
+        if freq not in NESTED:
+            raise Exception("Unsupported frequency: " + str(freq))
+        for level in NESTED[freq]:
+            aligned = [t is None or _bucket(pd.Series([pd.Timestamp(t)]), level)[0] == np.datetime64(pd.Timestamp(t))
+                       for t in (start, end)]
+            if all(aligned):
+                return level
+        raise Exception("The time range needs to start and end on days: " + str((start, end)))
+
+    @staticmethod
+    def _select(data: pd.DataFrame, stations: List[Tuple[str, str]] = None,
+                start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        buckets = data.index.get_level_values('bucket')
+        first = 0 if start is None else buckets.searchsorted(np.datetime64(pd.Timestamp(start)))
+        last = len(data) if end is None else buckets.searchsorted(np.datetime64(pd.Timestamp(end)))
+        data = data.iloc[first:last]
+        if stations is not None:
+            data = data[pd.MultiIndex.from_arrays([
+                data.index.get_level_values('STATION'),
+                data.index.get_level_values('LINENAME')]).isin(stations)]
+        return data
+
+    def rollup(self, freq: str = 'D', stations: List[Tuple[str, str]] = None,
+               start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        """
+        Sums per station in daily, weekly (starting on Monday), monthly or
+        yearly buckets, read from the coarsest level that answers the query
+
+        Parameters
+        freq: str, optional - D, W, M or Y
+        stations: List[(str, str)], optional - (STATION, LINENAME) pairs, all
+            stations if not specified
+        start: datetime, optional - inclusive, on a day boundary
+        end: datetime, optional - exclusive, on a day boundary
+
+        Return
+        pandas.DataFrame - datetime (the start of the bucket), STATION,
+        LINENAME, the sums and the number of intervals summed
+        """
+        level = self._level_for(freq, start, end)
+        data = self._select(self.levels[level], stations, start, end).reset_index()
+        if level != freq:
+            data = data.assign(bucket=_bucket(data['bucket'], freq)).groupby(
+                ['bucket'] + KEYS, observed=True, sort=True).sum().reset_index()
+        return data.rename(columns={'bucket': 'datetime'})
+
+    def profile(self, stations: List[Tuple[str, str]] = None,
+                start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        """
+        The mean of each hour of the week (0 is Monday 0:00) per station
+
+        Parameters
+        stations: List[(str, str)], optional
+        start: datetime, optional - inclusive, on a month boundary
+        end: datetime, optional - exclusive, on a month boundary
+
+        Return
+        pandas.DataFrame - indexed by STATION, LINENAME and hour_of_week
+        """
+        for t in (start, end):
+            if t is not None and _bucket(pd.Series([pd.Timestamp(t)]), 'M')[0] != np.datetime64(pd.Timestamp(t)):
+                raise Exception("The profile time range needs to start and end on months: " + str(t))
+        data = self._select(self.levels[PROFILE], stations, start, end)
+        sums = data.groupby(KEYS + [PROFILE], observed=True).sum()
+        return sums[COLUMNS].div(sums['intervals'], axis=0)
+
+    def year_over_year(self, freq: str = 'M', stations: List[Tuple[str, str]] = None,
+                       start: datetime = None, end: datetime = None,
+                       column: str = 'estimated_entries') -> pd.DataFrame:
+        """
+        The sums of each bucket next to those of the same bucket a year
+        before: 364 days, 52 weeks, 12 months or a year
+
+        Return
+        pandas.DataFrame - datetime, STATION, LINENAME, column,
+        previous and change (the ratio minus 1)
+        """
+        current = self.rollup(freq, stations, start, end)
+        previous_start = None if start is None else pd.Timestamp(start) - YEAR_BEFORE[freq]
+        previous_end = None if end is None else pd.Timestamp(end) - YEAR_BEFORE[freq]
+        previous = self.rollup(freq, stations, previous_start, previous_end)
+        previous = previous.assign(datetime=previous['datetime'] + YEAR_BEFORE[freq])
+        result = current[['datetime'] + KEYS + [column]].merge(
+            previous[['datetime'] + KEYS + [column]].rename(columns={column: 'previous'}),
+            on=['datetime'] + KEYS, how='left')
+        return result.assign(change=result[column] / result['previous'] - 1)
+
+    def save(self, path: str):
+        """
+        Save the pyramid as parquet files under path
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for level, data in self.levels.items():
+            data.reset_index().to_parquet(path / (level + '.parquet'), index=False)
+        self.tail.to_parquet(path / 'tail.parquet', index=False)
+        with open(path / META_FILE, 'w') as f:
+            json.dump({'levels': list(self.levels),
+                       'tail_length': self.tail_length.total_seconds()}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'RollupPyramid':
+        """
+        Load a pyramid saved under path
+        """
+        path = Path(path)
+        with open(path / META_FILE) as f:
+            meta = json.load(f)
+        levels = {}
+        for level in meta['levels']:
+            data = pd.read_parquet(path / (level + '.parquet'))
+            keys = ['bucket'] + KEYS + ([PROFILE] if level == PROFILE else [])
+            levels[level] = data.set_index(keys)
+        return cls(levels, pd.read_parquet(path / 'tail.parquet'),
+                   timedelta(seconds=meta['tail_length']))
+
+
+def update_rollups(path: str, station_data: pd.DataFrame) -> RollupPyramid:
+    """
+    Add per-station data to the pyramid saved under path, or build it
+
+    Parameters
+    path: str
+    station_data: pandas.DataFrame - see RollupPyramid.build
+
+    Return
+    RollupPyramid
+    """
+    if (Path(path) / META_FILE).exists():
+        pyramid = RollupPyramid.load(path)
+        pyramid.update(station_data)
+    else:
+        pyramid = RollupPyramid.build(station_data)
+    pyramid.save(path)
+    return pyramid
+
+
+class RollupWriter:
+    """
+    Sink for stream_interpolated_turnstile_data that aggregates each chunk by
+    station and adds it to the pyramid, which is saved under path when
+    closed. Only the pyramid is kept between chunks. The turnstile data
+    needs the STATION and LINENAME columns.
+
+    Parameters
+    path: str
+    rebuild: bool, optional - replace the saved pyramid instead of updating it
+    """
+
+    def __init__(self, path: str, rebuild: bool = False):
+        self.path = path
+        self.rebuild = rebuild
+        self.pyramid = None
+
+    def write(self, chunk: pd.DataFrame):
+        station_data = sum_turnstile_data_by_station(chunk)
+        if self.pyramid is None and not self.rebuild and (Path(self.path) / META_FILE).exists():
+            self.pyramid = RollupPyramid.load(self.path)
+        if self.pyramid is None:
+            self.pyramid = RollupPyramid.build(station_data)
+        else:
+            self.pyramid.update(station_data)
+
+    def close(self) -> RollupPyramid:
+        if self.pyramid is not None:
+            self.pyramid.save(self.path)
+        return self.pyramid
@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from .store import read_station_store
+from .turnstile import FREQUENCIES
+from .writer import COMPRESSION_SUFFIXES
+
+# This module keeps per-station ridership in memory and answers HTTP/JSON
+# queries about it, so that several consumers share one loaded copy:
+#
+#   GET /stations
+#   GET /ridership?station=59 ST&line=N&start=2020-01-01&end=2020-02-01&freq=D&agg=sum&group=station
+#
+# The rows are sorted by station and time once when loaded. A query finds the
+# rows of each selected station with a binary search on its time range and
+# reduces them into time buckets with bincount. The server runs on asyncio,
+# the queries run on a thread pool so that slow ones don't hold up the others.
+
+COLUMNS = ['estimated_entries', 'estimated_exits']
+
+AGGREGATIONS = ['sum', 'mean', 'max', 'min']
+GROUPS = ['station', 'total']
+
+_REASONS = {200: b'OK', 400: b'Bad Request', 404: b'Not Found', 405: b'Method Not Allowed',
+            500: b'Internal Server Error'}
+
+
+class QueryError(Exception):
+    pass
+
+
+def load_station_data(path: str, output_format: str = 'csv') -> pd.DataFrame:
+    """
+    Load the per-station data written by process_turnstiles.py
+
+    Parameters
+    path: str - the output directory
+    output_format: str, optional - csv (one file per station, compressed or
+        not) or parquet (a dataset written by store.write_station_store)
+
+    Return
+    pandas.DataFrame - datetime, STATION, LINENAME and the ridership columns
+
+    """
+    logging.getLogger().info("Loading station data from %s", path)
+    if output_format == 'parquet':
+        data = read_station_store(path, columns=['datetime', 'STATION', 'LINENAME'] + COLUMNS)
+        return data.astype({'STATION': str, 'LINENAME': str})
+    suffixes = tuple('.csv' + s for s in COMPRESSION_SUFFIXES.values())
+    files = sorted(f for f in Path(path).iterdir() if f.name.endswith(suffixes))
+    if not files:
+        raise Exception("No station files in " + str(path))
+    return pd.concat(
+        [pd.read_csv(f, parse_dates=['datetime'], dtype={'STATION': str, 'LINENAME': str})
+         for f in files], ignore_index=True)
+
+
+class RidershipIndex:
+    """
+    Per-station ridership sorted by station and time, see the module comment
+
+    Parameters
+    station_data: pandas.DataFrame - datetime, STATION, LINENAME and the
+        ridership columns, e.g. the output of load_station_data
+    """
+
+    def __init__(self, station_data: pd.DataFrame):
+        station_data = station_data[
+            station_data[['STATION', 'LINENAME']].notnull().all(axis=1)]
+        codes, self.stations = pd.MultiIndex.from_frame(
+            station_data[['STATION', 'LINENAME']].astype(str)).factorize(sort=True)
+        times = station_data['datetime'].to_numpy().astype('datetime64[ns]')
+        order = np.lexsort((times, codes))
+        self.times = times[order]
+        self.values = {c: station_data[c].to_numpy(dtype=np.float64)[order]
+                       for c in COLUMNS}
+        # the rows of station i are offsets[i]:offsets[i + 1]
+        self.offsets = np.append(0, np.cumsum(np.bincount(codes, minlength=len(self.stations))))
+        self._station_names = self.stations.get_level_values(0).str.upper()
+        self._lines = self.stations.get_level_values(1)
+
+    def __len__(self):
+        return len(self.times)
+
+    def station_list(self) -> List[Dict]:
+        """
+        The stations with their lines, time range and number of rows
+        """
+        starts, stops = self.offsets[:-1], self.offsets[1:]
+        return [{'station': station, 'line': line,
+                 'first': str(pd.Timestamp(self.times[start])) if stop > start else None,
+                 'last': str(pd.Timestamp(self.times[stop - 1])) if stop > start else None,
+                 'rows': int(stop - start)}
+                for (station, line), start, stop in zip(self.stations, starts, stops)]
+
+    def select_stations(self, stations: List[str] = None, line: str = None) -> np.ndarray:
+        """
+        The codes of the stations with one of the names (case insensitive)
+        served by the line (e.g. 'A' matches 'ACE'), all of them by default
+        """
+        selected = np.ones(len(self.stations), dtype=bool)
+        if stations:
+            selected &= np.asarray(self._station_names.isin([s.upper() for s in stations]))
+        if line:
+            selected &= np.asarray(self._lines.str.contains(line, regex=False))
+        return np.flatnonzero(selected)
+
+    def _rows(self, codes: np.ndarray, start: datetime = None, end: datetime = None) -> Tuple[np.ndarray, np.ndarray]:
+        # the rows of the stations within [start, end), and their station
+        first, last = self.offsets[codes], self.offsets[codes + 1]
+        if start is not None:
+            first = np.array([f + np.searchsorted(self.times[f:l], np.datetime64(start, 'ns'))
+                              for f, l in zip(first, last)], dtype=np.int64)
+        if end is not None:
+            last = np.array([f + np.searchsorted(self.times[f:l], np.datetime64(end, 'ns'))
+                             for f, l in zip(first, last)], dtype=np.int64)
+        counts = np.maximum(last - first, 0)
+        rows = np.repeat(first - np.append(0, np.cumsum(counts)[:-1]), counts) + np.arange(counts.sum())
+        return rows, np.repeat(codes, counts)
+
+    def query(self,
+              stations: List[str] = None,
+              line: str = None,
+              start: datetime = None,
+              end: datetime = None,
+              freq: str = 'raw',
+              agg: str = 'sum',
+              group: str = 'station',
+              columns: List[str] = COLUMNS) -> pd.DataFrame:
+        """
+        Ridership of the selected stations between start (inclusive) and end
+        (exclusive), reduced by agg into the time buckets of freq, per
+        station or in total
+
+        Return
+        pandas.DataFrame - datetime (the start of the bucket), STATION and
+        LINENAME for group='station', and the columns
+        """
+        if freq not in FREQUENCIES:
+            raise QueryError("Unsupported freq: " + str(freq))
+        if agg not in AGGREGATIONS:
+            raise QueryError("Unsupported agg: " + str(agg))
+        if group not in GROUPS:
+            raise QueryError("Unsupported group: " + str(group))
+        if set(columns) - set(COLUMNS):
+            raise QueryError("Unsupported columns: " + str(sorted(set(columns) - set(COLUMNS))))
+
+        rows, station_codes = self._rows(self.select_stations(stations, line), start, end)
+        buckets, bucket_times = pd.factorize(FREQUENCIES[freq](self.times[rows]), sort=True)
+        groups = station_codes if group == 'station' else np.zeros(len(rows), dtype=np.int64)
+        width = max(len(bucket_times), 1)
+        keys, inverse = np.unique(groups * width + buckets, return_inverse=True)
+
+        result = {}
+        if group == 'station':
+            result['STATION'] = self.stations.get_level_values(0)[keys // width]
+            result['LINENAME'] = self.stations.get_level_values(1)[keys // width]
+        result['datetime'] = np.asarray(bucket_times, dtype='datetime64[ns]')[keys % width]
+        for column in columns:
+            values = self.values[column][rows]
+            present = ~np.isnan(values)
+            if agg in ('sum', 'mean'):
+                # bincount of an empty selection is int64 whatever the
+                # weights, the sums and counts are cast to float
+                sums = np.bincount(inverse, np.where(present, values, 0), len(keys)).astype(float)
+                if agg == 'mean':
+                    counts = np.bincount(inverse, present, len(keys)).astype(float)
+                    sums = np.divide(sums, counts, out=np.full(len(keys), np.nan),
+                                     where=counts > 0)
+                result[column] = sums
+            else:
+                reduced = np.full(len(keys), -np.inf if agg == 'max' else np.inf)
+                (np.maximum if agg == 'max' else np.minimum).at(
+                    reduced, inverse[present], values[present])
+                reduced[np.isinf(reduced)] = np.nan
+                result[column] = reduced
+        return pd.DataFrame(result)
+
+
+def _parse_query(query: Dict[str, List[str]]) -> Dict:
+    # the arguments of RidershipIndex.query from the query string
+    def one(name, default=None):
+        return query[name][-1] if name in query else default
+
+    def date(name):
+        value = one(name)
+        try:
+            return None if value is None else datetime.fromisoformat(value)
+        except ValueError:
+            raise QueryError("Invalid " + name + ": " + value)
+
+    return {
+        'stations': query.get('station'),
+        'line': one('line'),
+        'start': date('start'),
+        'end': date('end'),
+        'freq': one('freq', 'raw'),
+        'agg': one('agg', 'sum'),
+        'group': one('group', 'station'),
+        'columns': one('columns', ','.join(COLUMNS)).split(','),
+    }
+
+
+def _records(frame: pd.DataFrame) -> List[Dict]:
+    frame = frame.assign(datetime=frame['datetime'].astype(str))
+    return json.loads(frame.to_json(orient='records'))
+
+
+class RidershipService:
+    """
+    HTTP/JSON server of a RidershipIndex on asyncio, see the module comment
+
+    Parameters
+    index: RidershipIndex
+    workers: int, optional - number of threads running queries
+    """
+
+    def __init__(self, index: RidershipIndex, workers: int = 4):
+        self.index = index
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def handle(self, method: str, target: str) -> Tuple[int, Dict]:
+        """
+        The status and JSON body of the response to a request, a 500 error
+        if answering it raises
+        """
+        try:
+            return self._handle(method, target)
+        except Exception as e:
+            logging.getLogger().exception("Failed to answer %s %s", method, target)
+            return 500, {'error': type(e).__name__ + ': ' + str(e)}
+
+    def _handle(self, method: str, target: str) -> Tuple[int, Dict]:
+        if method != 'GET':
+            return 405, {'error': 'Only GET is supported'}
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'rows': len(self.index),
+                         'stations': len(self.index.stations)}
+        if url.path == '/stations':
+            return 200, {'stations': self.index.station_list()}
+        if url.path == '/ridership':
+            try:
+                arguments = _parse_query(parse_qs(url.query))
+                result = self.index.query(**arguments)
+            except QueryError as e:
+                return 400, {'error': str(e)}
+            return 200, {'query': {k: v if v is None or isinstance(v, (str, list)) else str(v)
+                                   for k, v in arguments.items()},
+                         'rows': _records(result)}
+        return 404, {'error': 'Unknown path: ' + url.path}
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                # skip the headers, the requests have no body
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    if header.lower().startswith(b'connection:') and b'close' in header.lower():
+                        keep_alive = False
+                parts = request.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, body = 400, {'error': 'Malformed request'}
+                    keep_alive = False
+                else:
+                    status, body = await loop.run_in_executor(
+                        self.executor, self.handle, parts[0], parts[1])
+                    keep_alive &= parts[2] == 'HTTP/1.1'
+                payload = json.dumps(body).encode('utf-8')
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\nConnection: %s\r\n\r\n' % (
+                                 status, _REASONS.get(status, b''), len(payload),
+                                 b'keep-alive' if keep_alive else b'close') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> asyncio.AbstractServer:
+        """
+        Start listening, port 0 picks a free port
+        """
+        return await asyncio.start_server(self._connection, host, port)
+
+    def serve_forever(self, host: str = '127.0.0.1', port: int = 8080):
+        async def run():
+            server = await self.start(host, port)
+            logging.getLogger().info("Serving %d rows of %d stations on http://%s:%d/",
+                                     len(self.index), len(self.index.stations),
+                                     host, server.sockets[0].getsockname()[1])
+            async with server:
+                await server.serve_forever()
+        asyncio.run(run())
+
@@ -0,0 +1,396 @@
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import socket
+import time
+import traceback
+import zlib
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from . import turnstile
+from .streaming import OVERLAP
+
+# This module splits the processing of a long date range into shards that
+# workers on several machines process from a job directory they share:
+#
+#   create_job('jobs/backfill', datetime(2010, 5, 1), datetime(2020, 12, 31), archive='/mnt/mirror/turnstile')
+#   run_worker('jobs/backfill')        # on each machine, any number of times
+#   wait_for_job('jobs/backfill')
+#   station_data = merge_job('jobs/backfill')
+#
+# A shard is a time window and a share of the turnstiles, the UNITs whose
+# crc32 modulo unit_shards is its unit shard. Its weekly files are read with
+# an overlap on both sides of the window, like the chunks of
+# stream_interpolated_turnstile_data, and interpolated between the window
+# edges. The splines fitted there are those of the whole date range, so the
+# estimates of the window and the merged station sums are the same as those
+# of a single run. The data of the window is summed by station and written
+# as a parquet part file.
+#
+# The job directory is the work queue:
+#
+#   job.json            the parameters and the shards
+#   queue/<shard>.json  shards waiting for a worker
+#   claimed/            shards being processed, moved there from queue/ with
+#                       os.rename so that exactly one worker claims each
+#   parts/              the station sums of each shard
+#   done/               a file per shard whose part is written
+#   failed/             the traceback of each shard that raised
+#
+# A worker touches its claimed file as it goes, the claims that are not
+# touched for longer than a lease (the worker died) are moved back to the
+# queue. Shards are deterministic, a shard processed twice writes the same
+# part. The merge sums the parts in the order of the shards.
+
+JOB_FILE = 'job.json'
+DIRECTORIES = ['queue', 'claimed', 'parts', 'done', 'failed']
+LEASE = timedelta(hours=1)
+POLL = 5
+STATION_COLUMNS = ['datetime', 'STATION', 'LINENAME']
+
+
+def _unit_shards(units: pd.Series, unit_shards: int) -> np.ndarray:
+    # crc32 rather than hash(), which changes from one process to another
+    codes, uniques = pd.factorize(units)
+    shards = np.array([zlib.crc32(str(u).encode('utf-8')) % unit_shards
+                       for u in uniques], dtype=np.int64)
+    return np.where(codes >= 0, shards[np.maximum(codes, 0)] if len(shards) else 0, 0)
+
+
+def _shard_id(window: int, unit_shard: int) -> str:
+    return '%05d-%03d' % (window, unit_shard)
+
+
+def _load_job(job_directory: Path) -> dict:
+    with open(job_directory / JOB_FILE) as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, content: dict):
+    with open(str(path) + '.tmp', 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    os.replace(str(path) + '.tmp', path)
+
+
+def create_job(job_directory: str,
+               start_date: datetime,
+               end_date: datetime,
+               unit_shards: int = 4,
+               window: timedelta = timedelta(days=28),
+               group_by: List[str] = ['STATION', 'LINENAME', 'UNIT', 'SCP'],
+               frequency: str = '1H',
+               engine: str = 'pandas',
+               compact: bool = False,
+               overlap: timedelta = OVERLAP,
+               cache_directory: str = None,
+               archive: str = None) -> dict:
+    """
+    Split the processing of a date range into shards and queue them in
+    job_directory. An existing job with the same parameters is resumed: the
+    shards that are not done, not claimed and not queued (e.g. failed ones)
+    are queued again.
+
+    Parameters
+    job_directory: str - shared by the coordinator and the workers
+    start_date: datetime
+    end_date: datetime
+    unit_shards: int, optional - number of shares the UNITs are split in
+    window: timedelta, optional - length of the time windows
+    group_by: List[str], optional - needs STATION and LINENAME
+    frequency: str, optional
+    engine: str, optional
+    compact: bool, optional - see create_interpolated_turnstile_data
+    overlap: timedelta, optional - read on both sides of a window
+    cache_directory: str, optional - see download_turnstile_data, a
+        directory the workers share
+    archive: str, optional - see download_turnstile_data, a mirror the
+        workers share
+
+    Return
+    dict - the parameters and the shards
+    """
+    if not {'STATION', 'LINENAME'}.issubset(group_by):
+        raise Exception("A sharded job needs STATION and LINENAME in its group by keys")
+    if engine not in turnstile.ENGINES:
+        raise Exception("Unsupported engine: " + str(engine))
+    job_directory = Path(job_directory)
+    for d in DIRECTORIES:
+        (job_directory / d).mkdir(parents=True, exist_ok=True)
+
+    bounds = list(pd.date_range(start_date, end_date, freq=window))
+    shards = [{
+        'id': _shard_id(w, u),
+        'unit_shard': u,
+        'start': bounds[w].isoformat(),
+        'end': (bounds[w + 1] if w + 1 < len(bounds) else pd.Timestamp(end_date)).isoformat(),
+        'last': w + 1 == len(bounds),
+    } for w in range(len(bounds)) for u in range(unit_shards)]
+    job = {
+        'start': pd.Timestamp(start_date).isoformat(),
+        'end': pd.Timestamp(end_date).isoformat(),
+        'unit_shards': unit_shards,
+        'group_by': list(group_by),
+        'frequency': frequency,
+        'engine': engine,
+        'compact': compact,
+        'overlap': overlap.total_seconds(),
+        'cache_directory': cache_directory,
+        'archive': archive,
+        'shards': shards,
+    }
+    if (job_directory / JOB_FILE).exists():
+        if _load_job(job_directory) != job:
+            raise Exception("The job in " + str(job_directory) +
+                            " was created with other parameters")
+    else:
+        _write_json(job_directory / JOB_FILE, job)
+
+    queued = 0
+    for shard in shards:
+        name = shard['id'] + '.json'
+        if (job_directory / 'done' / name).exists() or \
+                (job_directory / 'claimed' / name).exists() or \
+                (job_directory / 'queue' / name).exists():
+            continue
+        failed = job_directory / 'failed' / (shard['id'] + '.txt')
+        if failed.exists():
+            failed.unlink()
+        _write_json(job_directory / 'queue' / name, shard)
+        queued += 1
+    logging.getLogger().info("Queued %d of %d shards in %s", queued,
+                             len(shards), job_directory)
+    return job
+
+
+def _claim(job_directory: Path) -> dict:
+    # the first queued shard that no other worker claims first
+    for path in sorted((job_directory / 'queue').glob('*.json')):
+        claimed = job_directory / 'claimed' / path.name
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            continue
+        os.utime(claimed)
+        with open(claimed) as f:
+            return json.load(f)
+    return None
+
+
+def _touch(job_directory: Path, shard: dict):
+    try:
+        os.utime(job_directory / 'claimed' / (shard['id'] + '.json'))
+    except FileNotFoundError:
+        # moved back to the queue, the part is still written
+        pass
+
+
+def _release(job_directory: Path, shard: dict):
+    try:
+        os.unlink(job_directory / 'claimed' / (shard['id'] + '.json'))
+    except FileNotFoundError:
+        pass
+
+
+def process_shard(job_directory: str,
+                  shard: dict,
+                  workers: int = 1,
+                  download_workers: int = 1) -> pd.DataFrame:
+    """
+    Interpolate a shard and write its station sums to its part file
+
+    Parameters
+    job_directory: str
+    shard: dict - one of the shards of the job
+    workers: int, optional - processes interpolating the shard
+    download_workers: int, optional - see download_turnstile_data
+
+    Return
+    pandas.DataFrame - the station sums of the shard
+    """
+    job_directory = Path(job_directory)
+    job = _load_job(job_directory)
+    overlap = timedelta(seconds=job['overlap'])
+    start, end = pd.Timestamp(shard['start']), pd.Timestamp(shard['end'])
+    # no further than the date range of the job, so that its first and last
+    # windows are those of a single run
+    first = max(start - overlap, pd.Timestamp(job['start']))
+    last = min(end + overlap, pd.Timestamp(job['end']))
+
+    raw = turnstile.download_turnstile_data(
+        first, last, workers=download_workers,
+        cache_directory=job['cache_directory'], compact=job['compact'],
+        archive=job['archive'])
+    raw = raw[_unit_shards(raw['UNIT'], job['unit_shards']) == shard['unit_shard']]
+    _touch(job_directory, shard)
+
+    station_data = pd.DataFrame({
+        'datetime': pd.to_datetime([]), 'STATION': [], 'LINENAME': [],
+        'estimated_entries': np.zeros(0), 'estimated_exits': np.zeros(0)})
+    if not raw.empty:
+        interpolated = turnstile._interpolate_raw_data(
+            raw, first, last, job['group_by'], [job['frequency']],
+            job['engine'], workers, job['compact'])[job['frequency']]
+        times = interpolated.index
+        selected = (times >= start) & ((times <= end) if shard['last'] else (times < end))
+        if selected.any():
+            station_data = turnstile.sum_turnstile_data_by_station(interpolated[selected])
+    for c in STATION_COLUMNS[1:]:
+        station_data[c] = station_data[c].astype(str)
+    station_data = station_data.astype({'datetime': 'datetime64[ns]'})
+
+    # written in one step, a part is either missing or complete
+    part = job_directory / 'parts' / (shard['id'] + '.parquet')
+    station_data.to_parquet(str(part) + '.tmp', index=False)
+    os.replace(str(part) + '.tmp', part)
+    (job_directory / 'done' / (shard['id'] + '.json')).touch()
+    return station_data
+
+
+def run_worker(job_directory: str,
+               workers: int = 1,
+               download_workers: int = 1) -> int:
+    """
+    Process the queued shards of a job until the queue is empty
+
+    Parameters
+    job_directory: str
+    workers: int, optional - processes interpolating each shard
+    download_workers: int, optional - see download_turnstile_data
+
+    Return
+    int - the number of shards processed
+    """
+    job_directory = Path(job_directory)
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    processed = 0
+    while True:
+        shard = _claim(job_directory)
+        if shard is None:
+            logging.getLogger().info("Worker %s processed %d shards", worker, processed)
+            return processed
+        logging.getLogger().info("Worker %s processing shard %s", worker, shard['id'])
+        try:
+            process_shard(job_directory, shard, workers, download_workers)
+            processed += 1
+        except Exception:
+            logging.getLogger().exception("Shard %s failed", shard['id'])
+            with open(job_directory / 'failed' / (shard['id'] + '.txt'), 'w') as f:
+                f.write(worker + '\n' + traceback.format_exc())
+        _release(job_directory, shard)
+
+
+def start_local_workers(job_directory: str,
+                        processes: int,
+                        workers: int = 1,
+                        download_workers: int = 1) -> List[multiprocessing.Process]:
+    """
+    Start worker processes on this machine, see run_worker
+    """
+    started = []
+    for _ in range(processes):
+        process = multiprocessing.Process(
+            target=run_worker, args=(str(job_directory), workers, download_workers))
+        process.start()
+        started.append(process)
+    return started
+
+
+def job_status(job_directory: str) -> dict:
+    """
+    Number of shards of a job, and of its queued, claimed, done and failed
+    shards
+    """
+    job_directory = Path(job_directory)
+    shards = {s['id'] for s in _load_job(job_directory)['shards']}
+    status = {'shards': len(shards)}
+    for d, suffix in [('queue', '.json'), ('claimed', '.json'),
+                      ('done', '.json'), ('failed', '.txt')]:
+        status[d] = len({p.name[:-len(suffix)] for p in (job_directory / d).glob('*' + suffix)} & shards)
+    return status
+
+
+def requeue_expired(job_directory: str, lease: timedelta = LEASE) -> int:
+    """
+    Move the claimed shards not touched within the lease back to the queue
+
+    Return
+    int - the number of shards moved
+    """
+    job_directory = Path(job_directory)
+    expired = time.time() - lease.total_seconds()
+    moved = 0
+    for path in (job_directory / 'claimed').glob('*.json'):
+        try:
+            if path.stat().st_mtime >= expired or (job_directory / 'done' / path.name).exists():
+                continue
+            os.rename(path, job_directory / 'queue' / path.name)
+        except FileNotFoundError:
+            continue
+        logging.getLogger().info("Requeued expired shard %s", path.stem)
+        moved += 1
+    return moved
+
+
+def wait_for_job(job_directory: str,
+                 lease: timedelta = LEASE,
+                 poll: float = POLL,
+                 processes: List[multiprocessing.Process] = (),
+                 workers: int = 1,
+                 download_workers: int = 1):
+    """
+    Wait until all the shards of a job are done, requeueing the expired
+    claims. While no local worker process is running, the queued shards are
+    processed in this process.
+
+    Parameters
+    job_directory: str
+    lease: timedelta, optional
+    poll: float, optional - seconds between checks
+    processes: List[multiprocessing.Process], optional - see
+        start_local_workers
+    workers: int, optional - see run_worker
+    download_workers: int, optional - see run_worker
+    """
+    while True:
+        status = job_status(job_directory)
+        if status['failed']:
+            for p in processes:
+                p.join()
+            raise Exception(str(status['failed']) + " shards failed, see " +
+                            str(Path(job_directory) / 'failed'))
+        if status['done'] == status['shards']:
+            break
+        requeue_expired(job_directory, lease)
+        if status['queue'] and not any(p.is_alive() for p in processes):
+            run_worker(job_directory, workers, download_workers)
+            continue
+        time.sleep(poll)
+    for p in processes:
+        p.join()
+
+
+def merge_job(job_directory: str) -> pd.DataFrame:
+    """
+    Sum the parts of a job by station, in the order of the shards
+
+    Return
+    pandas.DataFrame - datetime, STATION, LINENAME, estimated_entries and
+    estimated_exits, like sum_turnstile_data_by_station
+    """
+    job_directory = Path(job_directory)
+    job = _load_job(job_directory)
+    missing = [s['id'] for s in job['shards']
+               if not (job_directory / 'done' / (s['id'] + '.json')).exists()]
+    if missing:
+        raise Exception(str(len(missing)) + " shards are not done, e.g. " + missing[0])
+    logging.getLogger().info("Merging %d parts", len(job['shards']))
+    parts = [pd.read_parquet(job_directory / 'parts' / (s['id'] + '.parquet'))
+             for s in job['shards']]
+    return pd.concat(parts, ignore_index=True).groupby(
+        STATION_COLUMNS, sort=True).sum(numeric_only=True).reset_index()
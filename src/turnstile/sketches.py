@@ -0,0 +1,303 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+from .turnstile import sum_turnstile_data_by_station
+
+# This module keeps the distribution of per-station ridership, per station,
+# month and hour of the week, without keeping the values:
+#
+#   sketches = RidershipSketches()
+#   for chunk in stream_interpolated_turnstile_data(...):
+#       sketches.add(sum_turnstile_data_by_station(chunk))
+#   sketches.quantiles([0.5, 0.9, 0.99], by=['hour_of_week'])
+#
+# The quantiles come from a sketch with logarithmic buckets (DDSketch): the
+# bucket of a value x is ceil(log(|x|) / log(gamma)) with
+# gamma = (1 + accuracy) / (1 - accuracy), and a quantile is estimated from
+# the bucket it falls in within a relative error of accuracy. Only the
+# number of values in each bucket is kept, so the sketches of chunks, of
+# months or of workers merge by adding their counts. The count, sum, sum of
+# squares, minimum and maximum are kept next to them for the moments.
+#
+# Both are tables of (STATION, LINENAME, month, hour_of_week, column) rows,
+# with a row per bucket for the sketches. Their size depends on the number
+# of stations and months, not on the number of values added.
+
+COLUMNS = ['estimated_entries', 'estimated_exits']
+KEYS = ['STATION', 'LINENAME', 'month', 'hour_of_week', 'column']
+# the keys a query can group by on top of the station
+GROUPS = ['month', 'hour_of_week']
+ACCURACY = 0.01
+# added to the logarithmic index of a bucket so that it is positive for any
+# value not rounded to 0, negative values have the negated bucket
+BIAS = 2**20
+META_FILE = 'sketches.json'
+
+
+class RidershipSketches:
+    """
+    Mergeable quantile sketches and moments of per-station ridership, see
+    the module comment
+
+    Parameters
+    accuracy: float, optional - relative accuracy of the quantiles
+    counts: pandas.DataFrame, optional - KEYS, bucket and count
+    moments: pandas.DataFrame, optional - KEYS, count, sum, sum_squares,
+        min and max
+    """
+
+    def __init__(self, accuracy: float = ACCURACY,
+                 counts: pd.DataFrame = None, moments: pd.DataFrame = None):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.counts = counts if counts is not None else pd.DataFrame(
+            columns=KEYS + ['bucket', 'count'])
+        self.moments = moments if moments is not None else pd.DataFrame(
+            columns=KEYS + ['count', 'sum', 'sum_squares', 'min', 'max'])
+        # tables added since the last consolidation
+        self._pending = []
+        self._pending_rows = 0
+
+    def _buckets(self, values: np.ndarray) -> np.ndarray:
+        magnitude = np.abs(values)
+        with np.errstate(divide='ignore'):
+            index = np.ceil(np.log(magnitude) / np.log(self.gamma))
+        buckets = np.where(magnitude > 0, np.maximum(index + BIAS, 1), 0).astype(np.int64)
+        return np.sign(values).astype(np.int64) * buckets
+
+    def _values(self, buckets: np.ndarray) -> np.ndarray:
+        # the value a bucket stands for, within the relative accuracy of all
+        # the values in it
+        index = np.abs(buckets) - BIAS
+        return np.sign(buckets) * 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, station_data: pd.DataFrame, columns: List[str] = COLUMNS):
+        """
+        Add the values of per-station data
+
+        Parameters
+        station_data: pandas.DataFrame - datetime, STATION, LINENAME and the
+            columns, e.g. the output of turnstile.sum_turnstile_data_by_station
+        columns: List[str], optional
+        """
+        station_data = station_data[station_data[['STATION', 'LINENAME']].notnull().all(axis=1)]
+        times = pd.DatetimeIndex(station_data['datetime'])
+        keys = pd.DataFrame({
+            'STATION': station_data['STATION'].astype(str).to_numpy(),
+            'LINENAME': station_data['LINENAME'].astype(str).to_numpy(),
+            'month': times.to_period('M').to_timestamp(),
+            'hour_of_week': (times.dayofweek * 24 + times.hour).to_numpy(),
+        })
+        for column in columns:
+            values = station_data[column].to_numpy(dtype=np.float64)
+            present = ~np.isnan(values)
+            values = values[present]
+            rows = keys[present].assign(column=column)
+            self._pending.append(('counts', rows.assign(bucket=self._buckets(values), count=1).groupby(
+                KEYS + ['bucket'], sort=False).sum().reset_index()))
+            self._pending.append(('moments', rows.assign(
+                count=1, sum=values, sum_squares=values ** 2, min=values, max=values).groupby(
+                    KEYS, sort=False).agg({'count': 'sum', 'sum': 'sum', 'sum_squares': 'sum',
+                                           'min': 'min', 'max': 'max'}).reset_index()))
+            self._pending_rows += len(self._pending[-2][1])
+        # consolidate when the pending tables outgrow the consolidated ones,
+        # so that each row is merged a bounded number of times
+        if self._pending_rows > max(len(self.counts), 100000):
+            self._consolidate()
+
+    def _consolidate(self):
+        if not self._pending:
+            return
+        counts = [self.counts] + [t for kind, t in self._pending if kind == 'counts']
+        moments = [self.moments] + [t for kind, t in self._pending if kind == 'moments']
+        self.counts = _merge_counts(counts)
+        self.moments = _merge_moments(moments)
+        self._pending = []
+        self._pending_rows = 0
+
+    def merge(self, other: 'RidershipSketches') -> 'RidershipSketches':
+        """
+        Add the values of other sketches, e.g. of another worker or date range
+        """
+        if other.accuracy != self.accuracy:
+            raise Exception("Can't merge sketches of accuracy " + str(other.accuracy) +
+                            " into sketches of accuracy " + str(self.accuracy))
+        other._consolidate()
+        self._pending += [('counts', other.counts), ('moments', other.moments)]
+        self._consolidate()
+        return self
+
+    def _select(self, table: pd.DataFrame, column: str,
+                stations: List[Tuple[str, str]] = None,
+                start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        selected = table['column'] == column
+        if stations is not None:
+            selected &= pd.MultiIndex.from_frame(table[['STATION', 'LINENAME']]).isin(stations)
+        if start is not None:
+            selected &= table['month'] >= pd.Timestamp(start)
+        if end is not None:
+            selected &= table['month'] < pd.Timestamp(end)
+        return table[selected]
+
+    def quantiles(self,
+                  quantiles: List[float] = [0.5, 0.9, 0.99],
+                  column: str = 'estimated_entries',
+                  stations: List[Tuple[str, str]] = None,
+                  start: datetime = None,
+                  end: datetime = None,
+                  by: List[str] = ['hour_of_week']) -> pd.DataFrame:
+        """
+        Quantiles of the values of each station
+
+        Parameters
+        quantiles: List[float], optional
+        column: str, optional
+        stations: List[(str, str)], optional - (STATION, LINENAME) pairs,
+            all stations if not specified
+        start: datetime, optional - the first month
+        end: datetime, optional - the month after the last one
+        by: List[str], optional - month and/or hour_of_week, the sketches of
+            the other keys are merged
+
+        Return
+        pandas.DataFrame - STATION, LINENAME, the keys of by and a column per
+        quantile, e.g. p50, p90 and p99
+        """
+        if set(by) - set(GROUPS):
+            raise Exception("Unsupported group by keys: " + str(by))
+        self._consolidate()
+        groups = ['STATION', 'LINENAME'] + list(by)
+        counts = self._select(self.counts, column, stations, start, end).groupby(
+            groups + ['bucket'], sort=True)['count'].sum().reset_index()
+        # the buckets sort in the order of their values within a group, the
+        # quantile is in the first bucket whose cumulative count, over all
+        # the groups, is past its rank
+        group = counts.groupby(groups, sort=False).ngroup().to_numpy()
+        starts = np.flatnonzero(np.diff(group, prepend=-1))
+        cumulative = np.cumsum(counts['count'].to_numpy(dtype=np.int64))
+        before = cumulative[starts] - counts['count'].to_numpy(dtype=np.int64)[starts]
+        totals = np.bincount(group, weights=counts['count'], minlength=len(starts))
+        result = counts.iloc[starts][groups].reset_index(drop=True)
+        buckets = counts['bucket'].to_numpy(dtype=np.int64)
+        for q in quantiles:
+            rank = before + q * (totals - 1)
+            result['p' + ('%g' % (q * 100)).replace('.', '_')] = self._values(
+                buckets[np.searchsorted(cumulative, rank, side='right')])
+        return result
+
+    def describe(self,
+                 column: str = 'estimated_entries',
+                 stations: List[Tuple[str, str]] = None,
+                 start: datetime = None,
+                 end: datetime = None,
+                 by: List[str] = ['hour_of_week']) -> pd.DataFrame:
+        """
+        Count, mean, standard deviation, min and max of the values of each
+        station, see quantiles for the parameters
+        """
+        if set(by) - set(GROUPS):
+            raise Exception("Unsupported group by keys: " + str(by))
+        self._consolidate()
+        groups = ['STATION', 'LINENAME'] + list(by)
+        moments = self._select(self.moments, column, stations, start, end).groupby(
+            groups, sort=True).agg({'count': 'sum', 'sum': 'sum', 'sum_squares': 'sum',
+                                    'min': 'min', 'max': 'max'})
+        mean = moments['sum'] / moments['count']
+        variance = (moments['sum_squares'] - moments['count'] * mean ** 2) / (moments['count'] - 1)
+        return pd.DataFrame({
+            'count': moments['count'],
+            'mean': mean,
+            'std': np.sqrt(variance.clip(lower=0)),
+            'min': moments['min'],
+            'max': moments['max'],
+        }).reset_index()
+
+    def save(self, path: str):
+        """
+        Save the sketches as parquet files under path
+        """
+        self._consolidate()
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        self.counts.to_parquet(path / 'counts.parquet', index=False)
+        self.moments.to_parquet(path / 'moments.parquet', index=False)
+        with open(path / META_FILE, 'w') as f:
+            json.dump({'accuracy': self.accuracy}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'RidershipSketches':
+        """
+        Load sketches saved under path
+        """
+        path = Path(path)
+        with open(path / META_FILE) as f:
+            meta = json.load(f)
+        return cls(meta['accuracy'], pd.read_parquet(path / 'counts.parquet'),
+                   pd.read_parquet(path / 'moments.parquet'))
+
+
+def _merge_counts(tables: List[pd.DataFrame]) -> pd.DataFrame:
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return pd.DataFrame(columns=KEYS + ['bucket', 'count'])
+    return pd.concat(tables, ignore_index=True).groupby(
+        KEYS + ['bucket'], sort=True)['count'].sum().reset_index()
+
+
+def _merge_moments(tables: List[pd.DataFrame]) -> pd.DataFrame:
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return pd.DataFrame(columns=KEYS + ['count', 'sum', 'sum_squares', 'min', 'max'])
+    return pd.concat(tables, ignore_index=True).groupby(KEYS, sort=True).agg(
+        {'count': 'sum', 'sum': 'sum', 'sum_squares': 'sum',
+         'min': 'min', 'max': 'max'}).reset_index()
+
+
+def merge_sketches(paths: List[str], output: str = None) -> RidershipSketches:
+    """
+    Merge the sketches saved under several paths, e.g. by workers processing
+    different stations or date ranges
+
+    Parameters
+    paths: List[str]
+    output: str, optional - save the merged sketches there
+
+    Return
+    RidershipSketches
+    """
+    merged = RidershipSketches.load(paths[0])
+    for path in paths[1:]:
+        merged.merge(RidershipSketches.load(path))
+    logging.getLogger().info("Merged %d sketches into %d buckets", len(paths), len(merged.counts))
+    if output is not None:
+        merged.save(output)
+    return merged
+
+
+class SketchWriter:
+    """
+    Sink for stream_interpolated_turnstile_data that aggregates each chunk by
+    station and adds it to sketches saved under path when closed. The
+    turnstile data needs the STATION and LINENAME columns.
+
+    Parameters
+    path: str
+    accuracy: float, optional
+    """
+
+    def __init__(self, path: str, accuracy: float = ACCURACY):
+        self.path = path
+        self.sketches = RidershipSketches(accuracy)
+
+    def write(self, chunk: pd.DataFrame):
+        self.sketches.add(sum_turnstile_data_by_station(chunk))
+
+    def close(self) -> RidershipSketches:
+        self.sketches.save(self.path)
+        return self.sketches
@@ -0,0 +1,178 @@
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from datetime import datetime
+from typing import List, Tuple
+
+from .turnstile import sum_turnstile_data_by_station
+from .writer import station_file_name
+
+# This module stores per-station turnstile data as a parquet dataset
+# partitioned by station and month:
+#
+#   <path>/station=59_ST_NQR456W/month=2019-03/part-0.parquet
+#
+# Queries only open the files of the requested stations and months, read only
+# the requested columns, and skip the row groups outside the requested time
+# range using the datetime statistics of each file.
+
+SCHEMA = pa.schema([
+    ('datetime', pa.timestamp('ns')),
+    ('STATION', pa.dictionary(pa.int32(), pa.string())),
+    ('LINENAME', pa.dictionary(pa.int32(), pa.string())),
+    ('estimated_entries', pa.int32()),
+    ('estimated_exits', pa.int32()),
+    ('station', pa.string()),
+    ('month', pa.string()),
+])
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('station', pa.string()), ('month', pa.string())]),
+    flavor='hive')
+
+COMPRESSION = 'zstd'
+
+
+def _station_key(station: Tuple[str, str]) -> str:
+    # the name of the station's CSV file, without the extension
+    return station_file_name(station)[:-len('.csv')]
+
+
+def _month(time: datetime) -> str:
+    return time.strftime('%Y-%m')
+
+
+def _station_keys(station_data: pd.DataFrame) -> np.ndarray:
+    # the station key of every row, named once per station
+    stations = station_data[['STATION', 'LINENAME']].drop_duplicates()
+    keys = pd.Series(
+        [_station_key(s) for s in stations.itertuples(index=False)],
+        index=pd.MultiIndex.from_frame(stations))
+    return keys.reindex(pd.MultiIndex.from_frame(
+        station_data[['STATION', 'LINENAME']])).values
+
+
+def _to_table(station_data: pd.DataFrame) -> pa.Table:
+    # the datetime can be a column or the index
+    station_data = station_data.reset_index(
+        drop='datetime' in station_data.columns)
+    table = pd.DataFrame({
+        'datetime': station_data['datetime'].values,
+        'STATION': station_data['STATION'].values,
+        'LINENAME': station_data['LINENAME'].values,
+        'estimated_entries': station_data['estimated_entries'].round().astype('Int32'),
+        'estimated_exits': station_data['estimated_exits'].round().astype('Int32'),
+        'station': _station_keys(station_data),
+        'month': station_data['datetime'].dt.strftime('%Y-%m').values,
+    }).sort_values(['station', 'datetime'])
+    return pa.Table.from_pandas(table, schema=SCHEMA, preserve_index=False)
+
+
+def write_station_store(station_data: pd.DataFrame,
+                        path: str,
+                        basename_template: str = None,
+                        replace: bool = True):
+    """
+    Write per-station turnstile data to a parquet dataset partitioned by
+    station and month
+
+    Parameters
+    station_data: pandas.DataFrame - datetime, STATION, LINENAME,
+        estimated_entries and estimated_exits, e.g. the output of
+        sum_turnstile_data_by_station
+    path: str - root directory of the dataset
+    basename_template: str, optional - names of the files written, '{i}' is
+        replaced by a counter
+    replace: bool, optional - If True, the existing data of the station
+        months written is deleted. Otherwise the files are added to it.
+
+    """
+    logging.getLogger().info("Writing station data to %s", path)
+    ds.write_dataset(
+        _to_table(station_data),
+        str(path),
+        basename_template=basename_template,
+        format='parquet',
+        partitioning=PARTITIONING,
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression=COMPRESSION),
+        existing_data_behavior='delete_matching' if replace else 'overwrite_or_ignore')
+
+
+def read_station_store(path: str,
+                       stations: List[Tuple[str, str]] = None,
+                       start_date: datetime = None,
+                       end_date: datetime = None,
+                       columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read per-station turnstile data from a dataset written by
+    write_station_store
+
+    Only the files of the requested stations and months are opened, and only
+    the requested columns are read.
+
+    Parameters
+    path: str - root directory of the dataset
+    stations: List[(str, str)], optional - (STATION, LINENAME) pairs, all
+        stations if not specified
+    start_date: datetime, optional
+    end_date: datetime, optional - inclusive
+    columns: List[str], optional - all columns if not specified
+
+    Return
+    pandas.DataFrame
+
+    """
+    dataset = ds.dataset(str(path), format='parquet', partitioning=PARTITIONING)
+    conditions = []
+    if stations is not None:
+        conditions.append(ds.field('station').isin(
+            [_station_key(s) for s in stations]))
+    if start_date is not None:
+        conditions.append(ds.field('month') >= _month(start_date))
+        conditions.append(ds.field('datetime') >= pa.scalar(
+            pd.Timestamp(start_date), type=pa.timestamp('ns')))
+    if end_date is not None:
+        conditions.append(ds.field('month') <= _month(end_date))
+        conditions.append(ds.field('datetime') <= pa.scalar(
+            pd.Timestamp(end_date), type=pa.timestamp('ns')))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+class StoreWriter:
+    """
+    Sink for stream_interpolated_turnstile_data that aggregates each chunk by
+    station and adds it to a parquet dataset partitioned by station and month.
+    The data a previous run wrote to a station month is replaced the first
+    time the month is written. The turnstile data needs the STATION and
+    LINENAME columns.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks = 0
+        # (station, month) partitions written so far
+        self.partitions = set()
+
+    def write(self, chunk: pd.DataFrame):
+        aggregated = sum_turnstile_data_by_station(chunk)
+        if aggregated.empty:
+            return
+        partitions = pd.Series(list(zip(
+            _station_keys(aggregated),
+            aggregated['datetime'].dt.strftime('%Y-%m'))))
+        written = partitions.isin(self.partitions).values
+        for replace, selected in ((True, ~written), (False, written)):
+            if selected.any():
+                write_station_store(
+                    aggregated[selected], self.path,
+                    basename_template='chunk-%d-{i}.parquet' % self.chunks,
+                    replace=replace)
+        self.partitions.update(partitions)
+        self.chunks += 1
@@ -0,0 +1,231 @@
+import logging
+import pandas as pd
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List
+
+from .. import profiling
+from .cleaning import CleaningRules, DEFAULT_RULES, clean_counters
+from .turnstile import ENGINES, MTA_TURNSTILE_URL, _iterate_turnstile_files, \
+    _process_raw_data, _select_dates, sum_turnstile_data_by_station
+from .writer import split_by_station, station_file_name
+
+# This module processes turnstile data one weekly file at a time, so memory
+# use doesn't grow with the date range. Between weeks only the boundary state
+# of each turnstile is kept: its snapshots of the last OVERLAP before the
+# point up to which the output is final, and its last snapshot.
+
+# context kept on both sides of a chunk boundary. Far enough from its edges
+# the interpolation of a chunk is the same as that of the whole date range.
+OVERLAP = timedelta(days=2)
+
+
+def _combine(carried: pd.DataFrame,
+             processed: pd.DataFrame,
+             group_by: List[str]) -> pd.DataFrame:
+    if carried is None:
+        return processed
+    # snapshots present in both are summed, as _process_raw_data does
+    return pd.concat([carried, processed]).groupby(
+        group_by + ['datetime']).sum().reset_index().set_index('datetime')
+
+
+def _boundary_state(combined: pd.DataFrame,
+                    group_by: List[str],
+                    since: datetime) -> pd.DataFrame:
+    # the recent snapshots, and the last one of every turnstile so that the
+    # first difference after a silent period is still taken
+    last = ~combined.duplicated(subset=group_by, keep='last')
+    return combined[(combined.index >= since) | last]
+
+
+def _window(interpolated: pd.DataFrame,
+            start: datetime,
+            end: datetime = None,
+            include_end: bool = True) -> pd.DataFrame:
+    times = interpolated.index
+    selected = times >= start
+    if end is not None:
+        selected &= (times <= end) if include_end else (times < end)
+    return interpolated[selected].drop(columns=["entry_diffs", "exit_diffs"])
+
+
+class TurnstileStream:
+    """
+    Week by week interpolation of turnstile data, see
+    stream_interpolated_turnstile_data.
+
+    The state between weeks is in carried (the boundary snapshots), emitted
+    (the time up to which the output is final) and links (the weekly files
+    processed so far). A stream can be resumed from that state, with the
+    same parameters, to process the weekly files published since.
+    """
+
+    def __init__(self,
+                 start_date: datetime,
+                 end_date: datetime = None,
+                 group_by: List[str] = ['UNIT', 'SCP'],
+                 frequency: str = '1H',
+                 engine: str = 'pandas',
+                 overlap: timedelta = OVERLAP,
+                 base_url: str = MTA_TURNSTILE_URL,
+                 cache_directory: str = None,
+                 carried: pd.DataFrame = None,
+                 emitted: datetime = None,
+                 links: List[str] = None,
+                 cleaning_rules: CleaningRules = DEFAULT_RULES,
+                 archive: str = None):
+        if not set(group_by).issubset(['STATION', 'LINENAME', 'UNIT', 'SCP']):
+            raise Exception("Unsupported group by keys: " + str(group_by))
+        if engine not in ENGINES:
+            raise Exception("Unsupported engine: " + str(engine))
+        self.start_date = start_date
+        self.end_date = end_date
+        self.group_by = group_by
+        self.frequency = frequency
+        self.engine = engine
+        self.overlap = overlap
+        self.base_url = base_url
+        self.cache_directory = cache_directory
+        self.carried = carried
+        self.emitted = emitted or start_date
+        self.links = list(links or [])
+        self.cleaning_rules = cleaning_rules
+        self.archive = archive
+        self._interpolated = None
+
+    def _interpolate(self, processed: pd.DataFrame) -> pd.DataFrame:
+        with profiling.span('streaming.clean', rows_in=len(processed)) as span:
+            cleaned, _ = span.output(clean_counters(
+                processed, self.group_by, self.cleaning_rules))
+        with profiling.span('streaming.interpolate', rows_in=len(cleaned),
+                            engine=self.engine) as span:
+            return span.output(ENGINES[self.engine](
+                cleaned, self.group_by, self.frequency))
+
+    def final_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Interpolate the weekly files not processed yet, yielding the
+        intervals that later weeks can no longer change
+        """
+        for link, raw in _iterate_turnstile_files(
+                self.start_date, self.end_date, self.base_url,
+                self.cache_directory, skip_links=set(self.links),
+                archive=self.archive):
+            self.links.append(link)
+            raw = _select_dates(raw, self.start_date, self.end_date)
+            if raw.empty:
+                continue
+            with profiling.span('streaming.process', rows_in=len(raw),
+                                link=link) as span:
+                processed = _process_raw_data(raw, self.group_by)[
+                    self.group_by + ['ENTRIES', 'EXITS']]
+                combined = span.output(
+                    _combine(self.carried, processed, self.group_by))
+            self._interpolated = self._interpolate(combined)
+
+            # intervals more than the overlap before the last snapshot are
+            # final
+            horizon = (combined.index.max() - self.overlap).floor(
+                self.frequency)
+            if horizon > self.emitted:
+                chunk = _window(self._interpolated, self.emitted, horizon,
+                                include_end=False)
+                if self.end_date is not None:
+                    chunk = chunk[chunk.index <= self.end_date]
+                logging.getLogger().info(
+                    "Interpolated turnstile data until %s", horizon)
+                yield chunk
+                self.emitted = horizon
+            self.carried = _boundary_state(
+                combined, self.group_by, self.emitted - self.overlap)
+
+    def remaining(self) -> pd.DataFrame:
+        """
+        The intervals after the final ones, up to the last snapshot. They
+        can still change when more weeks are processed.
+        """
+        if self._interpolated is None:
+            if self.carried is None:
+                return None
+            self._interpolated = self._interpolate(self.carried)
+        return _window(self._interpolated, self.emitted, self.end_date)
+
+
+def stream_interpolated_turnstile_data(
+        start_date: datetime,
+        end_date: datetime = None,
+        group_by: List[str] = ['UNIT', 'SCP'],
+        frequency: str = '1H',
+        engine: str = 'pandas',
+        overlap: timedelta = OVERLAP,
+        base_url: str = MTA_TURNSTILE_URL,
+        cache_directory: str = None,
+        cleaning_rules: CleaningRules = DEFAULT_RULES,
+        archive: str = None) -> Iterator[pd.DataFrame]:
+    """
+    Create interpolated turnstile data week by week
+
+    Streaming version of create_interpolated_turnstile_data. The weekly files
+    are downloaded and interpolated one at a time, together with the boundary
+    state carried over from the previous weeks. Each chunk covers the time
+    window following the previous one, so all turnstiles of an interval are
+    in the same chunk.
+
+    The cleaning rules see the snapshots of the current window only, an
+    adaptive ceiling is estimated from them rather than the whole date range.
+
+    Of a turnstile that is silent for longer than the overlap only the last
+    snapshot is kept: when it reports again, the interpolated points of the
+    silent period that precede the current window are not produced.
+
+    Parameters
+    start_date : datetime
+    end_date : datetime, optional
+    group_by : List(str), optional
+    frequency: str, optional - a frequency that divides a day, e.g. 1H or 15T
+    engine: str, optional
+    overlap: timedelta, optional
+    base_url: str, optional
+    cache_directory: str, optional
+    cleaning_rules: CleaningRules, optional
+    archive: str, optional - read the weekly files from this local mirror
+        instead of downloading them, see turnstile.read_turnstile_archive
+
+    Returns
+    Iterator of dataframes, with the same columns as the output of
+    create_interpolated_turnstile_data
+
+    """
+    stream = TurnstileStream(start_date, end_date, group_by, frequency,
+                             engine, overlap, base_url, cache_directory,
+                             cleaning_rules=cleaning_rules, archive=archive)
+    yield from stream.final_chunks()
+    remaining = stream.remaining()
+    if remaining is not None:
+        yield remaining
+
+
+class StationWriter:
+    """
+    Sink for stream_interpolated_turnstile_data that aggregates each chunk by
+    station and appends it to one CSV per station, named as the keys of
+    aggregate_turnstile_data_by_station. The turnstile data needs the STATION
+    and LINENAME columns.
+    """
+
+    def __init__(self, output_directory: str, files: List[Path] = None):
+        self.output_directory = Path(output_directory)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        # files already started, later chunks are appended to them
+        self.files = list(files or [])
+
+    def write(self, chunk: pd.DataFrame):
+        aggregated = sum_turnstile_data_by_station(chunk)
+        for station, df in split_by_station(aggregated):
+            path = self.output_directory / station_file_name(station)
+            new = path not in self.files
+            df.to_csv(path, mode='w' if new else 'a', header=new, index=False)
+            if new:
+                self.files.append(path)
@@ -0,0 +1,226 @@
+import logging
+import numpy as np
+import os
+import pandas as pd
+import threading
+
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+from .cleaning import COUNTER_RANGE
+
+# This module generates synthetic turnstile data in the format of the MTA
+# weekly files, and serves it over HTTP like http://web.mta.info/developers/
+# so that the pipeline can be run and timed offline:
+#
+#   build_turnstile_site('/tmp/site', datetime(2020, 1, 4), weeks=4)
+#   server, base_url = serve_turnstile_site('/tmp/site')
+#   turnstile.download_turnstile_data(start, end, base_url=base_url)
+
+RAW_COLUMNS = ['C/A', 'UNIT', 'SCP', 'STATION', 'LINENAME', 'DIVISION',
+               'DATE', 'TIME', 'DESC', 'ENTRIES', 'EXITS']
+# the header of the MTA files pads EXITS with whitespace
+RAW_HEADER = RAW_COLUMNS[:-1] + ['EXITS' + ' ' * 62]
+
+LINENAMES = ['1', '23', '456', 'ACE', 'BDFM', 'G', 'JZ', 'L', 'NQRW', '7']
+AUDIT_INTERVAL = timedelta(hours=4)
+
+# relative traffic of each hour of the day
+HOURLY_PROFILE = np.array([1, 0.5, 0.3, 0.3, 0.5, 1.5, 4, 8, 10, 7, 5, 5,
+                           5.5, 5.5, 5.5, 6.5, 8, 10, 8, 5, 3.5, 3, 2.5, 1.5])
+
+
+def _format_unique(times: np.ndarray, pattern: str, unit: str) -> np.ndarray:
+    # format each distinct day or time of day once
+    if unit == 'D':
+        values = times.astype('datetime64[D]')
+    else:
+        values = times - times.astype('datetime64[D]') + np.datetime64('2000-01-01')
+    unique, inverse = np.unique(values, return_inverse=True)
+    return pd.DatetimeIndex(unique).strftime(pattern).to_numpy()[inverse]
+
+
+def generate_turnstile_data(start_date: datetime,
+                            end_date: datetime,
+                            units: int = 50,
+                            scps: int = 4,
+                            seed: int = 0,
+                            jitter: timedelta = timedelta(minutes=20),
+                            hourly_entries: float = 60,
+                            duplicate_rate: float = 0.005,
+                            reset_rate: float = 0.001,
+                            overflow_rate: float = 0.01) -> pd.DataFrame:
+    """
+    Generate raw turnstile data
+
+    Each turnstile reports every AUDIT_INTERVAL, shifted by a random offset
+    and jittered, with counts following HOURLY_PROFILE. Some snapshots are
+    repeated, some counters reset to a small value, and some start close to
+    COUNTER_RANGE so that they wrap around.
+
+    Parameters
+    start_date: datetime
+    end_date: datetime
+    units: int, optional - number of remote units, 3 per station
+    scps: int, optional - number of turnstiles per unit
+    seed: int, optional
+    jitter: timedelta, optional - largest shift of a snapshot
+    hourly_entries: float, optional - mean entries per turnstile and hour
+    duplicate_rate: float, optional - share of snapshots reported twice
+    reset_rate: float, optional - share of snapshots after a counter reset
+    overflow_rate: float, optional - share of turnstiles that wrap around
+
+    Return
+    pandas.DataFrame with the columns of the weekly files
+
+    """
+    rng = np.random.default_rng(seed)
+    turnstiles = units * scps
+    step = int(AUDIT_INTERVAL.total_seconds())
+    snapshots = int((end_date - start_date).total_seconds()) // step + 1
+
+    # seconds since start_date, irregular but increasing
+    offsets = rng.integers(0, step, turnstiles)[:, None]
+    largest_shift = int(jitter.total_seconds())
+    shifts = rng.integers(-largest_shift, largest_shift + 1,
+                          (turnstiles, snapshots))
+    seconds = offsets + np.arange(snapshots) * step + shifts
+    times = np.datetime64(start_date, 's') + seconds.astype('timedelta64[s]')
+
+    hours = ((seconds // 3600) + start_date.hour) % 24
+    rate = HOURLY_PROFILE[hours] / HOURLY_PROFILE.mean()
+    counters = {}
+    for column, scale in [('ENTRIES', 1.0), ('EXITS', 0.8)]:
+        counts = rng.poisson(hourly_entries * scale * rate * step / 3600)
+        counts[:, 0] = 0
+        total = np.cumsum(counts, axis=1)
+        # after a reset the counter starts again from a small value
+        reset = rng.random((turnstiles, snapshots)) < reset_rate
+        reset[:, 0] = True
+        base = np.where(reset, rng.integers(0, 10**8, (turnstiles, snapshots)), 0)
+        base[:, 0] = rng.integers(0, 10**9, turnstiles)
+        overflow = rng.random(turnstiles) < overflow_rate
+        base[overflow, 0] = COUNTER_RANGE - total[overflow, -1] // 2
+        last_reset = np.maximum.accumulate(
+            np.where(reset, np.arange(snapshots), 0), axis=1)
+        rows = np.arange(turnstiles)[:, None]
+        counters[column] = (base[rows, last_reset] + total -
+                            total[rows, last_reset]) % COUNTER_RANGE
+
+    unit = np.repeat(np.arange(units), scps)
+    scp = np.tile(np.arange(scps), units)
+    keep = ((times >= np.datetime64(start_date)) &
+            (times <= np.datetime64(end_date))).ravel()
+    repeat = np.where(rng.random(keep.shape) < duplicate_rate, 2, 1)[keep]
+    index = np.repeat(np.flatnonzero(keep), repeat)
+    turnstile = index // snapshots
+    stamps = times.ravel()[index]
+    station = np.arange(units) // 3
+
+    def names(pattern, values):
+        return np.array([pattern % v for v in values])
+
+    data = pd.DataFrame({
+        'C/A': names('A%03d', range(units))[unit[turnstile]],
+        'UNIT': names('R%03d', range(units))[unit[turnstile]],
+        'SCP': names('00-00-%02d', range(scps))[scp[turnstile]],
+        'STATION': names('STATION %d', station)[unit[turnstile]],
+        'LINENAME': np.array(LINENAMES)[station % len(LINENAMES)][unit[turnstile]],
+        'DIVISION': 'IRT',
+        'DATE': _format_unique(stamps, '%m/%d/%Y', 'D'),
+        'TIME': _format_unique(stamps, '%H:%M:%S', 's'),
+        'DESC': 'REGULAR',
+        'ENTRIES': counters['ENTRIES'].ravel()[index],
+        'EXITS': counters['EXITS'].ravel()[index],
+    })
+    return data
+
+
+def _weekly_file_name(week: datetime) -> str:
+    return 'data/nyct/turnstile/turnstile_%s.txt' % week.strftime('%y%m%d')
+
+
+def write_weekly_files(raw: pd.DataFrame,
+                       directory: str,
+                       weeks: List[datetime]) -> List[Tuple[datetime, str]]:
+    """
+    Split raw turnstile data into weekly files, the file of a week has the
+    snapshots of the 7 days before it
+
+    Parameters
+    raw: pandas.DataFrame - output of generate_turnstile_data
+    directory: str - root of the site
+    weeks: List[datetime] - the dates of the files
+
+    Return
+    List[(datetime, str)] - date and link of each file
+
+    """
+    os.makedirs(os.path.join(directory, 'data/nyct/turnstile'), exist_ok=True)
+    dates = pd.to_datetime(raw['DATE'], format='%m/%d/%Y')
+    files = []
+    for week in weeks:
+        selected = (dates >= week - timedelta(days=7)) & (dates < week)
+        link = _weekly_file_name(week)
+        raw[selected].to_csv(os.path.join(directory, link), index=False,
+                             header=RAW_HEADER)
+        files.append((week, link))
+    return files
+
+
+def build_turnstile_site(directory: str,
+                         first_week: datetime,
+                         weeks: int = 4,
+                         **generator_args) -> List[Tuple[datetime, str]]:
+    """
+    Write synthetic weekly files and the turnstile.html index linking them
+
+    Parameters
+    directory: str
+    first_week: datetime - date of the first weekly file, a Saturday for
+        the MTA files
+    weeks: int, optional
+    generator_args - passed to generate_turnstile_data
+
+    Return
+    List[(datetime, str)] - date and link of each weekly file
+
+    """
+    dates = [first_week + timedelta(days=7 * w) for w in range(weeks)]
+    raw = generate_turnstile_data(dates[0] - timedelta(days=7), dates[-1],
+                                  **generator_args)
+    files = write_weekly_files(raw, directory, dates)
+    # the index lists the newest week first, as the MTA page does
+    links = ['<a href="%s">%s</a><br/>' % (link, week.strftime('%A, %B %d, %Y'))
+             for week, link in reversed(files)]
+    with open(os.path.join(directory, 'turnstile.html'), 'w') as f:
+        f.write('<html><body>\n' + '\n'.join(links) + '\n</body></html>')
+    logging.getLogger().info("Wrote %d rows in %d weekly files to %s",
+                             len(raw), len(files), directory)
+    return files
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_turnstile_site(directory: str) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Serve a directory written by build_turnstile_site on a local port, in a
+    background thread
+
+    Parameters
+    directory: str
+
+    Return
+    (ThreadingHTTPServer, str) - the server, to shutdown() when done, and the
+    base url to pass to download_turnstile_data
+
+    """
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(_QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
@@ -1,28 +1,65 @@
 import bisect
-import io
 import logging
 import numpy as np
 import os
 import pandas as pd
 import re
 import requests
+import zipfile
 
 from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from html.parser import HTMLParser
-from typing import List, Dict
+from pandas.api.types import union_categoricals
+from requests.adapters import HTTPAdapter
+from scipy.interpolate import interp1d
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from urllib3.util.retry import Retry
+
+from . import cleaning, vectorized
+from .. import profiling
+from .cleaning import CleaningRules, DEFAULT_RULES
+from .writer import _write_slices, split_by_station, station_file_name
 
 # This module provides methods that handles MTA turnstile data
 
 
+def _factorize(values: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), values.cat.categories
+    return pd.factorize(values)
+
+
+def _build_timestamps(raw_data: pd.DataFrame) -> np.ndarray:
+    """
+    The datetime64 values of the DATE and TIME columns
+
+    A weekly file has a handful of dates and a few hundred distinct times,
+    each of them is parsed once and the timestamps are added up from their
+    codes.
+    """
+    date_codes, dates = _factorize(raw_data['DATE'])
+    time_codes, times = _factorize(raw_data['TIME'])
+    days = pd.to_datetime(dates, format="%m/%d/%Y").asi8
+    seconds = pd.to_timedelta(times).asi8
+    timestamps = days[date_codes] + seconds[time_codes]
+    timestamps[(date_codes < 0) | (time_codes < 0)] = np.iinfo(np.int64).min
+    return timestamps.view('datetime64[ns]')
+
+
+def _timestamps(raw_data: pd.DataFrame) -> np.ndarray:
+    # reuse the timestamps built by _select_dates
+    if 'datetime' in raw_data.columns:
+        return raw_data['datetime'].to_numpy()
+    return _build_timestamps(raw_data)
+
+
 def _process_raw_data(raw_data: pd.DataFrame, group_by: List[str]) -> pd.DataFrame:
     logging.getLogger().info("Cleaning turnstile data")
 
     # create datetime from DATE and TIME columns
-    processed = raw_data.assign(
-        datetime=pd.to_datetime(
-            raw_data['DATE'] + " " + raw_data['TIME'],
-            format="%m/%d/%Y %H:%M:%S"))
+    processed = raw_data.assign(datetime=_timestamps(raw_data))
 
     # remove mysterious duplicate index along STATION + UNIT
     processed = processed.groupby(
@@ -38,49 +75,103 @@ def _process_raw_data(raw_data: pd.DataFrame, group_by: List[str]) -> pd.DataFra
     return processed
 
 
-def _process_grouped_data(grouped: pd.DataFrame,
-                          frequency: str) -> pd.DataFrame:
-    # calculate the diff and take the absolute value
-    entry_diffs = grouped.ENTRIES.diff()
-    exit_diffs = grouped.EXITS.diff()
-
-    # clean up data
-    # grouped.loc[entry_diffs < 0, 'entry_diffs'] = np.nan
-    # grouped.loc[exit_diffs < 0, 'exit_diffs'] = np.nan
-    # grouped.loc[entry_diffs > 10000, 'entry_diffs'] = np.nan
-    # grouped.loc[exit_diffs > 10000, 'exit_diffs'] = np.nan
-
-    entry_diffs = pd.Series([np.nan if (x < 0)|(x>10000) else x for x in entry_diffs])
-    exit_diffs = pd.Series([np.nan if (x < 0)|(x>10000) else x for x in exit_diffs])
-
-    # restore cumulative data
-    cleaned_entries = entry_diffs.cumsum()
-    cleaned_exits = exit_diffs.cumsum()
-
-    # assign new columns
-    grouped = grouped.assign(
-        entry_diffs=entry_diffs.values,
-        exit_diffs=exit_diffs.values,
-        cleaned_entries=cleaned_entries.values,
-        cleaned_exits=cleaned_exits.values,
-    )
+# columns kept by the compact ingest: the supported group by keys, the time of
+# the snapshot and the counters
+COMPACT_KEYS = ['UNIT', 'SCP', 'STATION', 'LINENAME']
+COMPACT_COLUMNS = COMPACT_KEYS + ['DATE', 'TIME', 'ENTRIES', 'EXITS']
+
+
+def _compact_counter(counter: pd.Series) -> pd.Series:
+    # the counters have 10 digits at most, most fit in 32 bits
+    counter = pd.to_numeric(counter)
+    if counter.max() <= np.iinfo(np.int32).max and \
+            counter.min() >= np.iinfo(np.int32).min:
+        return counter.astype(np.int32)
+    return counter.astype(np.int64)
 
+
+def _compact_raw_data(raw_data: pd.DataFrame) -> pd.DataFrame:
+    # the header of the weekly files pads some of the names with whitespace
+    raw_data = raw_data.rename(columns=lambda c: c.strip())
+    return pd.DataFrame({
+        c: raw_data[c].astype('category') if c not in ('ENTRIES', 'EXITS')
+        else _compact_counter(raw_data[c])
+        for c in COMPACT_COLUMNS})
+
+
+def _concat_compact(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    # pd.concat turns categoricals with different categories into objects,
+    # the union of the categories is shared by all frames instead
+    columns = {}
+    for c in COMPACT_COLUMNS:
+        if c in ('ENTRIES', 'EXITS'):
+            columns[c] = np.concatenate([f[c].to_numpy() for f in frames])
+        else:
+            columns[c] = union_categoricals([f[c] for f in frames],
+                                            sort_categories=True)
+    return pd.DataFrame(columns)
+
+
+def _process_compact_data(raw_data: pd.DataFrame,
+                          group_by: List[str]) -> pd.DataFrame:
+    logging.getLogger().info("Cleaning compact turnstile data")
+
+    times = _timestamps(raw_data)
+
+    # sort by turnstile and time, the categories are sorted so their codes
+    # sort in the same order as the keys. lexsort is stable, of duplicate
+    # snapshots the first one in the raw data is kept.
+    codes = [raw_data[key].cat.codes.to_numpy() for key in group_by]
+    order = np.lexsort([times] + codes[::-1])
+    duplicated = np.zeros(len(order), dtype=bool)
+    if len(order):
+        duplicated[1:] = times[order[1:]] == times[order[:-1]]
+        for c in codes:
+            duplicated[1:] &= c[order[1:]] == c[order[:-1]]
+    order = order[~duplicated]
+
+    processed = raw_data[group_by + ['ENTRIES', 'EXITS']].iloc[order]
+    processed.index = pd.DatetimeIndex(times[order], name='datetime')
+    return processed
+
+
+def _fit_splines(grouped: pd.DataFrame) -> Dict[str, interp1d]:
+    # the quadratic splines of the cleaned counters of a turnstile with more
+    # than 2 snapshots, fitted as interpolate(method='quadratic') does. They
+    # don't depend on the frequency, so several frequencies share them.
+    splines = {}
+    for column in ['cleaned_entries', 'cleaned_exits']:
+        valid = grouped[column].notnull().to_numpy()
+        if valid.sum() > 2:
+            splines[column] = interp1d(grouped.index.asi8[valid],
+                                       grouped[column].to_numpy()[valid],
+                                       kind='quadratic', fill_value=np.nan,
+                                       bounds_error=False)
+    return splines
+
+
+def _process_grouped_data(grouped: pd.DataFrame,
+                          frequency: str,
+                          splines: Dict[str, interp1d] = None) -> pd.DataFrame:
+    # the differences and the cleaned cumulative counts come from
+    # cleaning.clean_counters
+    if splines is None:
+        splines = _fit_splines(grouped)
     resampled = grouped.resample(frequency).asfreq()
     interpolated_group = pd.concat([resampled, grouped])
     interpolated_group = interpolated_group.loc[~interpolated_group.index.duplicated(
         keep='first')]
     interpolated_group = interpolated_group.sort_index(ascending=True)
-    if interpolated_group[interpolated_group.cleaned_entries.notnull()].shape[0] > 2:
-        interpolated_group.cleaned_entries.interpolate(
-            method='quadratic', inplace=True)
-    else:
-        interpolated_group.cleaned_entries.interpolate(
-            method='linear', inplace=True)
-
-    if interpolated_group[interpolated_group.cleaned_exits.notnull()].shape[0] > 2:
-        interpolated_group.cleaned_exits.interpolate(method='quadratic', inplace=True)
-    else:
-        interpolated_group.cleaned_exits.interpolate(method='linear', inplace=True)
+    for column in ['cleaned_entries', 'cleaned_exits']:
+        if column in splines:
+            # the gaps after the first snapshot, past the last one the
+            # spline is NaN
+            values = interpolated_group[column]
+            missing = (values.isnull() & values.notnull().cummax()).to_numpy()
+            interpolated_group.loc[missing, column] = splines[column](
+                interpolated_group.index.asi8[missing])
+        else:
+            interpolated_group[column].interpolate(method='linear', inplace=True)
 
     interpolated_group = interpolated_group.assign(
         estimated_entries=interpolated_group.cleaned_entries.diff().round(),
@@ -101,9 +192,12 @@ def _interpolate(intervalized_data: pd.DataFrame,
                  group_by: List[str],
                  frequency: str) -> pd.DataFrame:
     logging.getLogger().info("Start interpolating turnstile data")
+    if 'cleaned_entries' not in intervalized_data.columns:
+        intervalized_data, _ = cleaning.clean_counters(intervalized_data,
+                                                       group_by)
 
     interpolated = []
-    intervalized_data.groupby(group_by).apply(
+    intervalized_data.groupby(group_by, observed=True).apply(
         lambda g: interpolated.append(_process_grouped_data(g, frequency)))
     logging.getLogger().info("Finish interpolating")
     result = pd.concat(interpolated)
@@ -112,6 +206,86 @@ def _interpolate(intervalized_data: pd.DataFrame,
     return result
 
 
+def _interpolate_frequencies(intervalized_data: pd.DataFrame,
+                             group_by: List[str],
+                             frequencies: List[str]) -> Dict[str, pd.DataFrame]:
+    # _interpolate at several frequencies, the splines of each turnstile are
+    # fitted once
+    logging.getLogger().info("Start interpolating turnstile data")
+    if 'cleaned_entries' not in intervalized_data.columns:
+        intervalized_data, _ = cleaning.clean_counters(intervalized_data,
+                                                       group_by)
+
+    interpolated = {frequency: [] for frequency in frequencies}
+
+    def process(grouped):
+        splines = _fit_splines(grouped)
+        for frequency in frequencies:
+            interpolated[frequency].append(
+                _process_grouped_data(grouped, frequency, splines))
+    intervalized_data.groupby(group_by, observed=True).apply(process)
+    logging.getLogger().info("Finish interpolating")
+    result = {frequency: pd.concat(frames)
+              for frequency, frames in interpolated.items()}
+    logging.getLogger().info("Finish concatenating the result")
+    return result
+
+
+ENGINES = {
+    'pandas': _interpolate,
+    'numpy': vectorized.interpolate,
+}
+
+# the engines interpolating several frequencies in one call, returning a
+# frame per frequency
+FREQUENCIES_ENGINES = {
+    'pandas': _interpolate_frequencies,
+    'numpy': vectorized.interpolate_frequencies,
+}
+
+
+def _split_into_chunks(data: pd.DataFrame,
+                       group_by: List[str],
+                       chunks: int) -> List[pd.DataFrame]:
+    # split the groups, in their sorted order, into contiguous chunks with
+    # roughly the same number of rows
+    codes = data.groupby(group_by, sort=True, observed=True).ngroup()
+    data, codes = data[codes.notnull()], codes[codes.notnull()].astype(int)
+    sizes = np.bincount(codes)
+    rows_before = np.cumsum(sizes) - sizes
+    chunk_of_group = rows_before * chunks // max(sizes.sum(), 1)
+    return [chunk for _, chunk in data.groupby(chunk_of_group[codes.values])]
+
+
+def _interpolate_chunk(args) -> Dict[str, pd.DataFrame]:
+    engine, chunk, group_by, frequencies = args
+    return FREQUENCIES_ENGINES[engine](chunk, group_by, frequencies)
+
+
+def _interpolate_in_parallel(intervalized_data: pd.DataFrame,
+                             group_by: List[str],
+                             frequencies: List[str],
+                             engine: str,
+                             workers: int) -> Dict[str, pd.DataFrame]:
+    logging.getLogger().info(
+        "Start interpolating turnstile data on %d workers", workers)
+
+    # a few chunks per worker so that a slow chunk doesn't hold up the pool
+    chunks = _split_into_chunks(intervalized_data, group_by, workers * 4)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map returns the results in the order of the chunks, so the output
+        # is the same as a single process run
+        interpolated = list(executor.map(
+            _interpolate_chunk,
+            [(engine, chunk, group_by, frequencies) for chunk in chunks]))
+    logging.getLogger().info("Finish interpolating")
+    result = {frequency: pd.concat([i[frequency] for i in interpolated])
+              for frequency in frequencies}
+    logging.getLogger().info("Finish concatenating the result")
+
+    return result
+
+
 class TurnstilePageParser(HTMLParser):
     def __init__(self, start_date, end_date=None):
         super().__init__()
@@ -161,38 +335,349 @@ class TurnstilePageParser(HTMLParser):
         return [r[1] for r in self.links[lower:upper + 1]]
 
 
+MTA_TURNSTILE_URL = 'http://web.mta.info/developers/'
+
+# the keys of the weekly files are strings, even the lines of stations only
+# served by numbered lines, e.g. 1 or 23
+RAW_DTYPES = {c: str for c in ['C/A', 'UNIT', 'SCP', 'STATION', 'LINENAME', 'DIVISION']}
+
+# retry settings of the concurrent download mode: a failed request is retried
+# DOWNLOAD_RETRIES times, waiting backoff * 2 ** (attempt - 1) seconds between
+# attempts. 429, 500, 502, 503 and 504 responses are retried too.
+# DOWNLOAD_TIMEOUT is the timeout of each request, in seconds.
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_TIMEOUT = 60
+
+
+def _create_session(pool_size: int,
+                    retries: int = DOWNLOAD_RETRIES,
+                    backoff: float = DOWNLOAD_BACKOFF) -> requests.Session:
+    # a session shared by the download threads, so the connections to the
+    # server are kept alive and reused between files
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _download_turnstile_file(session: requests.Session,
+                             url: str) -> pd.DataFrame:
+    # the body is parsed as it arrives, the parser reads the socket in
+    # chunks so neither the bytes nor the text of the whole file are held in
+    # memory. decode_content undoes a gzip or deflate content encoding.
+    with session.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return pd.read_csv(response.raw, encoding='utf-8', dtype=RAW_DTYPES)
+
+
+def _cache_path(cache_directory: str, link: str) -> str:
+    return os.path.join(cache_directory,
+                        re.sub(r"[^\w.-]", "_", link) + ".parquet")
+
+
+def _read_turnstile_file(link: str,
+                         download: Callable[[str], pd.DataFrame],
+                         cache_directory: str = None) -> pd.DataFrame:
+    # weekly files don't change once published, so a cached copy is used
+    # as is; new files are written to the cache after they are downloaded
+    if cache_directory is None:
+        return download(link)
+    path = _cache_path(cache_directory, link)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    data = download(link)
+    # write to a temporary file first, so that concurrent readers never
+    # see a partially written file
+    data.to_parquet(path + '.tmp', compression='snappy', index=False)
+    os.replace(path + '.tmp', path)
+    return data
+
+
+def _get_turnstile_links(start_date: datetime,
+                         end_date: datetime,
+                         download: Callable[[str], str],
+                         cache_directory: str = None) -> List[str]:
+    # the cached index page is enough when it already lists a week after
+    # end_date, otherwise a fresh copy is downloaded
+    index_path = cache_directory and os.path.join(cache_directory,
+                                                  'turnstile.html')
+    if index_path and end_date and os.path.exists(index_path):
+        parser = TurnstilePageParser(start_date, end_date)
+        with open(index_path, encoding='utf-8') as f:
+            parser.feed(f.read())
+        if parser.links and max(d for d, _ in parser.links) > end_date:
+            return parser.get_all_links()
+
+    page = download('turnstile.html')
+    if index_path:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            f.write(page)
+    parser = TurnstilePageParser(start_date, end_date)
+    parser.feed(page)
+    return parser.get_all_links()
+
+
 def download_turnstile_data(start_date: datetime,
-                            end_date: datetime = None) -> pd.DataFrame:
+                            end_date: datetime = None,
+                            workers: int = 1,
+                            base_url: str = MTA_TURNSTILE_URL,
+                            cache_directory: str = None,
+                            compact: bool = False,
+                            archive: str = None) -> pd.DataFrame:
     """
     Download raw turnstile data from http://web.mta.info/developers/turnstile.html
 
     Parameters
     start_date: datatime
     end_date: datetime, optional
+    workers: int, optional - If greater than 1, the weekly files are downloaded
+        concurrently by this many threads sharing a keep-alive session, failed
+        requests are retried with backoff and each file is parsed as soon as
+        it arrives.
+    base_url: str, optional - Location of turnstile.html and the weekly files
+    cache_directory: str, optional - If specified, each weekly file is stored
+        under this directory as a compressed parquet file the first time it
+        is downloaded, and read from there afterwards.
+    compact: bool, optional - If True, only UNIT, SCP, STATION, LINENAME,
+        DATE, TIME, ENTRIES and EXITS are kept from each weekly file. The
+        strings are stored as categoricals sharing one set of categories
+        and the counters as 32 bit integers when they fit.
+    archive: str, optional - If specified, the weekly files are read from
+        this local mirror instead of being downloaded, see
+        read_turnstile_archive. workers is the number of processes parsing
+        them.
 
     Return
     pandas.DataFrame
 
     """
+    if archive is not None:
+        return read_turnstile_archive(start_date, end_date, archive,
+                                      workers=workers, compact=compact)
     logging.getLogger().info("Downloading turnstile data")
-    mta_link_rook = 'http://web.mta.info/developers/'
-    start_page = requests.get(mta_link_rook + 'turnstile.html')
+    if cache_directory:
+        os.makedirs(cache_directory, exist_ok=True)
+
+    convert = _compact_raw_data if compact else (lambda data: data)
+    concat = _concat_compact if compact else pd.concat
+
+    if workers > 1:
+        with _create_session(workers) as session:
+            def get_page(link):
+                page = session.get(base_url + link, timeout=DOWNLOAD_TIMEOUT)
+                page.raise_for_status()
+                return page.content.decode('utf-8')
+
+            links = _get_turnstile_links(start_date, end_date, get_page,
+                                         cache_directory)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                dfs = list(executor.map(
+                    lambda l: convert(_read_turnstile_file(
+                        l,
+                        lambda link: _download_turnstile_file(
+                            session, base_url + link),
+                        cache_directory)),
+                    links))
+        return concat(dfs)
+
+    return concat([convert(data) for data in iterate_turnstile_data(
+        start_date, end_date, base_url, cache_directory)])
+
+
+def iterate_turnstile_data(start_date: datetime,
+                           end_date: datetime = None,
+                           base_url: str = MTA_TURNSTILE_URL,
+                           cache_directory: str = None) -> Iterator[pd.DataFrame]:
+    """
+    Download raw turnstile data one weekly file at a time, in date order
+
+    Parameters
+    start_date: datatime
+    end_date: datetime, optional
+    base_url: str, optional - Location of turnstile.html and the weekly files
+    cache_directory: str, optional - see download_turnstile_data
+
+    Return
+    Iterator[pandas.DataFrame] - the raw data of each weekly file
+
+    """
+    for _, data in _iterate_turnstile_files(start_date, end_date,
+                                            base_url, cache_directory):
+        yield data
+
+
+def _iterate_turnstile_files(start_date: datetime,
+                             end_date: datetime = None,
+                             base_url: str = MTA_TURNSTILE_URL,
+                             cache_directory: str = None,
+                             skip_links: List[str] = (),
+                             archive: str = None) -> Iterator[Tuple[str, pd.DataFrame]]:
+    if archive is not None:
+        for entry in _get_archive_links(start_date, end_date, archive):
+            link = _archive_link(entry)
+            if link not in skip_links:
+                yield link, _read_archive_file(entry)
+        return
+    links = _get_turnstile_links(
+        start_date, end_date,
+        lambda link: requests.get(base_url + link).content.decode('utf-8'),
+        cache_directory)
+    for l in links:
+        if l in skip_links:
+            continue
+        yield l, _read_turnstile_file(
+            l,
+            lambda link: _download_turnstile_file(requests, base_url + link),
+            cache_directory)
+
+
+# the weekly files of a local mirror, plain or gzip compressed, named as on
+# the MTA page
+ARCHIVE_FILE = re.compile(r"turnstile_(\d{6})\.txt(\.gz)?$")
+
+
+def _list_archive(archive: str) -> List[Tuple[datetime, Tuple[str, str]]]:
+    # the date and location of each weekly file under a directory, in a zip
+    # file or a weekly file itself. The location is the path of the file and
+    # the name of the zip member, None for a file.
+    if os.path.isdir(archive):
+        paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(archive) for name in names)
+    else:
+        paths = [archive]
+    entries = []
+    for path in paths:
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as z:
+                names = [(name, (path, name)) for name in sorted(z.namelist())]
+        else:
+            names = [(os.path.basename(path), (path, None))]
+        for name, location in names:
+            match = ARCHIVE_FILE.search(name)
+            if match:
+                entries.append((datetime.strptime(match.group(1), '%y%m%d'), location))
+
+    # the first copy of each week, e.g. of a week both in a zip file and
+    # extracted next to it
+    weeks = {}
+    for week, location in entries:
+        if week in weeks:
+            logging.getLogger().info("Skipping %s, a copy of %s", location, weeks[week])
+        else:
+            weeks[week] = location
+    return list(weeks.items())
+
+
+def _get_archive_links(start_date: datetime,
+                       end_date: datetime,
+                       archive: str) -> List[Tuple[str, str]]:
+    # the weekly files are selected by the date of their name, as the links
+    # of turnstile.html by their text
     parser = TurnstilePageParser(start_date, end_date)
-    parser.feed(start_page.content.decode('utf-8'))
-    dfs = [
-        pd.read_csv(
-            io.StringIO(
-                requests.get(
-                    mta_link_rook +
-                    l).content.decode('utf-8'))) for l in parser.get_all_links()]
-    return pd.concat(dfs)
+    parser.links = _list_archive(archive)
+    return parser.get_all_links()
+
+
+def _archive_link(location: Tuple[str, str]) -> str:
+    # the link of the weekly file on the MTA page, so that the weeks
+    # processed from a mirror and from the page are the same links
+    path, member = location
+    week = ARCHIVE_FILE.search(os.path.basename(path) if member is None else member).group(1)
+    return 'data/nyct/turnstile/turnstile_%s.txt' % week
+
+
+def _read_archive_file(location: Tuple[str, str]) -> pd.DataFrame:
+    path, member = location
+    if member is None:
+        # the compression is inferred from the extension
+        return pd.read_csv(path, encoding='utf-8', dtype=RAW_DTYPES)
+    with zipfile.ZipFile(path) as z, z.open(member) as f:
+        return pd.read_csv(f, encoding='utf-8', dtype=RAW_DTYPES,
+                           compression='gzip' if member.endswith('.gz') else None)
+
+
+def _read_archive_task(args) -> pd.DataFrame:
+    location, compact = args
+    data = _read_archive_file(location)
+    return _compact_raw_data(data) if compact else data
+
+
+def read_turnstile_archive(start_date: datetime,
+                           end_date: datetime = None,
+                           archive: str = 'data/raw/turnstile',
+                           workers: int = 1,
+                           compact: bool = False) -> pd.DataFrame:
+    """
+    Read raw turnstile data from a local mirror of the weekly files
+
+    The weekly files keep the names of the MTA page, turnstile_YYMMDD.txt,
+    plain or gzip compressed (turnstile_YYMMDD.txt.gz), and can also be
+    members of zip files. The weeks are selected by the date in the names,
+    like the links of turnstile.html by download_turnstile_data.
+
+    Parameters
+    start_date: datatime
+    end_date: datetime, optional
+    archive: str, optional - a directory, searched recursively, a zip file
+        or a weekly file
+    workers: int, optional - If greater than 1, the files are decompressed
+        and parsed by this many processes
+    compact: bool, optional - see download_turnstile_data, each file is
+        made compact by the process parsing it
+
+    Return
+    pandas.DataFrame
+
+    """
+    locations = _get_archive_links(start_date, end_date, archive)
+    if not locations:
+        raise Exception("No weekly turnstile files in " + str(archive))
+    logging.getLogger().info("Reading %d weekly files from %s", len(locations), archive)
+    tasks = [(location, compact) for location in locations]
+    if workers > 1:
+        # map returns the files in date order
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            dfs = list(executor.map(_read_archive_task, tasks))
+    else:
+        dfs = [_read_archive_task(task) for task in tasks]
+    return _concat_compact(dfs) if compact else pd.concat(dfs)
+
+
+def _select_dates(raw: pd.DataFrame,
+                  start_date: datetime,
+                  end_date: datetime = None) -> pd.DataFrame:
+    # keep a day on each side, the snapshots around the range are needed
+    # for the differences and the interpolation at its edges. The timestamps
+    # are kept in a datetime column for _process_raw_data.
+    timestamps = _build_timestamps(raw)
+    date = timestamps.astype('datetime64[D]').astype('datetime64[ns]')
+    selected = date >= np.datetime64(start_date - timedelta(1), 'ns')
+    if end_date:
+        selected &= date <= np.datetime64(end_date + timedelta(1), 'ns')
+    return raw[selected].assign(datetime=timestamps[selected])
 
 
 def create_interpolated_turnstile_data(
         start_date: datetime,
         end_date: datetime = None,
         group_by: List[str] = ['UNIT', 'SCP'],
-        frequency: str = '1H') -> pd.DataFrame:
+        frequency: Union[str, List[str]] = '1H',
+        engine: str = 'pandas',
+        workers: int = 1,
+        download_workers: int = 1,
+        cache_directory: str = None,
+        compact: bool = False,
+        cleaning_rules: CleaningRules = DEFAULT_RULES,
+        archive: str = None) -> Union[
+            pd.DataFrame, Dict[str, pd.DataFrame]]:
     """
     Create interpolated turnstile data
 
@@ -205,40 +690,199 @@ def create_interpolated_turnstile_data(
     start_date : datetime
     end_date : datetime, optional
     group_by : List(str), optional
-    frequency: str, optional
+    frequency: str or List(str), optional - With a list of frequencies the
+        data is downloaded, cleaned and fitted once, then sampled at each
+        frequency.
+    engine: str, optional - 'pandas' interpolates one turnstile at a time,
+        'numpy' interpolates all of them at once in vectorized passes.
+        Both produce the same estimated entries/exits.
+    workers: int, optional - number of processes to interpolate with. The
+        turnstiles are split into chunks that are interpolated in parallel,
+        the output is the same for any number of workers.
+    download_workers: int, optional - number of weekly files to download
+        concurrently, see download_turnstile_data
+    cache_directory: str, optional - directory to cache the weekly files in,
+        see download_turnstile_data
+    compact: bool, optional - If True, the raw data is kept in the compact
+        form of download_turnstile_data and the group by keys of the result
+        are categoricals. Duplicate snapshots of a turnstile are dropped
+        instead of summed, only the first one is kept.
+    cleaning_rules: CleaningRules, optional - how the differences of the
+        counters are cleaned, see cleaning.CleaningRules. The default drops
+        negative differences and differences above 10000.
+    archive: str, optional - read the weekly files from this local mirror
+        instead of downloading them, see read_turnstile_archive
 
     Returns
     dataframe
     [group_by_keys: List[str]
      estimated_entries: int
      estimated_exits: int]
+    or, for a list of frequencies, dict[frequency: str, dataframe]
 
     """
 
     if not set(group_by).issubset(['STATION', 'LINENAME', 'UNIT', 'SCP']):
         raise Exception("Unsupported group by keys: " + str(group_by))
+    if engine not in ENGINES:
+        raise Exception("Unsupported engine: " + str(engine))
+
+    with profiling.span('turnstile.download') as span:
+        raw = span.output(download_turnstile_data(
+            start_date, end_date, workers=download_workers,
+            cache_directory=cache_directory, compact=compact,
+            archive=archive))
+    frequencies = [frequency] if isinstance(frequency, str) else frequency
+    result = _interpolate_raw_data(raw, start_date, end_date, group_by,
+                                   frequencies, engine, workers, compact,
+                                   cleaning_rules)
+    return result[frequency] if isinstance(frequency, str) else result
+
+
+def _interpolate_raw_data(raw: pd.DataFrame,
+                          start_date: datetime,
+                          end_date: datetime,
+                          group_by: List[str],
+                          frequencies: List[str],
+                          engine: str = 'pandas',
+                          workers: int = 1,
+                          compact: bool = False,
+                          cleaning_rules: CleaningRules = DEFAULT_RULES) -> Dict[str, pd.DataFrame]:
+    # the steps of create_interpolated_turnstile_data after the download
+    with profiling.span('turnstile.select_dates', rows_in=len(raw)) as span:
+        raw = span.output(_select_dates(raw, start_date, end_date))
+
+    with profiling.span('turnstile.process', rows_in=len(raw)) as span:
+        if compact:
+            processed = _process_compact_data(raw, group_by)
+        else:
+            processed = _process_raw_data(raw, group_by)
+        span.output(processed)
+    return _interpolate_processed_data(processed, start_date, end_date,
+                                       group_by, frequencies, engine,
+                                       workers, cleaning_rules)
+
+
+def _interpolate_processed_data(processed: pd.DataFrame,
+                                start_date: datetime,
+                                end_date: datetime,
+                                group_by: List[str],
+                                frequencies: List[str],
+                                engine: str = 'pandas',
+                                workers: int = 1,
+                                cleaning_rules: CleaningRules = DEFAULT_RULES) -> Dict[str, pd.DataFrame]:
+    # the snapshots of each turnstile, sorted by time with a datetime index,
+    # cleaned and interpolated between start_date and end_date
+    with profiling.span('turnstile.clean', rows_in=len(processed)) as span:
+        processed, _ = span.output(cleaning.clean_counters(
+            processed, group_by, cleaning_rules))
+    with profiling.span('turnstile.interpolate', rows_in=len(processed),
+                        engine=engine, workers=workers) as span:
+        if workers > 1:
+            interpolated = _interpolate_in_parallel(
+                processed, group_by, frequencies, engine, workers)
+        else:
+            interpolated = FREQUENCIES_ENGINES[engine](
+                processed, group_by, frequencies)
+        span.output(interpolated)
+
+    result = {}
+    for f, data in interpolated.items():
+        end = end_date or data.index.max()
+        result[f] = data[data.index.to_series().between(
+            start_date, end)] .drop(columns=["entry_diffs", "exit_diffs"])
+    return result
+
+
+def create_cleaning_report(start_date: datetime,
+                           end_date: datetime = None,
+                           group_by: List[str] = ['UNIT', 'SCP'],
+                           cleaning_rules: CleaningRules = DEFAULT_RULES,
+                           download_workers: int = 1,
+                           cache_directory: str = None,
+                           compact: bool = False,
+                           archive: str = None) -> pd.DataFrame:
+    """
+    Count how often each cleaning rule applies to each turnstile, without
+    interpolating
+
+    Parameters
+    start_date : datetime
+    end_date : datetime, optional
+    group_by : List(str), optional
+    cleaning_rules: CleaningRules, optional
+    download_workers: int, optional
+    cache_directory: str, optional
+    compact: bool, optional
+    archive: str, optional
+
+    Returns
+    dataframe indexed by the group by keys, with the number of entry and exit
+    differences each rule applied to, e.g. entries_negative, exits_ceiling
+
+    """
+    raw = download_turnstile_data(start_date, end_date,
+                                  workers=download_workers,
+                                  cache_directory=cache_directory,
+                                  compact=compact,
+                                  archive=archive)
+    raw = _select_dates(raw, start_date, end_date)
+    if compact:
+        processed = _process_compact_data(raw, group_by)
+    else:
+        processed = _process_raw_data(raw, group_by)
+    _, report = cleaning.clean_counters(processed, group_by, cleaning_rules)
+    return report
+
+
+# time buckets of per-station data, e.g. the freq parameter of service.py
+# and the levels of rollup.py, the start of the bucket of a time
+FREQUENCIES = {
+    'raw': lambda times: times,
+    'H': lambda times: times.astype('datetime64[h]'),
+    'D': lambda times: times.astype('datetime64[D]'),
+    # weeks start on Monday, 1970-01-01 was a Thursday
+    'W': lambda times: ((times.astype('datetime64[D]').astype(np.int64) + 3) // 7 * 7 - 3).astype('datetime64[D]'),
+    'M': lambda times: times.astype('datetime64[M]'),
+    'Y': lambda times: times.astype('datetime64[Y]'),
+    # one bucket, starting at the first time
+    'total': lambda times: np.full(len(times), times.min() if len(times) else 0, dtype=times.dtype),
+}
+
+
+def sum_turnstile_data_by_station(turnstile_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sum turnstile data by datetime and station
 
+    Parameters
+    turnstile_data: pandas.DataFrame - with STATION and LINENAME columns
 
-    raw = download_turnstile_data(start_date, end_date)
-    raw['date'] = pd.to_datetime(raw.DATE)
-    raw = raw[(raw.date <= (end_date + timedelta(1))) & (raw.date >= (start_date - timedelta(1)))]
-    raw.drop('date',axis=1,inplace=True)
+    Return
+    pandas.DataFrame - datetime, STATION, LINENAME and the sums of the
+    numeric columns
 
-    interpolated = _interpolate(_process_raw_data(raw, group_by), group_by, frequency)
-    end_date = end_date or interpolated.index.max()
-    return interpolated[interpolated.index.to_series().between(
-        start_date, end_date)] .drop(columns=["entry_diffs", "exit_diffs"])
+    """
+    with profiling.span('turnstile.sum_by_station',
+                        rows_in=len(turnstile_data)) as span:
+        return span.output(turnstile_data.groupby(
+            ['datetime', 'STATION', 'LINENAME'], observed=True).sum(
+                numeric_only=True).reset_index())
 
 
 def aggregate_turnstile_data_by_station(turnstile_data: pd.DataFrame,
-                                        output_directory: str = None) -> Dict[str,
-                                                                              pd.DataFrame]:
+                                        output_directory: str = None,
+                                        workers: int = 1,
+                                        compression: str = None) -> Dict[str,
+                                                                         pd.DataFrame]:
     """
     aggregate turnstile data by station and save to output directory if passed.
 
     Parameters
     turnstile_data: pandas.DataFram
     output_directory: str, optional - If specified, the data by station will be saved under the specified directory.
+    workers: int, optional - number of threads writing the station files
+    compression: str, optional - compression of the station files, see
+        writer.write_station_files
 
 
     Return
@@ -246,28 +890,7 @@ def aggregate_turnstile_data_by_station(turnstile_data: pd.DataFrame,
 
     """
 
-    aggregated_by_station = turnstile_data.groupby(
-        ['datetime', 'STATION','LINENAME']).sum().reset_index()
-    turnstile_by_station = {
-        re.sub(
-            r"\s+",
-            '_',
-            re.sub(
-                r"[/|-]",
-                " ",
-                '_'.join(station))) +
-        ".csv": df for (
-            station,
-            df) in aggregated_by_station.groupby(
-            ['STATION','LINENAME'])}
+    slices = split_by_station(sum_turnstile_data_by_station(turnstile_data))
     if output_directory:
-        if not os.path.exists(output_directory):
-            os.mkdir(output_directory)
-        for key in turnstile_by_station:
-            d = turnstile_by_station[key]
-            d.to_csv(
-                os.path.join(
-                    output_directory.strip('/'),
-                    '/') + key,
-                index=False)
-    return turnstile_by_station
+        _write_slices(slices, output_directory, workers, compression)
+    return {station_file_name(station): df for station, df in slices}
@@ -0,0 +1,371 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from scipy.linalg import solve_banded
+from typing import Dict, List
+
+from .cleaning import _segment_starts, _segmented_diff, clean_counters
+
+# This module provides a vectorized interpolation engine for MTA turnstile
+# data. Instead of processing one turnstile at a time, every (UNIT, SCP)
+# series is laid out in one array sorted by turnstile and time, and each
+# step (resample, interpolate) is a segmented numpy pass over that array,
+# like the clean up in cleaning.py. The results match
+# turnstile._process_grouped_data.
+
+# quadratic splines, the same degree as pandas' interpolate(method='quadratic')
+SPLINE_DEGREE = 2
+
+NANOS_PER_DAY = 24 * 60 * 60 * 10**9
+
+
+def _frequency_nanos(frequency: str) -> int:
+    offset = pd.tseries.frequencies.to_offset(frequency)
+    if not isinstance(offset, pd.offsets.Tick):
+        raise Exception("Unsupported frequency for the numpy engine: " +
+                        str(frequency))
+    return offset.nanos
+
+
+def _last_valid(valid: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # index of the last valid position at or before each row within its
+    # segment, -1 if there is none
+    positions = np.arange(len(valid))
+    segment_start = np.maximum.accumulate(np.where(starts, positions, 0))
+    last = np.maximum.accumulate(np.where(valid, positions, -1))
+    return np.where(last >= segment_start, last, -1)
+
+
+def _next_valid(valid: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # index of the next valid position at or after each row within its
+    # segment, -1 if there is none
+    n = len(valid)
+    ends = np.append(starts[1:], True)
+    reversed_last = _last_valid(valid[::-1], ends[::-1])[::-1]
+    return np.where(reversed_last >= 0, n - 1 - reversed_last, -1)
+
+
+def _bspline_basis(x: np.ndarray, knots: np.ndarray, left: np.ndarray):
+    # de Boor's recursion for the non-zero quadratic B-splines at x, on the
+    # knot span [knots[left], knots[left + 1]); same arithmetic as scipy
+    h = [np.ones(len(x)), np.zeros(len(x)), np.zeros(len(x))]
+    for j in range(1, SPLINE_DEGREE + 1):
+        hh = [v.copy() for v in h[:j]]
+        h[0] = np.zeros(len(x))
+        for n in range(1, j + 1):
+            xb = knots[left + n]
+            xa = knots[left + n - j]
+            span = xb - xa
+            with np.errstate(divide='ignore', invalid='ignore'):
+                w = np.where(span == 0, 0.0, hh[n - 1] / span)
+            h[n - 1] = h[n - 1] + w * (xb - x)
+            h[n] = w * (x - xa)
+    return h
+
+
+def _fit_quadratic_splines(x: np.ndarray,
+                           y: np.ndarray,
+                           segments: np.ndarray) -> tuple:
+    """
+    Fit an interpolating quadratic spline through each segment of (x, y)
+
+    The knots are placed as scipy.interpolate.make_interp_spline does for
+    k=2, so the curves are the ones pandas' quadratic interpolation produces.
+    The collocation matrices of all segments form one block diagonal banded
+    system, which is solved in a single call.
+
+    Parameters
+    x: numpy.ndarray - sorted by segment, then by x
+    y: numpy.ndarray
+    segments: numpy.ndarray - segment id of each point, at least 3 points each
+
+    Return
+    the splines, to evaluate with _evaluate_quadratic_splines
+
+    """
+    k = SPLINE_DEGREE
+    n = len(x)
+    starts = _segment_starts(segments)
+    first = np.flatnonzero(starts)
+    sizes = np.diff(np.append(first, n))
+    segment_index = np.cumsum(starts) - 1
+    local = np.arange(n) - first[segment_index]
+    size = sizes[segment_index]
+
+    # knots: x0 (k + 1 times), midpoints between x[1], ..., x[m - 2], x[m - 1]
+    # (k + 1 times); m + 3 knots for a segment of m points
+    knot_first = first + np.arange(len(first)) * (k + 1)
+    knots = np.empty(n + len(first) * (k + 1))
+    knot_local = np.arange(len(knots)) - np.repeat(knot_first, sizes + k + 1)
+    knot_size = np.repeat(sizes, sizes + k + 1)
+    knot_point = np.repeat(first, sizes + k + 1) + knot_local - k
+    inner = (knot_local > k) & (knot_local < knot_size)
+    knots[knot_local <= k] = np.repeat(x[first], k + 1)
+    knots[knot_local >= knot_size] = np.repeat(x[first + sizes - 1], k + 1)
+    knots[inner] = (x[knot_point[inner]] + x[knot_point[inner] + 1]) / 2.
+
+    # collocation: point i lies in the knot span starting at i + 1
+    left = np.clip(local + 1, k, size - 1)
+    basis = _bspline_basis(x, knots, knot_first[segment_index] + left)
+    banded = np.zeros((2 * k + 1, n))
+    for a in range(k + 1):
+        column = first[segment_index] + left - k + a
+        banded[k + np.arange(n) - column, column] = basis[a]
+    coefficients = solve_banded((k, k), banded, y)
+    return x, starts, first, sizes, knots, knot_first, coefficients
+
+
+def _evaluate_quadratic_splines(splines: tuple,
+                                query_x: np.ndarray,
+                                query_previous: np.ndarray) -> np.ndarray:
+    """
+    Evaluate splines fitted by _fit_quadratic_splines
+
+    Parameters
+    splines: tuple - output of _fit_quadratic_splines
+    query_x: numpy.ndarray
+    query_previous: numpy.ndarray - index into x of the last point before each query
+
+    Return
+    numpy.ndarray of the spline values at query_x
+
+    """
+    k = SPLINE_DEGREE
+    x, starts, first, sizes, knots, knot_first, coefficients = splines
+    n = len(x)
+
+    # find the knot span of each query point from the data
+    # points around it, the midpoint between them is the only knot in between
+    query_index = np.cumsum(starts)[query_previous] - 1
+    query_local = query_previous - first[query_index]
+    query_size = sizes[query_index]
+    midpoint = (x[query_previous] +
+                x[np.minimum(query_previous + 1, n - 1)]) / 2.
+    query_left = query_local + 1 + (query_x >= midpoint)
+    query_left[query_local == 0] = k
+    query_left[query_local == query_size - 2] = query_size[
+        query_local == query_size - 2] - 1
+    query_left = np.clip(query_left, k, query_size - 1)
+    basis = _bspline_basis(query_x, knots,
+                           knot_first[query_index] + query_left)
+    values = np.zeros(len(query_x))
+    for a in range(k + 1):
+        values += coefficients[first[query_index] +
+                               query_left - k + a] * basis[a]
+    return values
+
+
+def _prepare_column(cleaned: np.ndarray,
+                    times: np.ndarray,
+                    starts: np.ndarray) -> tuple:
+    # the part of the interpolation that doesn't depend on the frequency:
+    # which segments are quadratic, and their splines
+    valid = ~np.isnan(cleaned)
+    segment_index = np.cumsum(starts) - 1
+    counts = np.bincount(segment_index, weights=valid)
+    quadratic = counts[segment_index] > 2
+    points = np.flatnonzero(valid & quadratic)
+    splines = None
+    if len(points):
+        splines = _fit_quadratic_splines(
+            times[points].astype(np.float64), cleaned[points],
+            segment_index[points])
+    point_position = np.full(len(cleaned), -1)
+    point_position[points] = np.arange(len(points))
+    return quadratic, splines, point_position
+
+
+def _interpolate_column(cleaned: np.ndarray,
+                        times: np.ndarray,
+                        starts: np.ndarray,
+                        quadratic: np.ndarray,
+                        splines: tuple,
+                        point_position: np.ndarray) -> np.ndarray:
+    # fill the missing values of each segment the way _process_grouped_data
+    # does: quadratic splines over time if there are more than 2 values,
+    # otherwise linear over the row positions. Leading gaps are kept, and so
+    # are trailing gaps of quadratic segments (out of the spline's range).
+    # quadratic and point_position are those of _prepare_column for each
+    # row, -1 for the rows without an observation.
+    valid = ~np.isnan(cleaned)
+    previous = _last_valid(valid, starts)
+    following = _next_valid(valid, starts)
+    missing = ~valid & (previous >= 0)
+
+    result = cleaned.copy()
+
+    linear = missing & ~quadratic
+    inside = linear & (following >= 0)
+    rows = np.flatnonzero(inside)
+    lo, hi = previous[rows], following[rows]
+    slope = (cleaned[hi] - cleaned[lo]) / (hi - lo)
+    result[rows] = slope * (rows - lo) + cleaned[lo]
+    trailing = np.flatnonzero(linear & (following < 0))
+    result[trailing] = cleaned[previous[trailing]]
+
+    queries = np.flatnonzero(missing & quadratic & (following >= 0))
+    if len(queries):
+        result[queries] = _evaluate_quadratic_splines(
+            splines, times[queries].astype(np.float64),
+            point_position[previous[queries]])
+    return result
+
+
+def _segmented_ffill(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    last = _last_valid(~np.isnan(values), starts)
+    return np.where(last >= 0, values[np.maximum(last, 0)], np.nan)
+
+
+def _take_keys(keys: pd.Series,
+               rows: np.ndarray,
+               present: np.ndarray):
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        # missing keys are code -1, the result keeps the categories
+        codes = np.where(present, keys.cat.codes.to_numpy()[rows], -1)
+        return pd.Categorical.from_codes(codes, dtype=keys.dtype)
+    return np.where(present, keys.to_numpy()[rows], np.nan)
+
+
+def interpolate(processed: pd.DataFrame,
+                group_by: List[str],
+                frequency: str) -> pd.DataFrame:
+    """
+    Interpolate turnstile data for every group at once
+
+    Vectorized equivalent of turnstile._interpolate: the same diffs, clean up,
+    resampling and interpolation, done in segmented passes over one array
+    sorted by group and time.
+
+    Parameters
+    processed: pandas.DataFrame - output of turnstile._process_raw_data,
+        cleaned with the default rules unless it is the output of
+        cleaning.clean_counters
+    group_by: List[str]
+    frequency: str - a fixed frequency, e.g. 1H or 15T
+
+    Return
+    pandas.DataFrame
+
+    """
+    return interpolate_frequencies(processed, group_by, [frequency])[frequency]
+
+
+def interpolate_frequencies(processed: pd.DataFrame,
+                            group_by: List[str],
+                            frequencies: List[str]) -> Dict[str, pd.DataFrame]:
+    """
+    Interpolate turnstile data for every group at several frequencies
+
+    The data is sorted and the splines are fitted once, each frequency only
+    adds its grid and evaluates the splines on it.
+
+    Parameters
+    processed: pandas.DataFrame - see interpolate
+    group_by: List[str]
+    frequencies: List[str] - fixed frequencies, e.g. ['15T', '1H']
+
+    Return
+    dict[frequency: str, pandas.DataFrame] - the output of interpolate for
+    each frequency
+
+    """
+    logging.getLogger().info("Start interpolating turnstile data")
+    steps = [_frequency_nanos(frequency) for frequency in frequencies]
+
+    if 'cleaned_entries' not in processed.columns:
+        processed, _ = clean_counters(processed, group_by)
+    processed = processed[processed[group_by].notnull().all(axis=1)]
+    codes = processed.groupby(group_by, sort=True,
+                              observed=True).ngroup().to_numpy()
+    times = processed.index.asi8
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
+    starts = _segment_starts(codes)
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(codes)) - 1
+    keys = processed[group_by].iloc[order[first]]
+
+    columns = {}
+    for diffs, cleaned, name in [('entry_diffs', 'cleaned_entries', 'entries'),
+                                 ('exit_diffs', 'cleaned_exits', 'exits')]:
+        cumulative = processed[cleaned].to_numpy()[order]
+        columns[name] = (processed[diffs].to_numpy()[order], cumulative,
+                         _prepare_column(cumulative, times, starts))
+
+    interpolated = {}
+    for frequency, step in zip(frequencies, steps):
+        interpolated[frequency] = _interpolate_grid(
+            codes, times, first, last, keys, columns, step)
+    logging.getLogger().info("Finish interpolating")
+    return interpolated
+
+
+def _interpolate_grid(codes: np.ndarray,
+                      times: np.ndarray,
+                      first: np.ndarray,
+                      last: np.ndarray,
+                      keys: pd.DataFrame,
+                      columns: dict,
+                      step: int) -> pd.DataFrame:
+    # the resampling grid of each group, anchored at midnight of its first day
+    origin = times[first] - times[first] % NANOS_PER_DAY
+    grid_first = origin + (times[first] - origin) // step * step
+    grid_last = origin + (times[last] - origin) // step * step
+    grid_sizes = (grid_last - grid_first) // step + 1
+    grid_offsets = np.repeat(np.cumsum(grid_sizes) - grid_sizes, grid_sizes)
+    grid_codes = np.repeat(codes[first], grid_sizes)
+    grid_times = np.repeat(grid_first, grid_sizes) + step * (
+        np.arange(grid_sizes.sum()) - grid_offsets)
+
+    # merge the observations with the grid, an observation on the grid is
+    # kept once
+    all_codes = np.concatenate([codes, grid_codes])
+    all_times = np.concatenate([times, grid_times])
+    on_grid = np.concatenate([np.zeros(len(codes), dtype=bool),
+                              np.ones(len(grid_codes), dtype=bool)])
+    source = np.concatenate([np.arange(len(codes)),
+                             np.full(len(grid_codes), -1)])
+    merged = np.lexsort((on_grid, all_times, all_codes))
+    all_codes, all_times = all_codes[merged], all_times[merged]
+    on_grid, source = on_grid[merged], source[merged]
+    duplicated = np.zeros(len(merged), dtype=bool)
+    duplicated[1:] = (all_codes[1:] == all_codes[:-1]) & \
+        (all_times[1:] == all_times[:-1])
+    on_grid[:-1] |= duplicated[1:]
+    keep = ~duplicated
+    all_codes, all_times = all_codes[keep], all_times[keep]
+    on_grid, source = on_grid[keep], source[keep]
+    all_starts = _segment_starts(all_codes)
+    observed = source >= 0
+    segment_index = np.cumsum(all_starts) - 1
+
+    result = {}
+    for name, (diffs, cumulative, prepared) in columns.items():
+        quadratic, splines, point_position = prepared
+        merged_diffs = np.full(len(source), np.nan)
+        merged_diffs[observed] = diffs[source[observed]]
+        cleaned = np.full(len(source), np.nan)
+        cleaned[observed] = cumulative[source[observed]]
+        merged_position = np.full(len(source), -1)
+        merged_position[observed] = point_position[source[observed]]
+        curve = _interpolate_column(
+            cleaned, all_times, all_starts,
+            quadratic[first][segment_index], splines, merged_position)
+        estimated = np.round(_segmented_diff(curve, all_starts))
+        result[name] = (_segmented_ffill(merged_diffs, all_starts)[on_grid],
+                        _segmented_ffill(estimated, all_starts)[on_grid])
+
+    # group keys are carried forward from the first observation, so a grid
+    # point before it has none
+    grid_rows = np.flatnonzero(on_grid)
+    has_keys = _last_valid(observed, all_starts)[grid_rows] >= 0
+    key_rows = np.searchsorted(codes[first], all_codes[grid_rows])
+    interpolated = pd.DataFrame(
+        {key: _take_keys(keys[key], key_rows, has_keys) for key in keys.columns},
+        index=pd.DatetimeIndex(all_times[grid_rows], name='datetime'))
+    return interpolated.assign(
+        entry_diffs=result['entries'][0],
+        exit_diffs=result['exits'][0],
+        estimated_entries=result['entries'][1],
+        estimated_exits=result['exits'][1])
@@ -0,0 +1,139 @@
+import logging
+import numpy as np
+import pandas as pd
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+# This module writes per-station data to one CSV file per station. The data
+# is sorted by station once, each station is a contiguous slice of the sorted
+# rows, and the slices are formatted and written on a thread pool.
+
+MANIFEST_FILE = 'turnstile_station_data.md'
+
+# suffix of the files written with each compression of pandas.to_csv
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+_SEPARATORS = re.compile(r"[/|-]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def station_file_name(station: Tuple[str, str]) -> str:
+    """
+    File name of the data of a station, e.g. 59_ST_NQR456W.csv
+
+    Parameters
+    station: (str, str) - STATION and LINENAME
+
+    Return
+    str
+
+    """
+    return _WHITESPACE.sub('_', _SEPARATORS.sub(" ", '_'.join(str(key) for key in station))) + ".csv"
+
+
+def split_by_station(station_data: pd.DataFrame) -> List[Tuple[Tuple[str, str],
+                                                               pd.DataFrame]]:
+    """
+    Split data by station, with one stable sort
+
+    Parameters
+    station_data: pandas.DataFrame - with STATION and LINENAME columns
+
+    Return
+    List[((STATION, LINENAME), pandas.DataFrame)] - in the order of the
+    stations, the rows of each station in their original order
+
+    """
+    station_data = station_data[
+        station_data[['STATION', 'LINENAME']].notnull().all(axis=1)]
+    codes = station_data.groupby(['STATION', 'LINENAME'], sort=True,
+                                 observed=True).ngroup().to_numpy()
+    order = np.argsort(codes, kind='stable')
+    station_data = station_data.iloc[order]
+    codes = codes[order]
+    bounds = np.append(np.flatnonzero(np.diff(codes, prepend=-1)),
+                       len(codes))
+    stations = station_data[['STATION', 'LINENAME']].iloc[bounds[:-1]]
+    return [((station, line), station_data.iloc[start:stop])
+            for station, line, start, stop in zip(
+                stations['STATION'], stations['LINENAME'],
+                bounds[:-1], bounds[1:])]
+
+
+def _write_slices(slices: List[Tuple[Tuple[str, str], pd.DataFrame]],
+                  output_directory: str,
+                  workers: int = 1,
+                  compression: str = None) -> List[Path]:
+    if compression not in COMPRESSION_SUFFIXES:
+        raise Exception("Unsupported compression: " + str(compression))
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    suffix = COMPRESSION_SUFFIXES[compression]
+
+    def write(item):
+        station, data = item
+        path = output_directory / (station_file_name(station) + suffix)
+        data.to_csv(path, index=False, compression=compression)
+        return path
+
+    logging.getLogger().info("Writing %d station files to %s",
+                             len(slices), output_directory)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(write, slices))
+    return [write(s) for s in slices]
+
+
+def write_station_files(station_data: pd.DataFrame,
+                        output_directory: str,
+                        workers: int = 1,
+                        compression: str = None) -> List[Path]:
+    """
+    Write the data of each station to its own CSV file
+
+    Parameters
+    station_data: pandas.DataFrame - with STATION and LINENAME columns, e.g.
+        the output of turnstile.sum_turnstile_data_by_station
+    output_directory: str
+    workers: int, optional - number of threads writing files
+    compression: str, optional - gzip, bz2, xz or zstd, the files are
+        compressed as they are written and get the matching suffix
+
+    Return
+    List[Path] - the files written, in the order of the stations
+
+    """
+    return _write_slices(split_by_station(station_data), output_directory,
+                         workers, compression)
+
+
+def write_manifest(files: List[Path],
+                   output_directory: str,
+                   url_prefix: str = '') -> Path:
+    """
+    Write a markdown list of links to the station files
+
+    Parameters
+    files: List[Path] - the station files written
+    output_directory: str
+    url_prefix: str, optional - prefix of the links
+
+    Return
+    Path of the manifest
+
+    """
+    path = Path(output_directory) / MANIFEST_FILE
+    link_list = '\n'.join(
+        [f"- [{file.name}]({url_prefix}{file.name})" for file in files])
+    with open(path, 'w') as f:
+        f.write(f"## Turnstile data per station per hour for 2020\n {link_list}")
+    return path
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from src.turnstile import synthetic
+
+# the synthetic weekly files of 2019-12-28 to 2020-01-17, and hourly station
+# data from 2018-12-01 to 2020-02-09, shared by the tests
+
+STATIONS = [('59 ST', 'NQR456W'), ('FULTON ST', '2345ACJZ'),
+            ('W 4 ST-WASH SQ', 'ABCDEFM')]
+
+
+@pytest.fixture(scope='session')
+def site(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('site')
+    synthetic.build_turnstile_site(str(directory), datetime(2020, 1, 4), 3,
+                                   units=6)
+    return str(directory)
+
+
+@pytest.fixture(scope='session')
+def base_url(site):
+    # the weekly files served over HTTP like the MTA page
+    server, url = synthetic.serve_turnstile_site(site)
+    yield url
+    server.shutdown()
+
+
+@pytest.fixture(scope='session')
+def stations():
+    return STATIONS
+
+
+@pytest.fixture(scope='session')
+def station_data():
+    # the columns of sum_turnstile_data_by_station
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2018-12-01', '2020-02-10', freq='H',
+                          inclusive='left')
+    data = pd.concat([pd.DataFrame({
+        'datetime': times, 'STATION': station, 'LINENAME': line,
+        'estimated_entries': rng.integers(0, 100, len(times)).astype(float),
+        'estimated_exits': rng.integers(0, 100, len(times)).astype(float)})
+        for station, line in STATIONS])
+    return data.sort_values('datetime', ignore_index=True)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from src.turnstile import turnstile
+from src.turnstile.cleaning import COUNTER_RANGE, RULES, CleaningRules, \
+    clean_counters
+
+nan = np.nan
+
+# the counters of a turnstile for each rule
+COUNTERS = {
+    # a negative difference, and a jump above MAX_DIFF
+    ('R001', '00-00-00'): [100, 150, 90, 200, 20200, 20250],
+    # wraps around
+    ('R001', '00-00-01'): [COUNTER_RANGE - 50, COUNTER_RANGE - 10, 20, 60],
+    # counts down
+    ('R002', '00-00-00'): [1000, 900, 850, 700, 710],
+    # one busy hour
+    ('R002', '00-00-01'): [0, 10, 22, 33, 42, 542],
+}
+
+# the cleaned differences of each turnstile and the rules hit, per rules
+CASES = [
+    (CleaningRules(),
+     [[nan, 50, nan, 110, nan, 50], [nan, 40, nan, 40],
+      [nan, nan, nan, nan, 10], [nan, 10, 12, 11, 9, 500]],
+     {'negative': 5, 'ceiling': 1}),
+    # without the reversed rule, counting down looks like resets
+    (CleaningRules(resets=True),
+     [[nan, 50, 90, 110, nan, 50], [nan, 40, 20, 40],
+      [nan, 900, 850, 700, 10], [nan, 10, 12, 11, 9, 500]],
+     {'reset': 5, 'ceiling': 1}),
+    (CleaningRules(wraparound=True),
+     [[nan, 50, nan, 110, nan, 50], [nan, 40, 30, 40],
+      [nan, nan, nan, nan, 10], [nan, 10, 12, 11, 9, 500]],
+     {'wraparound': 1, 'negative': 4, 'ceiling': 1}),
+    (CleaningRules(reversed=True),
+     [[nan, 50, nan, 110, nan, 50], [nan, 40, nan, 40],
+      [nan, 100, 50, 150, nan], [nan, 10, 12, 11, 9, 500]],
+     {'reversed': 4, 'negative': 3, 'ceiling': 1}),
+    # the ceiling is 5 times the lower median of the positive differences,
+    # 250 for the first turnstile and 55 raised to the floor of 100 for the
+    # last one
+    (CleaningRules(adaptive=5, adaptive_floor=100),
+     [[nan, 50, nan, 110, nan, 50], [nan, 40, nan, 40],
+      [nan, nan, nan, nan, 10], [nan, 10, 12, 11, 9, nan]],
+     {'negative': 5, 'ceiling': 2}),
+    (CleaningRules(adaptive=5, adaptive_floor=1000, negative=False),
+     [[nan, 50, -60, 110, nan, 50], [nan, 40, -(COUNTER_RANGE - 30), 40],
+      [nan, -100, -50, -150, 10], [nan, 10, 12, 11, 9, 500]],
+     {'ceiling': 1}),
+]
+
+
+@pytest.fixture(scope='module')
+def processed():
+    # the snapshots in the order of the weekly files, every 4 hours
+    frames = [pd.DataFrame({
+        'UNIT': unit, 'SCP': scp, 'ENTRIES': counters,
+        'EXITS': [2 * c for c in counters]},
+        index=pd.date_range('2020-01-01', periods=len(counters), freq='4H'))
+        for (unit, scp), counters in COUNTERS.items()]
+    return pd.concat(frames).sample(frac=1, random_state=0)
+
+
+@pytest.mark.parametrize('rules, diffs, hits', CASES)
+def test_rules(processed, rules, diffs, hits):
+    cleaned, report = clean_counters(processed, ['UNIT', 'SCP'], rules)
+    # sorted by turnstile and time
+    expected = pd.concat([pd.DataFrame(
+        {'UNIT': unit, 'SCP': scp, 'entry_diffs': d},
+        index=pd.date_range('2020-01-01', periods=len(d), freq='4H'))
+        for (unit, scp), d in zip(COUNTERS, diffs)])
+    pd.testing.assert_frame_equal(cleaned[expected.columns], expected,
+                                  check_dtype=False, check_freq=False)
+    # the cumulative sums skip the dropped differences
+    turnstiles = cleaned.groupby(['UNIT', 'SCP']).ngroup().to_numpy()
+    for t in range(len(COUNTERS)):
+        cumulative = cleaned['entry_diffs'][turnstiles == t].cumsum()
+        np.testing.assert_array_equal(
+            cleaned['cleaned_entries'][turnstiles == t], cumulative)
+
+    assert list(report.index) == list(COUNTERS)
+    assert report[['entries_' + rule for rule in RULES]].sum().to_dict() == {
+        'entries_' + rule: hits.get(rule, 0) for rule in RULES}
+
+
+def test_cleaning_report(site):
+    start, end = datetime(2020, 1, 1), datetime(2020, 1, 15)
+    default = turnstile.create_cleaning_report(start, end, archive=site)
+    assert default.shape == (24, 2 * len(RULES))
+    for counter in ['entries', 'exits']:
+        assert (default[[counter + '_' + rule for rule in
+                         ['reversed', 'wraparound', 'reset']]] == 0).all(None)
+
+    # the differences fixed as resets and wraparounds were negative before
+    report = turnstile.create_cleaning_report(
+        start, end, archive=site,
+        cleaning_rules=CleaningRules(resets=True, wraparound=True))
+    assert report['entries_reset'].sum() > 0
+    assert report['entries_wraparound'].sum() > 0
+    for counter in ['entries', 'exits']:
+        pd.testing.assert_series_equal(
+            default[counter + '_negative'],
+            report[counter + '_negative'] + report[counter + '_reset'] +
+            report[counter + '_wraparound'], check_names=False)
+        pd.testing.assert_series_equal(default[counter + '_ceiling'],
+                                       report[counter + '_ceiling'])
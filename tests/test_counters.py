@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from src.turnstile import turnstile
+from src.turnstile.counters import CounterStore, build_counter_store
+
+FIRST = datetime(2019, 12, 28)
+START = datetime(2020, 1, 8)
+END = datetime(2020, 1, 15)
+GROUP_BY = ['STATION', 'LINENAME', 'UNIT', 'SCP']
+
+
+def _keys_as_str(data: pd.DataFrame) -> pd.DataFrame:
+    return data.assign(**{c: data[c].astype(str) for c in data.columns
+                          if isinstance(data[c].dtype, pd.CategoricalDtype)})
+
+
+@pytest.fixture(scope='module')
+def raw_data(site):
+    return turnstile.download_turnstile_data(FIRST, archive=site, compact=True)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+@pytest.mark.parametrize('start, end', [(None, None), (START, END)])
+def test_decode(site, raw_data, compression, start, end):
+    # small blocks so that a range only decodes some of them
+    store = CounterStore(GROUP_BY, compression, block_rows=1000)
+    for _, week in turnstile._iterate_turnstile_files(
+            FIRST, None, turnstile.MTA_TURNSTILE_URL, None, archive=site):
+        store.append(week)
+    expected = turnstile._process_compact_data(raw_data, GROUP_BY)
+    if start is not None:
+        expected = expected[(expected.index >= start) & (expected.index < end)]
+    pd.testing.assert_frame_equal(_keys_as_str(store.decode(start, end)),
+                                  _keys_as_str(expected[GROUP_BY + ['ENTRIES', 'EXITS']]),
+                                  check_dtype=False)
+
+
+@pytest.mark.parametrize('engine', ['pandas', 'numpy'])
+def test_interpolate(site, engine):
+    store = build_counter_store(FIRST, archive=site)
+    expected = turnstile.create_interpolated_turnstile_data(
+        START, END, engine=engine, compact=True, archive=site)
+    pd.testing.assert_frame_equal(store.interpolate(START, END, engine=engine), expected)
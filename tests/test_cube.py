@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from src.turnstile.cube import RidershipCube, build_cube
+
+START = datetime(2019, 1, 7, 13)
+END = datetime(2019, 2, 3, 5)
+
+
+@pytest.fixture(scope='module')
+def data(station_data):
+    # two months, with a day and some hours missing
+    data = station_data[station_data['datetime'].between(
+        '2018-12-15', '2019-02-14 23:00')]
+    missing = (data['STATION'] == 'FULTON ST') & \
+        (data['datetime'].dt.normalize() == '2019-01-10')
+    return data[~missing].drop(data.sample(50, random_state=0).index,
+                               errors='ignore')
+
+
+@pytest.fixture(scope='module')
+def cube(data, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('cube'))
+    build_cube(data, path)
+    # opened again from the files
+    return RidershipCube(path)
+
+
+def _table(data: pd.DataFrame, stations=None,
+           column='estimated_entries') -> pd.DataFrame:
+    # the hours of START to END, one column per station
+    table = data.pivot_table(index='datetime', columns=['STATION', 'LINENAME'],
+                             values=column)
+    table = table.reindex(pd.date_range(START.replace(hour=0), END, freq='H'))
+    table = table[(table.index >= START) & (table.index < END)]
+    return table if stations is None else table[stations]
+
+
+def test_build(data, cube):
+    assert cube.times[0] == datetime(2018, 12, 15)
+    assert cube.days == 62
+    np.testing.assert_array_equal(
+        cube.values('estimated_exits', start=START, end=END),
+        _table(data, column='estimated_exits').to_numpy().T)
+
+
+def test_slice(data, cube, stations):
+    selected = [stations[2], stations[1]]
+    pd.testing.assert_frame_equal(
+        cube.slice(stations=selected, start=START, end=END),
+        _table(data, selected), check_dtype=False, check_names=False,
+        check_freq=False, check_column_type=False)
+    # all the stations, a view of the memory mapped file
+    values = cube.values(start=START, end=END)
+    assert isinstance(values, np.memmap)
+    np.testing.assert_array_equal(values, _table(data).to_numpy().T)
+
+
+def test_daily_totals(data, cube):
+    # the whole days of the range, a day without data is NaN
+    table = _table(data)
+    days = table[table.index >= datetime(2019, 1, 8)]
+    expected = days.groupby(days.index.normalize()).sum(min_count=1)
+    expected = expected[expected.index < datetime(2019, 2, 3)]
+    totals = cube.daily_totals(start=START, end=END)
+    pd.testing.assert_frame_equal(totals, expected, check_names=False,
+                                  check_freq=False, check_column_type=False)
+    assert totals[('FULTON ST', '2345ACJZ')].isnull().sum() == 1
+
+    pd.testing.assert_series_equal(
+        cube.station_means(start=START, end=END), expected.mean(),
+        check_names=False, check_index_type=False)
+    pd.testing.assert_series_equal(
+        cube.station_means(start=START, end=END, period='interval'),
+        table.mean(), check_names=False, check_index_type=False)
+
+
+@pytest.mark.parametrize('by, bucket_of', [
+    ('hour', lambda times: times.hour),
+    ('dayofweek', lambda times: times.dayofweek),
+    ('hour_of_week', lambda times: times.dayofweek * 24 + times.hour)])
+def test_profiles(data, cube, by, bucket_of):
+    table = _table(data)
+    expected = table.groupby(bucket_of(table.index)).mean()
+    profile = cube.profile(start=START, end=END, by=by)
+    pd.testing.assert_frame_equal(profile, expected, check_names=False,
+                                  check_index_type=False,
+                                  check_column_type=False)
+
+
+def test_errors(data, cube, tmp_path):
+    with pytest.raises(Exception, match='Unknown stations'):
+        cube.slice(stations=[('CANAL ST', 'JNQRZ6W')])
+    with pytest.raises(Exception, match='Unsupported profile'):
+        cube.profile(by='month')
+    with pytest.raises(Exception, match='divide a day'):
+        build_cube(data, str(tmp_path), frequency='7H')
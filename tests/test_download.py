@@ -0,0 +1,191 @@
+import gzip
+import pandas as pd
+import pytest
+import requests
+import shutil
+import threading
+import zipfile
+
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from src.turnstile import synthetic, turnstile
+
+# These tests download the synthetic weekly files of conftest.py from a local
+# HTTP server, and compare them with the files read directly
+
+START = datetime(2020, 1, 1)
+END = datetime(2020, 1, 10)
+# the weekly files of START to END
+WEEKS = ['turnstile_200104.txt', 'turnstile_200111.txt']
+
+
+def _read_weeks(site: str, weeks=WEEKS) -> pd.DataFrame:
+    return pd.concat([pd.read_csv(Path(site) / 'data/nyct/turnstile' / week,
+                                  dtype=turnstile.RAW_DTYPES)
+                      for week in weeks])
+
+
+class _FlakyHandler(SimpleHTTPRequestHandler):
+    # fails the first request of each weekly file with a 503
+    failed = set()
+
+    def do_GET(self):
+        if self.path.endswith('.txt') and self.path not in self.failed:
+            self.failed.add(self.path)
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _GzipHandler(SimpleHTTPRequestHandler):
+    # sends the weekly files with a gzip content encoding
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not path.endswith('.txt'):
+            return super().do_GET()
+        with open(path, 'rb') as f:
+            body = gzip.compress(f.read())
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(site: str, handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                 partial(handler, directory=site))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _url(server: ThreadingHTTPServer) -> str:
+    return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_download(site, base_url, workers):
+    raw = turnstile.download_turnstile_data(START, END, workers=workers,
+                                            base_url=base_url)
+    pd.testing.assert_frame_equal(raw, _read_weeks(site))
+
+
+def test_retries(site):
+    server = _serve(site, _FlakyHandler)
+    try:
+        raw = turnstile.download_turnstile_data(START, END, workers=2,
+                                                base_url=_url(server))
+    finally:
+        server.shutdown()
+    assert len(_FlakyHandler.failed) == len(WEEKS)
+    pd.testing.assert_frame_equal(raw, _read_weeks(site))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_stream_parsing(site, base_url, workers):
+    # the files are parsed from the response stream, a content encoding is
+    # undone on the way
+    server = _serve(site, _GzipHandler)
+    try:
+        raw = turnstile.download_turnstile_data(START, END, workers=workers,
+                                                base_url=_url(server))
+    finally:
+        server.shutdown()
+    pd.testing.assert_frame_equal(raw, _read_weeks(site))
+
+    # an error page is raised, not parsed
+    with requests.Session() as session:
+        with pytest.raises(requests.HTTPError):
+            turnstile._download_turnstile_file(
+                session, base_url + 'data/nyct/turnstile/missing.txt')
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_cache_directory(site, tmp_path, workers):
+    server, url = synthetic.serve_turnstile_site(site)
+    try:
+        downloaded = turnstile.download_turnstile_data(
+            START, END, workers=workers, base_url=url,
+            cache_directory=str(tmp_path))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert sorted(f.name for f in tmp_path.iterdir()) == sorted(
+        ['turnstile.html'] + ['data_nyct_turnstile_' + week + '.parquet'
+                              for week in WEEKS])
+
+    # read from the cache, the server is gone
+    cached = turnstile.download_turnstile_data(
+        START, END, workers=workers, base_url=url,
+        cache_directory=str(tmp_path))
+    pd.testing.assert_frame_equal(cached.reset_index(drop=True),
+                                  downloaded.reset_index(drop=True))
+    compact = turnstile.download_turnstile_data(
+        START, END, workers=workers, base_url=url,
+        cache_directory=str(tmp_path), compact=True)
+    pd.testing.assert_frame_equal(
+        compact, turnstile._compact_raw_data(
+            _read_weeks(site).reset_index(drop=True)),
+        check_categorical=False)
+
+
+@pytest.fixture(scope='module')
+def archives(site, tmp_path_factory):
+    # the weekly files of the site as a directory, gzip compressed files, a
+    # zip file with a compressed member, a zip file next to an extracted
+    # copy of one of its files, and one file
+    directory = tmp_path_factory.mktemp('archives')
+    weeks = sorted((Path(site) / 'data/nyct/turnstile').iterdir())
+    (directory / 'gz').mkdir()
+    for week in weeks:
+        with open(week, 'rb') as f:
+            (directory / 'gz' / (week.name + '.gz')).write_bytes(
+                gzip.compress(f.read()))
+    (directory / 'mixed').mkdir()
+    with zipfile.ZipFile(directory / 'mixed' / 'weeks.zip', 'w') as z:
+        z.write(weeks[0], 'turnstile/' + weeks[0].name)
+        z.write(directory / 'gz' / (weeks[1].name + '.gz'),
+                'turnstile/' + weeks[1].name + '.gz')
+        z.write(weeks[2], 'turnstile/' + weeks[2].name)
+    shutil.copy(weeks[1], directory / 'mixed')
+    return {'directory': site, 'gz': str(directory / 'gz'),
+            'zip': str(directory / 'mixed' / 'weeks.zip'),
+            'mixed': str(directory / 'mixed'), 'file': str(weeks[1])}
+
+
+@pytest.mark.parametrize('kind', ['directory', 'gz', 'zip', 'mixed'])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_archive(base_url, archives, kind, workers):
+    downloaded = turnstile.download_turnstile_data(START, END,
+                                                   base_url=base_url)
+    pd.testing.assert_frame_equal(
+        turnstile.read_turnstile_archive(START, END, archives[kind],
+                                         workers=workers), downloaded)
+    pd.testing.assert_frame_equal(
+        turnstile.download_turnstile_data(START, END, archive=archives[kind],
+                                          compact=True),
+        turnstile.download_turnstile_data(START, END, base_url=base_url,
+                                          compact=True))
+    # the weeks are named after the links of the MTA page
+    assert [link for link, _ in turnstile._iterate_turnstile_files(
+        START, END, archive=archives[kind])] == \
+        [link for link, _ in turnstile._iterate_turnstile_files(
+            START, END, base_url=base_url)]
+
+
+def test_archive_file(site, archives, tmp_path):
+    # a weekly file is an archive of its week
+    pd.testing.assert_frame_equal(
+        turnstile.read_turnstile_archive(START, END, archives['file']),
+        _read_weeks(site, WEEKS[1:]))
+    with pytest.raises(Exception, match='No weekly turnstile files'):
+        turnstile.read_turnstile_archive(START, END, str(tmp_path))
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.turnstile.hierarchy import LEVELS, Crosswalk, aggregate_levels
+
+CROSSWALK = pd.DataFrame({
+    'station_name': ['Canal St', 'Canal St', 'Canal St', 'Astor Pl',
+                     'Bowling Green'],
+    'clean_lines': ['46', 'JZ', 'NQRW', '6', '45'],
+    'gtfs_stop_id': ['639', 'M20', 'R23', '636', '420'],
+    'turnstile_units': ['R118,R462', 'R118', 'R119', 'R160', None],
+})
+EQUIPMENT = pd.DataFrame({'borough': ['M', 'M'],
+                          'remote': ["['R118']", "['R160']"]})
+TRANSFERS = pd.DataFrame({'from_stop_id': ['639'], 'to_stop_id': ['R23'],
+                          'transfer_type': [2]})
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('crosswalk')
+    CROSSWALK.to_csv(directory / 'crosswalk.csv')
+    EQUIPMENT.to_csv(directory / 'equipment.csv')
+    TRANSFERS.to_csv(directory / 'transfers.txt', index=False)
+    return [str(directory / name) for name in
+            ['crosswalk.csv', 'equipment.csv', 'transfers.txt']]
+
+
+def test_crosswalk(files):
+    # the Canal St stations share R118, and the transfer joins the third
+    crosswalk = Crosswalk.from_files(*files)
+    assert list(crosswalk.complexes) == ['Canal St 46JNQRWZ', 'Astor Pl 6',
+                                         'Bowling Green 45']
+    assert list(crosswalk.complex_codes(
+        pd.Series(['R118', 'R462', 'R119', 'R160', 'R999']))) == \
+        [0, 0, 0, 1, -1]
+    assert list(crosswalk.boroughs) == ['M']
+    assert list(crosswalk.complex_boroughs) == [0, 0, -1]
+
+    crosswalk = Crosswalk.from_files(*files[:2])
+    assert list(crosswalk.complexes) == ['Canal St 46JZ', 'Canal St NQRW',
+                                         'Astor Pl 6', 'Bowling Green 45']
+    assert list(crosswalk.complex_boroughs) == [0, -1, 0, -1]
+
+
+@pytest.fixture(scope='module')
+def crosswalk():
+    # R001 and R002 are a complex in Manhattan, R003 one without a borough
+    return Crosswalk(pd.Index(['R001', 'R002', 'R003']), np.array([0, 0, 1]),
+                     pd.Index(['A/B 12', 'C 3']), np.array([0, -1]),
+                     pd.Index(['M']))
+
+
+@pytest.fixture(scope='module')
+def turnstile_data():
+    # R003 is listed under two station names, R004 isn't in the crosswalk
+    turnstiles = pd.DataFrame(
+        [('R001', '00-00-00', 'A', '12'), ('R001', '00-00-01', 'A', '12'),
+         ('R002', '00-00-00', 'B', '12'), ('R003', '00-00-00', 'C', '3'),
+         ('R003', '00-00-01', 'C ST', '3'), ('R004', '00-00-00', 'D', '4')],
+        columns=['UNIT', 'SCP', 'STATION', 'LINENAME'])
+    times = pd.date_range('2020-01-01', periods=4, freq='H')
+    rng = np.random.default_rng(0)
+    data = turnstiles.merge(pd.DataFrame({'datetime': times}), how='cross')
+    return data.assign(
+        estimated_entries=rng.integers(0, 100, len(data)).astype(float),
+        estimated_exits=rng.integers(0, 100, len(data)).astype(float)
+    ).sample(frac=1, random_state=0)
+
+
+@pytest.mark.parametrize('levels', [LEVELS, ['BOROUGH', 'STATION'],
+                                    ['COMPLEX']])
+def test_levels(crosswalk, turnstile_data, levels):
+    result = aggregate_levels(turnstile_data, crosswalk, levels)
+    assert list(result['level'].unique()) == \
+        [level for level in LEVELS if level in levels]
+
+    complexes = {'R001': 'A/B 12', 'R002': 'A/B 12', 'R003': 'C 3'}
+    boroughs = {'R001': 'M', 'R002': 'M'}
+    data = turnstile_data.assign(
+        COMPLEX=turnstile_data['UNIT'].map(complexes),
+        BOROUGH=turnstile_data['UNIT'].map(boroughs))
+    keys = {'SCP': ['UNIT', 'SCP'], 'UNIT': ['UNIT'],
+            'STATION': ['STATION', 'LINENAME'], 'COMPLEX': ['COMPLEX'],
+            'BOROUGH': ['BOROUGH']}
+    columns = ['estimated_entries', 'estimated_exits']
+    for level in levels:
+        rows = result[result['level'] == level]
+        expected = data.groupby(['datetime'] + keys[level], dropna=False)[
+            columns].sum().reset_index()
+        # by time, then the nodes, the one of the units without a complex or
+        # borough first
+        expected = expected.sort_values(['datetime'] + keys[level],
+                                        na_position='first', ignore_index=True)
+        pd.testing.assert_frame_equal(
+            rows[['datetime'] + keys[level] + columns].reset_index(drop=True),
+            expected, check_dtype=False)
+        # every level adds up to the total of each time
+        pd.testing.assert_frame_equal(
+            rows.groupby('datetime')[columns].sum(),
+            data.groupby('datetime')[columns].sum())
+        # the keys of the other levels are missing
+        others = set(result.columns) - {'level', 'datetime'} - \
+            set(keys[level]) - set(columns)
+        assert rows[sorted(others)].isnull().all(None)
+
+
+def test_errors(crosswalk, turnstile_data):
+    with pytest.raises(Exception, match='Unsupported levels'):
+        aggregate_levels(turnstile_data, crosswalk, ['LINE'])
+    with pytest.raises(Exception, match='needs the columns'):
+        aggregate_levels(turnstile_data.drop(columns='SCP'), crosswalk)
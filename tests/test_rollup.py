@@ -0,0 +1,66 @@
+import pandas as pd
+import pytest
+
+from src.turnstile.rollup import RollupPyramid, RollupWriter, update_rollups
+
+RULES = {'D': 'D', 'W': 'W-SUN', 'M': 'M', 'Y': 'Y'}
+
+
+@pytest.fixture(scope='module')
+def pyramid(station_data):
+    return RollupPyramid.build(station_data)
+
+
+def _weeks(station_data):
+    weeks = station_data['datetime'].dt.to_period('W-SUN')
+    return [week for _, week in station_data.groupby(weeks)]
+
+
+@pytest.mark.parametrize('freq', ['D', 'W', 'M', 'Y'])
+@pytest.mark.parametrize('start, end', [(None, None), ('2019-03-04', '2019-03-25'),
+                                        ('2019-01-01', '2020-01-01'), ('2019-02-03', '2019-05-17')])
+def test_rollup(station_data, stations, pyramid, freq, start, end):
+    stations = [stations[0], stations[2]]
+    try:
+        result = pyramid.rollup(freq, stations=stations, start=start, end=end)
+    except Exception as e:
+        # weekly and coarser buckets need a range on their boundaries or
+        # on days
+        assert 'time range' in str(e)
+        return
+    selected = station_data[station_data['STATION'].isin(
+        [station for station, _ in stations])]
+    if start is not None:
+        selected = selected[(selected['datetime'] >= start) & (selected['datetime'] < end)]
+    buckets = selected['datetime'].dt.to_period(RULES[freq]).dt.start_time
+    expected = selected.groupby([buckets, 'STATION', 'LINENAME'])['estimated_entries'].sum()
+    result = result.set_index(['datetime', 'STATION', 'LINENAME'])['estimated_entries']
+    pd.testing.assert_series_equal(result.sort_index(), expected.sort_index(),
+                                   check_names=False, check_index_type=False)
+
+
+def test_updates(station_data, pyramid, tmp_path):
+    weeks = _weeks(station_data)
+    # each update first adds provisional values, then replaces them
+    update_rollups(str(tmp_path), pd.concat(weeks[:-8]))
+    for week in weeks[-8:]:
+        provisional = week.assign(estimated_entries=week['estimated_entries'] + 1000)
+        update_rollups(str(tmp_path), provisional)
+        update_rollups(str(tmp_path), week)
+    updated = RollupPyramid.load(str(tmp_path))
+    for level, data in pyramid.levels.items():
+        pd.testing.assert_frame_equal(data, updated.levels[level], check_dtype=False,
+                                      check_index_type=False)
+
+
+def test_writer(station_data, pyramid, tmp_path):
+    # the sink of the stream folds each chunk in as it arrives
+    writer = RollupWriter(str(tmp_path), rebuild=True)
+    for week in _weeks(station_data):
+        writer.write(week)
+    written = writer.close()
+    for level, data in pyramid.levels.items():
+        pd.testing.assert_frame_equal(data, written.levels[level], check_dtype=False,
+                                      check_index_type=False)
+    pd.testing.assert_frame_equal(RollupPyramid.load(str(tmp_path)).levels['M'],
+                                  written.levels['M'], check_index_type=False)
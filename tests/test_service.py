@@ -0,0 +1,157 @@
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import threading
+
+from datetime import datetime
+
+from src.turnstile.service import COLUMNS, RidershipIndex, \
+    RidershipService, load_station_data
+from src.turnstile.store import write_station_store
+from src.turnstile.turnstile import FREQUENCIES
+from src.turnstile.writer import write_station_files
+
+START = datetime(2019, 1, 9, 7)
+END = datetime(2019, 2, 12)
+
+
+@pytest.fixture(scope='module')
+def data(station_data):
+    # two months, some hours without ridership
+    data = station_data[station_data['datetime'].between(
+        '2019-01-01', '2019-02-28 23:00')].copy()
+    missing = data.sample(100, random_state=0).index
+    data.loc[missing, 'estimated_entries'] = np.nan
+    return data
+
+
+@pytest.fixture(scope='module')
+def service(data):
+    return RidershipService(RidershipIndex(data.sample(frac=1,
+                                                       random_state=1)))
+
+
+def _expected(data, stations, start, end, freq, agg, group):
+    selected = data[data['STATION'].isin(stations) &
+                    (data['datetime'] >= start) & (data['datetime'] < end)]
+    buckets = pd.Series(FREQUENCIES[freq](selected['datetime'].to_numpy()),
+                        index=selected.index, name='datetime')
+    keys = ['STATION', 'LINENAME'] if group == 'station' else []
+    expected = selected.groupby(keys + [buckets])[COLUMNS].agg(agg)
+    return expected.reset_index()[keys + ['datetime'] + COLUMNS]
+
+
+@pytest.mark.parametrize('freq', ['raw', 'H', 'D', 'W', 'M'])
+@pytest.mark.parametrize('agg', ['sum', 'mean', 'max', 'min'])
+@pytest.mark.parametrize('group', ['station', 'total'])
+def test_query(data, service, freq, agg, group):
+    result = service.index.query(stations=['59 st', 'W 4 ST-WASH SQ'],
+                                 start=START, end=END, freq=freq, agg=agg,
+                                 group=group)
+    expected = _expected(data, ['59 ST', 'W 4 ST-WASH SQ'], START, END,
+                         freq, agg, group)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_select_stations(service):
+    index = service.index
+    assert list(index.select_stations()) == [0, 1, 2]
+    assert list(index.select_stations(['fulton st'])) == [1]
+    # the lines served, A matches ACJZ and ABCDEFM
+    assert list(index.select_stations(line='A')) == [1, 2]
+    assert list(index.select_stations(['59 ST'], line='A')) == []
+
+
+@pytest.mark.parametrize('group', ['station', 'total'])
+@pytest.mark.parametrize('arguments', [
+    {'stations': ['CANAL ST']},
+    {'start': datetime(2021, 1, 1)},
+    {'start': END, 'end': START},
+])
+def test_empty_selection(service, group, arguments):
+    for agg in ['sum', 'mean', 'max', 'min']:
+        result = service.index.query(freq='D', agg=agg, group=group,
+                                     **arguments)
+        assert result.empty
+        assert list(result.columns) == (
+            ['STATION', 'LINENAME'] if group == 'station' else []) + \
+            ['datetime'] + COLUMNS
+    status, body = service.handle(
+        'GET', '/ridership?station=CANAL ST&freq=D&group=' + group)
+    assert status == 200 and body['rows'] == []
+
+
+def test_handle(data, service):
+    status, body = service.handle(
+        'GET', '/ridership?station=FULTON ST&start=2019-01-09T07:00'
+        '&end=2019-02-12&freq=D&agg=mean&columns=estimated_exits')
+    assert status == 200
+    expected = _expected(data, ['FULTON ST'], START, END, 'D', 'mean',
+                         'station')
+    rows = pd.DataFrame(body['rows'])
+    assert list(rows.columns) == ['STATION', 'LINENAME', 'datetime',
+                                  'estimated_exits']
+    pd.testing.assert_frame_equal(
+        rows.assign(datetime=pd.to_datetime(rows['datetime'])),
+        expected.drop(columns='estimated_entries'))
+
+    status, body = service.handle('GET', '/stations')
+    assert status == 200
+    assert [(s['station'], s['rows']) for s in body['stations']] == [
+        ('59 ST', 1416), ('FULTON ST', 1416), ('W 4 ST-WASH SQ', 1416)]
+    assert service.handle('GET', '/health') == (
+        200, {'status': 'ok', 'rows': len(data), 'stations': 3})
+
+    for target in ['/ridership?freq=Q', '/ridership?agg=median',
+                   '/ridership?group=line', '/ridership?columns=riders',
+                   '/ridership?start=yesterday']:
+        status, body = service.handle('GET', target)
+        assert status == 400, target
+    assert service.handle('GET', '/trains')[0] == 404
+    assert service.handle('POST', '/stations')[0] == 405
+
+
+def test_server(service):
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(service.start(port=0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % server.sockets[0].getsockname()[1]
+    try:
+        # two requests on one keep-alive connection
+        with requests.Session() as session:
+            stations = session.get(url + 'stations')
+            ridership = session.get(url + 'ridership',
+                                    params={'station': '59 ST', 'freq': 'M'})
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        # the connections still open, as asyncio.run ends them
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, server.wait_closed(),
+                                               return_exceptions=True))
+        loop.close()
+    assert stations.status_code == 200
+    assert len(stations.json()['stations']) == 3
+    assert ridership.status_code == 200
+    assert [row['datetime'] for row in ridership.json()['rows']] == [
+        '2019-01-01', '2019-02-01']
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_load_station_data(data, tmp_path, output_format):
+    data = data.fillna(0)
+    if output_format == 'csv':
+        write_station_files(data, str(tmp_path), compression='gzip')
+    else:
+        write_station_store(data, str(tmp_path))
+    loaded = RidershipIndex(load_station_data(str(tmp_path), output_format))
+    expected = RidershipIndex(data)
+    for freq in ['raw', 'D']:
+        pd.testing.assert_frame_equal(loaded.query(freq=freq),
+                                      expected.query(freq=freq))
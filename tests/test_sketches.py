@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.turnstile.sketches import RidershipSketches, SketchWriter, merge_sketches
+
+QUANTILES = [0.1, 0.5, 0.9, 0.99]
+
+
+@pytest.fixture(scope='module')
+def sketches(station_data):
+    sketches = RidershipSketches()
+    sketches.add(station_data)
+    return sketches
+
+
+def _months(station_data):
+    months = station_data['datetime'].dt.to_period('M')
+    return [month for _, month in station_data.groupby(months)]
+
+
+def _assert_sketches_equal(result, expected):
+    by = ['month', 'hour_of_week']
+    for column in ['estimated_entries', 'estimated_exits']:
+        pd.testing.assert_frame_equal(result.quantiles(QUANTILES, column, by=by),
+                                      expected.quantiles(QUANTILES, column, by=by))
+        pd.testing.assert_frame_equal(result.describe(column, by=by),
+                                      expected.describe(column, by=by), check_dtype=False)
+
+
+def test_merge(station_data, sketches, tmp_path):
+    # the sketches of separate chunks add up to the sketches of all of them
+    months = _months(station_data)
+    merged = RidershipSketches()
+    paths = []
+    for i, month in enumerate(months):
+        chunk = RidershipSketches()
+        chunk.add(month)
+        merged.merge(chunk)
+        paths.append(str(tmp_path / str(i)))
+        chunk.save(paths[-1])
+    _assert_sketches_equal(merged, sketches)
+    _assert_sketches_equal(merge_sketches(paths, output=str(tmp_path / 'merged')), sketches)
+    _assert_sketches_equal(RidershipSketches.load(str(tmp_path / 'merged')), sketches)
+
+    with pytest.raises(Exception, match='accuracy'):
+        merged.merge(RidershipSketches(0.05))
+
+
+@pytest.mark.parametrize('by', [['hour_of_week'], ['month']])
+def test_quantiles(station_data, sketches, by):
+    result = sketches.quantiles(QUANTILES, by=by)
+    times = station_data['datetime'].dt
+    keys = {'hour_of_week': times.dayofweek * 24 + times.hour,
+            'month': times.to_period('M').dt.start_time}
+    grouped = station_data.groupby(['STATION', 'LINENAME'] + [keys[k].rename(k) for k in by])
+    for q in QUANTILES:
+        # the sketch returns the value of the rank below the quantile,
+        # within its relative accuracy
+        expected = grouped['estimated_entries'].quantile(q, interpolation='lower')
+        column = 'p' + ('%g' % (q * 100)).replace('.', '_')
+        values = result.set_index(['STATION', 'LINENAME'] + by)[column]
+        assert len(values) == len(expected)
+        np.testing.assert_allclose(values.loc[expected.index].to_numpy(),
+                                   expected.to_numpy(), rtol=sketches.accuracy)
+
+
+def test_describe(station_data, sketches, stations):
+    result = sketches.describe(column='estimated_exits', stations=stations[:2],
+                               start='2019-03-01', end='2019-06-01', by=['month'])
+    selected = station_data[station_data['STATION'].isin([s for s, _ in stations[:2]])
+                            & (station_data['datetime'] >= '2019-03-01')
+                            & (station_data['datetime'] < '2019-06-01')]
+    month = selected['datetime'].dt.to_period('M').dt.start_time.rename('month')
+    expected = selected.groupby(['STATION', 'LINENAME', month])['estimated_exits'].agg(
+        ['count', 'mean', 'std', 'min', 'max']).reset_index()
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_writer(station_data, sketches, tmp_path):
+    # the sink of the stream sums the turnstiles of each chunk by station
+    writer = SketchWriter(str(tmp_path))
+    for month in _months(station_data):
+        chunk = month.assign(UNIT='R001', SCP='00-00-00')
+        writer.write(chunk)
+    written = writer.close()
+    _assert_sketches_equal(written, sketches)
+    _assert_sketches_equal(RidershipSketches.load(str(tmp_path)), sketches)
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+from datetime import datetime
+
+from src.turnstile.store import StoreWriter, read_station_store, \
+    write_station_store
+
+COLUMNS = ['datetime', 'STATION', 'LINENAME', 'estimated_entries',
+           'estimated_exits']
+
+
+@pytest.fixture(scope='module')
+def data(station_data):
+    # three months of the station data
+    return station_data[station_data['datetime'] < '2019-03-01']
+
+
+def _compare(read: pd.DataFrame, expected: pd.DataFrame):
+    read = read.astype({'STATION': str, 'LINENAME': str})
+    sort = ['STATION', 'LINENAME', 'datetime']
+    pd.testing.assert_frame_equal(
+        read[COLUMNS].sort_values(sort, ignore_index=True),
+        expected[COLUMNS].sort_values(sort, ignore_index=True),
+        check_dtype=False)
+
+
+def test_round_trip(data, tmp_path):
+    write_station_store(data, str(tmp_path))
+    partitions = sorted(str(p.relative_to(tmp_path))
+                        for p in tmp_path.glob('*/*'))
+    assert partitions == sorted(
+        'station=%s/month=%s' % (station, month)
+        for station in ['59_ST_NQR456W', 'FULTON_ST_2345ACJZ',
+                        'W_4_ST_WASH_SQ_ABCDEFM']
+        for month in ['2018-12', '2019-01', '2019-02'])
+    _compare(read_station_store(str(tmp_path)), data)
+
+
+def test_partition_pruning(data, stations, tmp_path):
+    write_station_store(data, str(tmp_path))
+    # the files of the other stations and months are not opened. The schema
+    # of the dataset is read from its first file, which is kept.
+    for pattern in ['station=W_4_ST*/*', 'station=FULTON*/month=2018-12']:
+        for part in tmp_path.glob(pattern + '/*.parquet'):
+            part.write_bytes(b'not a parquet file')
+
+    start, end = datetime(2019, 1, 15), datetime(2019, 2, 10, 12)
+    read = read_station_store(str(tmp_path), stations=stations[:2],
+                              start_date=start, end_date=end,
+                              columns=COLUMNS)
+    expected = data[data['STATION'].isin(['59 ST', 'FULTON ST']) &
+                    data['datetime'].between(start, end)]
+    _compare(read, expected)
+    assert list(read.columns) == COLUMNS
+
+
+def test_store_writer(data, tmp_path):
+    # a second run replaces the station months of the first one, the weeks
+    # of a run are added to the months they share
+    for run in range(2):
+        writer = StoreWriter(str(tmp_path))
+        weeks = data['datetime'].dt.to_period('W')
+        for _, week in data.groupby(weeks):
+            writer.write(week.assign(
+                estimated_entries=week['estimated_entries'] + run))
+    expected = data.assign(estimated_entries=data['estimated_entries'] + 1)
+    _compare(read_station_store(str(tmp_path)), expected)
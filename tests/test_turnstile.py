@@ -0,0 +1,116 @@
+import pandas as pd
+import pytest
+import shutil
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from src.turnstile import incremental, sharding, streaming, turnstile
+from src.turnstile.result_cache import ResultCache
+
+# These tests check that the paths computing the same turnstile data agree,
+# on the synthetic mirror of the weekly files of conftest.py, read with
+# archive=
+
+START = datetime(2020, 1, 8)
+END = datetime(2020, 1, 20)
+KEYS = ['datetime', 'UNIT', 'SCP']
+STATION_KEYS = ['datetime', 'STATION', 'LINENAME']
+COLUMNS = ['estimated_entries', 'estimated_exits']
+
+
+def _sorted(data: pd.DataFrame, keys=KEYS) -> pd.DataFrame:
+    if 'datetime' not in data.columns:
+        data = data.reset_index()
+    data = data.assign(**{k: data[k].astype(str) for k in keys if k != 'datetime'})
+    return data.sort_values(keys).reset_index(drop=True)[keys + COLUMNS]
+
+
+def test_result_cache(site, tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    cached = cache.get(START, END, archive=site)
+    # the rows of create_interpolated_turnstile_data, in the same order
+    direct = turnstile.create_interpolated_turnstile_data(START, END, archive=site)
+    pd.testing.assert_index_equal(cached.index, direct.index)
+    pd.testing.assert_frame_equal(cached[['UNIT', 'SCP']], direct[['UNIT', 'SCP']])
+
+    # served from the cached segments
+    pd.testing.assert_frame_equal(cache.get(START, END, archive=site), cached)
+
+    # the estimates of a week don't depend on the date range of the call
+    shifted = ResultCache(str(tmp_path / 'shifted')).get(
+        START + timedelta(days=3), END + timedelta(days=2), archive=site)
+    pd.testing.assert_frame_equal(
+        cached[cached.index >= START + timedelta(days=3)],
+        shifted[shifted.index <= END])
+
+
+def test_engines(site):
+    pandas = _sorted(turnstile.create_interpolated_turnstile_data(
+        START, END, engine='pandas', archive=site))
+    numpy = _sorted(turnstile.create_interpolated_turnstile_data(
+        START, END, engine='numpy', archive=site))
+    pd.testing.assert_frame_equal(pandas, numpy, check_dtype=False)
+
+
+def test_workers(site):
+    single = turnstile.create_interpolated_turnstile_data(
+        START, END, engine='numpy', archive=site)
+    parallel = turnstile.create_interpolated_turnstile_data(
+        START, END, engine='numpy', workers=2, archive=site)
+    pd.testing.assert_frame_equal(single, parallel)
+
+
+def test_incremental(site, tmp_path):
+    # the weekly files published so far, one more on each update
+    published = tmp_path / 'published'
+    published.mkdir()
+    updated = tmp_path / 'updated'
+    for week in sorted(Path(site).rglob('turnstile_*.txt')):
+        shutil.copy(week, published)
+        incremental.update_station_files(str(updated), START, archive=str(published))
+
+    rebuilt = tmp_path / 'rebuilt'
+    station_writer = streaming.StationWriter(str(rebuilt))
+    for chunk in streaming.stream_interpolated_turnstile_data(
+            START, group_by=['STATION', 'LINENAME', 'UNIT', 'SCP'], archive=site):
+        station_writer.write(chunk)
+    files = sorted(f.name for f in rebuilt.iterdir())
+    assert files == sorted(f.name for f in updated.iterdir() if f.name != incremental.STATE_FILE)
+    for name in files:
+        assert (rebuilt / name).read_text() == (updated / name).read_text(), name
+
+    # the files can't be continued with other parameters
+    with pytest.raises(Exception, match='were created with'):
+        incremental.update_station_files(str(updated), START, engine='numpy',
+                                         archive=str(published))
+
+
+def test_sharding(site, tmp_path):
+    job = str(tmp_path / 'job')
+    sharding.create_job(job, START, END, unit_shards=2, window=timedelta(days=5),
+                        archive=site)
+    processes = sharding.start_local_workers(job, 2)
+    sharding.wait_for_job(job, poll=0.1, processes=processes)
+    assert all(p.exitcode == 0 for p in processes)
+    merged = sharding.merge_job(job)
+
+    batch = turnstile.sum_turnstile_data_by_station(
+        turnstile.create_interpolated_turnstile_data(
+            START, END, group_by=['STATION', 'LINENAME', 'UNIT', 'SCP'],
+            archive=site).reset_index())
+    pd.testing.assert_frame_equal(_sorted(batch, STATION_KEYS),
+                                  _sorted(merged, STATION_KEYS))
+
+
+@pytest.mark.parametrize('engine', ['pandas', 'numpy'])
+def test_frequencies(site, engine):
+    # the splines fitted once give the same data as a call per frequency
+    frequencies = ['15T', '1H', '1D']
+    together = turnstile.create_interpolated_turnstile_data(
+        START, END, frequency=frequencies, engine=engine, archive=site)
+    for frequency in frequencies:
+        pd.testing.assert_frame_equal(together[frequency],
+                                      turnstile.create_interpolated_turnstile_data(
+                                          START, END, frequency=frequency,
+                                          engine=engine, archive=site))
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from src.turnstile.writer import MANIFEST_FILE, split_by_station, \
+    write_manifest, write_station_files
+
+FILES = ['59_ST_NQR456W.csv', 'FULTON_ST_2345ACJZ.csv',
+         'W_4_ST_WASH_SQ_ABCDEFM.csv']
+
+
+@pytest.fixture(scope='module')
+def data(station_data):
+    return station_data[station_data['datetime'] < '2019-01-01']
+
+
+@pytest.mark.parametrize('compression, suffix', [
+    (None, ''), ('gzip', '.gz'), ('bz2', '.bz2'), ('xz', '.xz'),
+    ('zstd', '.zst')])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_station_files(data, stations, tmp_path, compression, suffix,
+                       workers):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    files = write_station_files(data, str(tmp_path), workers=workers,
+                                compression=compression)
+    assert [f.name for f in files] == [name + suffix for name in FILES]
+    assert sorted(f.name for f in tmp_path.iterdir()) == \
+        [f.name for f in files]
+    for station, path in zip(stations, files):
+        # the compression is inferred from the suffix
+        read = pd.read_csv(path, parse_dates=['datetime'])
+        expected = data[(data['STATION'] == station[0]) &
+                        (data['LINENAME'] == station[1])]
+        pd.testing.assert_frame_equal(read, expected.reset_index(drop=True))
+
+
+def test_unsupported_compression(data, tmp_path):
+    with pytest.raises(Exception, match='Unsupported compression'):
+        write_station_files(data, str(tmp_path), compression='zip')
+
+
+def test_split_by_station(data):
+    # the stations in order, the rows of each in their original order
+    shuffled = data.sample(frac=1, random_state=0)
+    split = split_by_station(shuffled)
+    assert [station for station, _ in split] == sorted(
+        set(zip(data['STATION'], data['LINENAME'])))
+    for station, rows in split:
+        pd.testing.assert_frame_equal(
+            rows, shuffled[(shuffled['STATION'] == station[0]) &
+                           (shuffled['LINENAME'] == station[1])])
+
+
+def test_manifest(data, tmp_path):
+    files = write_station_files(data, str(tmp_path), compression='gzip')
+    path = write_manifest(files, str(tmp_path), url_prefix='https://x/')
+    assert path == tmp_path / MANIFEST_FILE
+    lines = [line.strip() for line in path.read_text().splitlines()]
+    assert lines[0].startswith('## ')
+    assert lines[1:] == ['- [%s.gz](https://x/%s.gz)' % (name, name)
+                         for name in FILES]